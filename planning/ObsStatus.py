@@ -9,15 +9,14 @@ import time
 
 import ephem
 import matplotlib
-import requests
-from astropy.io.votable import parse
+import numpy
 
 matplotlib.use('Agg')
 from matplotlib.pyplot import figure, close
 from matplotlib.patches import Rectangle
 from matplotlib.backends.backend_pdf import PdfPages
 
-from src.daomop import (storage)
+from src.daomop import (storage, webservice)
 from src.planning import parameters
 
 dbimages = 'vos:jkavelaars/CFIS/dbimages'
@@ -60,22 +59,21 @@ def query_for_observations(mjd, observable, runids):
             "LANG": "ADQL",
             "FORMAT": "votable"}
 
-    result = requests.get(storage.TAP_WEB_SERVICE, params=data, verify=False)
-    assert isinstance(result, requests.Response)
-    logging.debug("Doing TAP Query using url: %s" % (str(result.url)))
-    tmpFile = tempfile.NamedTemporaryFile()
-    with open(tmpFile.name, 'w') as outfile:
-        outfile.write(result.text)
-    try:
-       vot = parse(tmpFile.name).get_first_table()
-    except:
-       print result.text
-       raise
+    def fetch(query):
+        result = webservice.get(storage.TAP_WEB_SERVICE, params=dict(data, QUERY=query), stream=True)
+        logging.debug("Doing TAP Query using url: %s" % (str(result.url)))
+        return webservice.read_votable(result).to_table()
 
-    vot.array.sort(order='StartDate')
-    t = vot.array
-    tmpFile.close()
+    query_cache = storage.get_query_cache()
+    if query_cache is None:
+        table = fetch(data["QUERY"])
+    else:
+        table = query_cache.get(data["QUERY"], data["FORMAT"], fetch, refresh=storage.REFRESH_QUERIES)
 
+    table.sort('StartDate')
+    # the same masked record array that the VOTable parser returns.
+    t = table.as_array()
+    t = numpy.ma.masked_array(numpy.asarray(t).view(numpy.recarray), mask=numpy.ma.getmaskarray(t))
 
     logging.debug("Got {} lines from tap query".format(len(t)))
 
@@ -235,6 +233,9 @@ if __name__ == '__main__':
 
     parser.add_argument('--debug', action='store_true')
 
+    parser.add_argument('--refresh', action='store_true',
+                        help="re-run the TAP query even if its result is in the query cache")
+
     parser.add_argument('--stack', action='store_true', default=False,
                         help=( "Make single status plot that stacks"
                                " data accross multiple nights, instead of nightly sub-plots." ))
@@ -242,6 +243,7 @@ if __name__ == '__main__':
     opt = parser.parse_args()
 
     runids = tuple(opt.runid)
+    storage.REFRESH_QUERIES = opt.refresh
 
     if opt.debug:
         logging.basicConfig(level=logging.DEBUG)
@@ -5,7 +5,6 @@ Wes Fraser and Michele Bannister with more smarty pants stuff added by JJ Kavela
 import copy
 import re
 
-import requests
 import scipy
 from astropy import units
 from astropy.coordinates import SkyCoord
@@ -13,6 +12,7 @@ from astropy.io.ascii import Csv
 from astropy.time import Time
 from astropy.units.quantity import Quantity
 
+from src.daomop import webservice
 from src.validate.gui import logger
 
 
@@ -254,8 +254,7 @@ class Query(object):
                                   Query.SERVER,
                                   Query.END_POINT)
         logger.info("Sending JPL/Hoirzons query.\n")
-        response = requests.get(url, params=self.params)
-        response.raise_for_status()
+        response = webservice.get(url, params=self.params, stream=True)
         self._data = []
         for line in response.iter_lines():
             self._data.append(line)
@@ -12,6 +12,7 @@ from astropy import units
 from astropy.coordinates import SkyCoord
 from astropy.time import TimeDelta, Time
 
+from src.daomop.storage import MyPolygon
 from src.planning.cameras import Camera
 from src.planning.ephem_target import EphemTarget
 
@@ -79,6 +80,19 @@ def create_ephemeris_file(name, camera, kbos, orbits, pointing_date, qrunid):
     return
 
 
+def _token_positions(orbits, tokens):
+    """
+    Arrays of the current RA/DEC of the given tokens, for use with MyPolygon.contains_points.
+
+    @param orbits: dictionary of orbits keyed on token
+    @param tokens: list of tokens to get positions of
+    @return: ra, dec arrays in degrees
+    """
+    ra = np.array([orbits[token].coordinate.ra.degree for token in tokens])
+    dec = np.array([orbits[token].coordinate.dec.degree for token in tokens])
+    return ra, dec
+
+
 def optimize(orbits, required, locations, tokens):
     """
 
@@ -128,15 +142,12 @@ def optimize(orbits, required, locations, tokens):
             best_coverage = [token]
         else:
             logging.debug("Maximizing inclusion of required targets")
+            candidates = [this_token for this_token in this_required if this_token not in covered]
+            ra, dec = _token_positions(orbits, candidates)
             for idx in search_order:
                 pointing.offset(index=idx)
-                this_coverage = []
-                for this_token in this_required:
-                    if this_token in covered:
-                        continue
-                    this_obj = orbits[this_token]
-                    if pointing.polygon.isInside(this_obj.coordinate.ra.degree, this_obj.coordinate.dec.degree):
-                        this_coverage.append(this_token)
+                inside = MyPolygon(pointing.polygon).contains_points(ra, dec)
+                this_coverage = [this_token for this_token, is_inside in zip(candidates, inside) if is_inside]
 
                 if len(this_coverage) > max_sources_in_pointing:
                     max_sources_in_pointing = len(this_coverage)
@@ -150,26 +161,19 @@ def optimize(orbits, required, locations, tokens):
         max_sources_in_pointing = 0
         optimal_coverage = []
         optimal_pointing = None
+        best_ra, best_dec = _token_positions(orbits, best_coverage)
+        candidates = [this_token for this_token in possible_tokens if this_token not in covered]
+        ra, dec = _token_positions(orbits, candidates)
         for idx in search_order:
             pointing.offset(index=idx)
-            exclude = False  # exclude this offset because it doesn't overlap one or more of the required sources.
-            for this_token in best_coverage:
-                this_obj = orbits[this_token]
-                if not pointing.polygon.isInside(this_obj.coordinate.ra.degree, this_obj.coordinate.dec.degree):
-                    exclude = True
-                    break
-
-            if exclude:
+            polygon = MyPolygon(pointing.polygon)
+            # exclude this offset if it doesn't overlap one or more of the required sources.
+            if not np.all(polygon.contains_points(best_ra, best_dec)):
                 continue
 
             # OK, this offset has all the required sources possible, how many extra sources do we get?
-            this_coverage = []
-            for this_token in possible_tokens:
-                if this_token in covered:
-                    continue
-                this_obj = orbits[this_token]
-                if pointing.polygon.isInside(this_obj.coordinate.ra.degree, this_obj.coordinate.dec.degree):
-                    this_coverage.append(this_token)
+            inside = polygon.contains_points(ra, dec)
+            this_coverage = [this_token for this_token, is_inside in zip(candidates, inside) if is_inside]
 
             if len(this_coverage) > max_sources_in_pointing:
                 max_sources_in_pointing = len(this_coverage)
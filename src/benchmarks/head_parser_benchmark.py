@@ -0,0 +1,79 @@
+"""Compare util.MEFHeaders against util.read_mef_headers on a synthetic 40 extension MegaPrime .head file."""
+from __future__ import print_function
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+from astropy.io import fits
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'daomop'))
+import util
+
+
+def write_head_file(filename, nccd=40, nfiller=200):
+    """
+    Write a .head file with a primary header and nccd extensions, each with the WCS/PV keywords and nfiller
+    other cards, roughly the size of a MegaPipe header.
+    """
+    with open(filename, 'w') as fout:
+        for ext in range(nccd + 1):
+            cards = ext == 0 and [('SIMPLE', True), ('RUNID', '17AP30')] or \
+                [('XTENSION', 'IMAGE'), ('EXTVER', ext), ('NAXIS', 2), ('NAXIS1', 2112), ('NAXIS2', 4644),
+                 ('CTYPE1', 'RA---TAN'), ('CTYPE2', 'DEC--TAN'), ('CRPIX1', -7535.5), ('CRPIX2', 9808.4),
+                 ('CRVAL1', 176.48), ('CRVAL2', 8.03), ('CD1_1', -5.1e-5), ('CD1_2', 7.0e-7),
+                 ('CD2_1', 1.2e-7), ('CD2_2', -5.1e-5), ('NORDFIT', 3), ('DATASEC', '[33:2080,1:4612]'),
+                 ('MJDATE', 57000.5), ('EXPTIME', 60.0), ('PHOTZP', 30.0), ('FLAT', '14AQ02-r.flat.fits')]
+            cards += [('PV{}_{}'.format(axis, idx), 1e-3 * idx) for axis in [1, 2] for idx in range(11)]
+            cards += [('KEY{:05d}'.format(idx), 'filler value {}'.format(idx)) for idx in range(nfiller)]
+            for key, value in cards:
+                fout.write(str(fits.Card(key, value, 'comment')) + "\n")
+            fout.write("END      \n")
+
+
+def timed(func, repeat):
+    start = time.time()
+    for idx in range(repeat):
+        func()
+    return (time.time() - start) / repeat
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp()
+    try:
+        filename = os.path.join(directory, '1000001p.head')
+        write_head_file(filename)
+        sidecar = filename + util.HEAD_CACHE_EXT
+
+        def cold_all():
+            if os.access(sidecar, os.F_OK):
+                os.unlink(sidecar)
+            return list(util.MEFHeaders(filename))
+
+        def cold_one():
+            if os.access(sidecar, os.F_OK):
+                os.unlink(sidecar)
+            return util.MEFHeaders(filename)[21]
+
+        results = [('read_mef_headers, all', timed(lambda: util.read_mef_headers(filename), args.repeat)),
+                   ('MEFHeaders, all, no sidecar', timed(cold_all, args.repeat)),
+                   ('MEFHeaders, one ccd, no sidecar', timed(cold_one, args.repeat))]
+        list(util.MEFHeaders(filename))
+        results += [('MEFHeaders, all, sidecar', timed(lambda: list(util.MEFHeaders(filename)), args.repeat)),
+                    ('MEFHeaders, one ccd, sidecar', timed(lambda: util.MEFHeaders(filename)[21], args.repeat))]
+
+        print("{:>34s} {:>10s} {:>8s}".format("parser", "ms", "speedup"))
+        for name, elapsed in results:
+            print("{:>34s} {:>10.2f} {:>8.1f}".format(name, 1000 * elapsed, results[0][1] / elapsed))
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
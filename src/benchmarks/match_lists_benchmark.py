@@ -0,0 +1,117 @@
+"""Compare the k-d tree util.match_lists against a brute force reference on synthetic catalogs.
+
+The reference measures the true angular separation, as the spherical k-d tree match does, while
+util.match_lists_bruteforce only scales RA by cos(dec) on its forward pass so can disagree by construction.
+"""
+from __future__ import print_function
+import argparse
+import logging
+import os
+import sys
+import time
+
+import numpy
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'daomop'))
+import util
+
+
+def synthetic_catalogs(nrows, ra=45.0, dec=20.0, width=0.25, jitter=0.1/3600.0):
+    """
+    Build a pair of catalogs of nrows sources within a width x width degree box, the second being a
+    jittered copy of 90% of the first plus 10% unrelated sources.
+
+    :param nrows: number of sources in each catalog
+    :rtype: numpy.ndarray, numpy.ndarray
+    """
+    pos1 = numpy.transpose((numpy.random.uniform(ra, ra + width, nrows),
+                            numpy.random.uniform(dec, dec + width, nrows)))
+    ncommon = int(0.9 * nrows)
+    pos2 = numpy.concatenate((pos1[numpy.random.permutation(nrows)[:ncommon]] +
+                              numpy.random.normal(0, jitter, size=(ncommon, 2)),
+                              numpy.transpose((numpy.random.uniform(ra, ra + width, nrows - ncommon),
+                                               numpy.random.uniform(dec, dec + width, nrows - ncommon)))))
+    return pos1, pos2
+
+
+def spherical_bruteforce(pos1, pos2, tolerance):
+    """
+    Match by brute force: pos1[idx1] and pos2[idx2] match if each is the nearest, in angular separation, of the
+    other within tolerance degrees.
+
+    :return: match1, match2 as returned by util.match_lists.
+    :rtype: numpy.ma, numpy.ma
+    """
+    xyz1 = util.unit_vectors(pos1)
+    xyz2 = util.unit_vectors(pos2)
+    distance = 2 * numpy.sin(numpy.radians(tolerance) / 2.0)
+
+    def nearest(points, others):
+        idx = numpy.zeros(len(points), dtype=numpy.int64)
+        sep = numpy.zeros(len(points))
+        for row, point in enumerate(points):
+            chords = numpy.sqrt(((others - point) ** 2).sum(axis=1))
+            idx[row] = chords.argmin()
+            sep[row] = chords[idx[row]]
+        return idx, sep
+
+    idx12, sep12 = nearest(xyz1, xyz2)
+    idx21, sep21 = nearest(xyz2, xyz1)
+    match1 = numpy.ma.zeros(len(pos1), dtype=numpy.int64)
+    match1.mask = True
+    match2 = numpy.ma.zeros(len(pos2), dtype=numpy.int64)
+    match2.mask = True
+    idx1 = numpy.arange(len(pos1))[sep12 <= distance]
+    idx2 = idx12[idx1]
+    mutual = idx21[idx2] == idx1
+    match1[idx1[mutual]] = idx2[mutual]
+    match2[idx2[mutual]] = idx1[mutual]
+    return match1, match2
+
+
+def agree(kdtree, reference):
+    """
+    :return: True if the two sets of matches pair the same sources, same masks and same matched indexes.
+    """
+    return all([numpy.array_equal(this.mask, that.mask) and
+                numpy.array_equal(this.compressed(), that.compressed()) for this, that in zip(kdtree, reference)])
+
+
+def timed(func, *args, **kwargs):
+    start = time.time()
+    result = func(*args, **kwargs)
+    return time.time() - start, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--sizes", type=int, nargs='+', default=[1000, 3000, 10000, 30000, 100000],
+                        help="catalog sizes to benchmark")
+    parser.add_argument("--max-brute", type=int, default=10000,
+                        help="largest catalog size to run the brute force reference on")
+    parser.add_argument("--tolerance", type=float, default=0.5,
+                        help="match tolerance, arc-seconds")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    numpy.random.seed(args.seed)
+    tolerance = args.tolerance / 3600.0
+
+    print("{:>8s} {:>12s} {:>12s} {:>10s} {:>8s} {:>6s}".format("nrows", "kdtree (s)", "brute (s)",
+                                                                "speedup", "matched", "agree"))
+    for nrows in args.sizes:
+        pos1, pos2 = synthetic_catalogs(nrows)
+        kd_time, matches = timed(util.match_lists, pos1, pos2, tolerance=tolerance, spherical=True)
+        brute_time = speedup = agreed = "-"
+        if nrows <= args.max_brute:
+            brute_time, reference = timed(spherical_bruteforce, pos1, pos2, tolerance)
+            speedup = "{:.1f}".format(brute_time / kd_time)
+            brute_time = "{:.3f}".format(brute_time)
+            agreed = str(agree(matches, reference))
+        print("{:>8d} {:>12.3f} {:>12s} {:>10s} {:>8d} {:>6s}".format(nrows, kd_time, brute_time, speedup,
+                                                                     int((~matches[0].mask).sum()), agreed))
+
+
+if __name__ == '__main__':
+    sys.exit(main())
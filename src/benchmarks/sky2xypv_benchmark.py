@@ -0,0 +1,87 @@
+"""Compare the vectorized wcs.sky2xypv, with and without the polynomial inverse, against the scalar reference."""
+from __future__ import print_function
+import argparse
+import os
+import sys
+import time
+
+import numpy
+from astropy.io import fits
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'daomop'))
+import wcs
+
+PV = [[-7.030338745606E-03, 1.01755337222, 8.262429361142E-03,
+       0.00000000000, -5.910145454849E-04, -7.494178330178E-04,
+       -3.470178516657E-04, -2.331150605755E-02, -8.187062772669E-06,
+       -2.325429510806E-02, 1.135299506292E-04],
+      [-6.146513090656E-03, 1.01552885426, 8.259666421752E-03,
+       0.00000000000, -4.567030382243E-04, -6.978676921999E-04,
+       -3.732572951216E-04, -2.332572754467E-02, -2.354317291723E-05,
+       -2.329623852891E-02, 1.196394469003E-04]]
+DC = [[19550.08417778, 269.58539826],
+      [-48.85428173, -19520.05812122]]
+
+
+def pv_wcs():
+    """
+    WCS of an edge CCD of the MegaPrime mosaic, where the distortion is largest.
+    """
+    header = fits.Header()
+    cd = numpy.linalg.inv(DC)
+    for key, value in [('NAXIS', 2), ('NAXIS1', 2112), ('NAXIS2', 4644),
+                       ('CTYPE1', 'RA---TAN'), ('CTYPE2', 'DEC--TAN'),
+                       ('CRPIX1', -7535.57493517), ('CRPIX2', 9808.40914361),
+                       ('CRVAL1', 176.486157083), ('CRVAL2', 8.03697351091),
+                       ('CD1_1', cd[0][0]), ('CD1_2', cd[0][1]), ('CD2_1', cd[1][0]), ('CD2_2', cd[1][1]),
+                       ('NORDFIT', 3)]:
+        header[key] = value
+    for axis in [0, 1]:
+        for idx, value in enumerate(PV[axis]):
+            header['PV{}_{}'.format(axis + 1, idx)] = value
+    return wcs.WCS(header)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--npts", type=int, default=100000,
+                        help="number of positions to convert")
+    parser.add_argument("--max-scalar", type=int, default=10000,
+                        help="number of positions to time the scalar reference on, the rate is extrapolated")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    numpy.random.seed(args.seed)
+    image_wcs = pv_wcs()
+    x = numpy.random.uniform(1, 2112, args.npts)
+    y = numpy.random.uniform(1, 4644, args.npts)
+    ra, dec = image_wcs.xy2sky(x, y)
+    ra = ra.value
+    dec = dec.value
+    params = (image_wcs.crpix1, image_wcs.crpix2, image_wcs.crval1, image_wcs.crval2,
+              image_wcs.dc, image_wcs.pv, image_wcs.nord)
+
+    nscalar = min(args.npts, args.max_scalar)
+    start = time.time()
+    for idx in range(nscalar):
+        wcs.sky2xypv_scalar(ra[idx], dec[idx], *params)
+    scalar_rate = nscalar / (time.time() - start)
+
+    start = time.time()
+    inverse = image_wcs.pv_inverse
+    fit_time = time.time() - start
+
+    print("{:>24s} {:>14s} {:>12s} {:>14s}".format("method", "points/s", "speedup", "max err (pix)"))
+    print("{:>24s} {:>14.0f} {:>12s} {:>14s}".format("scalar", scalar_rate, "1.0", "-"))
+    for name, kwargs in [('vectorized', {}), ('vectorized + inverse', {'inverse': inverse})]:
+        start = time.time()
+        xp, yp = wcs.sky2xypv(ra, dec, *params, **kwargs)
+        rate = args.npts / (time.time() - start)
+        error = max(numpy.fabs(xp - x).max(), numpy.fabs(yp - y).max())
+        print("{:>24s} {:>14.0f} {:>12.1f} {:>14.2e}".format(name, rate, rate / scalar_rate, error))
+    print("polynomial inverse fit took {:.3f}s, max residual {:.2e} pix".format(
+        fit_time, inverse.max_residual * numpy.fabs(DC).max()))
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,55 @@
+"""Profile the per-call overhead of WCS.xy2sky/sky2xy on single positions with header re-parsing and with the
+parsed Distortion cached on the WCS."""
+from __future__ import print_function
+import argparse
+import os
+import sys
+import timeit
+
+import numpy
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'daomop'))
+import wcs
+from sky2xypv_benchmark import pv_wcs
+
+
+def parse_every_call(image_wcs, x, y):
+    """
+    The conversions as they were before the Distortion was cached, every property access parsed the header.
+    """
+    header = image_wcs.header
+    ra, dec = wcs.xy2skypv(numpy.array(x), numpy.array(y), header['CRPIX1'], header['CRPIX2'],
+                           header['CRVAL1'], header['CRVAL2'], wcs.parse_cd(header), wcs.parse_pv(header),
+                           wcs.parse_order_fit(header))
+    return wcs.sky2xypv(ra.value, dec.value, header['CRPIX1'], header['CRPIX2'],
+                        header['CRVAL1'], header['CRVAL2'], numpy.array(numpy.mat(wcs.parse_cd(header)).I),
+                        wcs.parse_pv(header), wcs.parse_order_fit(header))
+
+
+def cached(image_wcs, x, y):
+    ra, dec = image_wcs.xy2sky(x, y)
+    return image_wcs.sky2xy(ra, dec)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--calls", type=int, default=2000,
+                        help="number of xy2sky/sky2xy round trips to time")
+    args = parser.parse_args()
+
+    image_wcs = pv_wcs()
+    x, y = 1000.0, 2000.0
+    print("{:>24s} {:>16s}".format("method", "us per round trip"))
+    for name, func in [('parse every call', parse_every_call), ('cached distortion', cached)]:
+        elapsed = timeit.timeit(lambda: func(image_wcs, x, y), number=args.calls)
+        print("{:>24s} {:>16.1f}".format(name, 1e6 * elapsed / args.calls))
+
+    elapsed = timeit.timeit(lambda: wcs.Distortion.from_header(image_wcs.header), number=args.calls)
+    saved = image_wcs.distortion.to_dict()
+    loaded = timeit.timeit(lambda: wcs.Distortion.from_dict(saved), number=args.calls)
+    print("Distortion from header {:.1f} us, from saved values {:.1f} us".format(1e6 * elapsed / args.calls,
+                                                                               1e6 * loaded / args.calls))
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -3,11 +3,16 @@
 This source detection system uses sextactor and produces PSF based measurement values."""
 import argparse
 import logging
+import multiprocessing
 import os
 import subprocess
 import sys
+from multiprocessing.pool import ThreadPool
+from astropy.io import fits
+import metrics
 import storage
 import util
+import vospace
 
 task = 'build_cat'
 dependency = None
@@ -29,49 +34,16 @@ def run(expnum, ccd, version, prefix, dry_run, force):
             if dependency is not None and not storage.get_status(dependency, prefix, expnum, "p", ccd=ccd):
                 raise IOError("{} not yet run for {}".format(dependency, expnum))
 
-            observation = storage.Observation(expnum)
-            image = storage.Image(observation, ccd=ccd)
-            image.get()
-            image.flat_field.get()
-
-            # Build the PSF model input catalog
-            logging.info("Building PSF input catalog")
-            logging.info("Using config: {}".format(os.path.join(SEX_CONFIG, 'pre_psfex.sex')))
-            ldac_catalog = storage.Artifact(observation, ccd=ccd, ext=".ldac")
-            cmd = ['/usr/bin/sex', image.filename,
-                   '-c', os.path.join(SEX_CONFIG, 'pre_psfex.sex'),
-                   '-CATALOG_NAME', ldac_catalog.filename,
-                   '-WEIGHT_IMAGE', image.flat_field.filename,
-                   '-MAG_ZEROPOINT', str(image.zeropoint)]
-            logging.info(" ".join(cmd))
-            logging.info(subprocess.check_output(cmd, stderr=subprocess.STDOUT))
-
-            # Build the PSF model
-            cmd = ['psfex', ldac_catalog.filename,
-                   '-c', os.path.join(SEX_CONFIG, 'default.psfex')]
-            logging.info(" ".join(cmd))
-            logging.info(subprocess.check_output(cmd,
-                                                 stderr=subprocess.STDOUT))
-
-            # Build a source catalog using the PSF model.
-            fits_catalog = storage.Artifact(observation, ccd=ccd, ext=".cat.fits")
-            psf = storage.Artifact(observation, ccd=ccd, ext=".psf")
-            cmd = ['/usr/bin/sex',
-                   '-c', os.path.join(SEX_CONFIG, 'ml.sex'),
-                   '-WEIGHT_IMAGE', image.flat_field.filename,
-                   '-CATALOG_NAME', fits_catalog.filename,
-                   '-PSF_NAME', psf.filename,
-                   '-MAG_ZEROPOINT', str(image.zeropoint),
-                   image.filename]
-            logging.info(" ".join(cmd))
-            logging.info(subprocess.check_output(cmd, stderr=subprocess.STDOUT))
+            with metrics.timer('download'):
+                retrieve(expnum, ccd)
+            process(expnum, ccd)
 
             if dry_run:
                 return
 
             # transfer results to storage.
-            fits_catalog.put()
-            psf.put()
+            with metrics.timer('upload'):
+                store(expnum, ccd)
             logging.info(message)
 
         except Exception as e:
@@ -83,6 +55,244 @@ def run(expnum, ccd, version, prefix, dry_run, force):
     return
 
 
+def retrieve(expnum, ccd, directory=os.curdir):
+    """
+    Get the image and weight (flat field) of a CCD from VOSpace.
+
+    :param directory: local directory to retrieve the files into.
+    """
+    image = storage.Image(storage.Observation(expnum), ccd=ccd)
+    pairs = []
+    for artifact in [image, image.flat_field]:
+        filename = os.path.join(directory, artifact.filename)
+        if not os.access(filename, os.F_OK):
+            logging.info("Retrieving {} from VOSpace".format(artifact.uri))
+            pairs.append((artifact.uri, filename))
+    storage.copy_many(pairs)
+
+
+def retrieve_mef(expnum, ccds, directories=None):
+    """
+    Get the whole MEF image and weight (flat field) of an exposure with one transfer each and split out the CCDs.
+
+    Each CCD is written to the same file that retrieve would have copied from VOSpace, so process runs unchanged.
+    CCDs whose files are already present are not split again.
+
+    :param ccds: list of CCDs to split out of the MEF files.
+    :param directories: dict of the local directory to write each CCD into, default is the current directory.
+    :return: number of VOSpace transfers saved compared to retrieving each CCD on its own.
+    :rtype: int
+    """
+    if directories is None:
+        directories = dict([(ccd, os.curdir) for ccd in ccds])
+    observation = storage.Observation(expnum)
+
+    # CCDs are grouped on their flat field, normally all the CCDs of an exposure share one.
+    mefs = {}
+    ccds_split = set()
+    for ccd in ccds:
+        image = storage.Image(observation, ccd=ccd)
+        flat_field = storage.Image(storage.Observation(image.flat_field_name, dbimages=storage.FLATS_VOSPACE),
+                                   subdir="", ext=".fits", version="")
+        for mef, artifact in [(storage.Image(observation), image), (flat_field, image.flat_field)]:
+            if os.access(os.path.join(directories[ccd], artifact.filename), os.F_OK):
+                continue
+            mefs.setdefault(mef.uri, (mef, []))[1].append(artifact)
+            ccds_split.add(ccd)
+
+    transfers = 0
+    for mef, artifacts in mefs.values():
+        if not os.access(mef.filename, os.F_OK):
+            logging.info("Retrieving {} from VOSpace".format(mef.uri))
+            storage.copy(mef.uri, mef.filename)
+            transfers += 1
+        with fits.open(mef.filename, memmap=True) as hdulist:
+            for artifact in artifacts:
+                filename = os.path.join(directories[artifact.ccd], artifact.filename)
+                logging.debug("Extracting extension {} of {} to {}".format(artifact.ccd + 1, mef.filename, filename))
+                hdu = hdulist[artifact.ccd + 1]
+                fits.PrimaryHDU(data=hdu.data, header=hdu.header).writeto(filename)
+
+    # the image and flat field of each CCD would otherwise be a transfer each.
+    saved = 2 * len(ccds_split) - transfers
+    logging.info("Retrieved {} MEF files, saved {} VOSpace round trips".format(transfers, saved))
+    return saved
+
+
+def process(expnum, ccd):
+    """
+    Run sextractor/psfex/sextractor on the image of a CCD, in the current directory.
+    """
+    observation = storage.Observation(expnum)
+    image = storage.Image(observation, ccd=ccd)
+
+    # Build the PSF model input catalog
+    logging.info("Building PSF input catalog")
+    logging.info("Using config: {}".format(os.path.join(SEX_CONFIG, 'pre_psfex.sex')))
+    ldac_catalog = storage.Artifact(observation, ccd=ccd, ext=".ldac")
+    cmd = ['/usr/bin/sex', image.filename,
+           '-c', os.path.join(SEX_CONFIG, 'pre_psfex.sex'),
+           '-CATALOG_NAME', ldac_catalog.filename,
+           '-WEIGHT_IMAGE', image.flat_field.filename,
+           '-MAG_ZEROPOINT', str(image.zeropoint)]
+    logging.info(" ".join(cmd))
+    with metrics.timer('sextractor.psf_input'):
+        logging.info(metrics.check_output(cmd, stderr=subprocess.STDOUT))
+
+    # Build the PSF model
+    cmd = ['psfex', ldac_catalog.filename,
+           '-c', os.path.join(SEX_CONFIG, 'default.psfex')]
+    logging.info(" ".join(cmd))
+    with metrics.timer('psfex'):
+        logging.info(metrics.check_output(cmd,
+                                          stderr=subprocess.STDOUT))
+
+    # Build a source catalog using the PSF model.
+    fits_catalog = storage.Artifact(observation, ccd=ccd, ext=".cat.fits")
+    psf = storage.Artifact(observation, ccd=ccd, ext=".psf")
+    cmd = ['/usr/bin/sex',
+           '-c', os.path.join(SEX_CONFIG, 'ml.sex'),
+           '-WEIGHT_IMAGE', image.flat_field.filename,
+           '-CATALOG_NAME', fits_catalog.filename,
+           '-PSF_NAME', psf.filename,
+           '-MAG_ZEROPOINT', str(image.zeropoint),
+           image.filename]
+    logging.info(" ".join(cmd))
+    with metrics.timer('sextractor.catalog'):
+        logging.info(metrics.check_output(cmd, stderr=subprocess.STDOUT))
+
+
+def store(expnum, ccd, directory=os.curdir):
+    """
+    Put the source catalog and PSF of a CCD into VOSpace.
+
+    :param directory: local directory holding the files.
+    """
+    observation = storage.Observation(expnum)
+    pairs = []
+    for ext in [".cat.fits", ".psf"]:
+        artifact = storage.Artifact(observation, ccd=ccd, ext=ext)
+        logging.info("Copying {} to {}".format(artifact.filename, artifact.uri))
+        pairs.append((os.path.join(directory, artifact.filename), artifact.uri))
+    storage.make_paths([uri for filename, uri in pairs])
+    # both files are uploaded at once.
+    storage.copy_many(pairs)
+
+
+def _retrieve_task(expnum, ccd, directory):
+    """
+    Download stage of run_parallel, returns the (ccd, status message) of the retrieval.
+    """
+    try:
+        if not os.access(directory, os.F_OK):
+            os.makedirs(directory)
+        # share the MEF header retrieved by run_parallel rather than each CCD fetching its own copy.
+        header = storage.Header(storage.Observation(expnum))
+        if not os.access(os.path.join(directory, header.filename), os.F_OK):
+            os.symlink(os.path.abspath(header.filename), os.path.join(directory, header.filename))
+        with metrics.timer('download'):
+            retrieve(expnum, ccd, directory)
+    except Exception as ex:
+        logging.error("Failed to retrieve {} {}: {}".format(expnum, ccd, ex))
+        return ccd, str(ex)
+    return ccd, storage.SUCCESS
+
+
+def _process_task(expnum, ccd, version, prefix, dry_run, directory):
+    """
+    Processing stage of run_parallel, runs in a worker process inside the CCD working directory.
+    """
+    message = storage.SUCCESS
+    os.chdir(directory)
+    with storage.LoggingManager(task, prefix, expnum, ccd, version, dry_run):
+        try:
+            process(expnum, ccd)
+        except Exception as ex:
+            logging.error(str(ex))
+            message = str(ex)
+    return message
+
+
+def _store_task(expnum, ccd, directory):
+    """
+    Upload stage of run_parallel, returns the status message of the upload.
+    """
+    try:
+        with metrics.timer('upload'):
+            store(expnum, ccd, directory)
+    except Exception as ex:
+        logging.error("Failed to store {} {}: {}".format(expnum, ccd, ex))
+        return str(ex)
+    return storage.SUCCESS
+
+
+def run_parallel(expnum, ccds, version, prefix, dry_run, force, jobs, prefetch=2, mef=False):
+    """
+    Process the CCDs of an exposure through a pool of jobs worker processes, each CCD in its own directory.
+
+    Downloads are done by prefetch threads ahead of the workers and uploads by a background thread, so transfers
+    overlap with sextractor/psfex.  Status is not recorded here, the status message for each CCD is returned.
+
+    :param mef: retrieve the whole MEF image and flat field once, see retrieve_mef, rather than each CCD.
+
+    :return: status message of each CCD processed, keyed on ccd.
+    :rtype: dict
+    """
+    statuses = storage.get_statuses(task, prefix, expnum, version, ccds)
+    todo = []
+    for ccd in ccds:
+        if statuses[ccd] and not force:
+            logging.info("{} completed successfully for {} {} {} {}".format(task, prefix, expnum, version, ccd))
+        else:
+            todo.append(ccd)
+    messages = {}
+    if len(todo) == 0:
+        return messages
+
+    # retrieve the MEF header once, all the CCDs need it to find their flat field and zeropoint.
+    storage.Header(storage.Observation(expnum)).get()
+    directories = dict([(ccd, os.path.abspath("{}{}{:02d}".format(expnum, version, ccd))) for ccd in todo])
+    if mef:
+        for directory in directories.values():
+            if not os.access(directory, os.F_OK):
+                os.makedirs(directory)
+        try:
+            with metrics.timer('download'):
+                retrieve_mef(expnum, todo, directories)
+        except Exception as ex:
+            # the CCDs not split out of the MEF are retrieved on their own by _retrieve_task.
+            logging.error("Failed to retrieve MEF of {}: {}".format(expnum, ex))
+
+    # fork the worker processes before starting any threads.
+    process_pool = multiprocessing.Pool(jobs)
+    download_pool = ThreadPool(prefetch)
+    upload_pool = ThreadPool(1)
+    try:
+        processing = {}
+        for ccd, message in download_pool.imap_unordered(
+                lambda this_ccd: _retrieve_task(expnum, this_ccd, directories[this_ccd]), todo):
+            if message != storage.SUCCESS:
+                messages[ccd] = message
+                continue
+            processing[ccd] = process_pool.apply_async(_process_task,
+                                                       (expnum, ccd, version, prefix, dry_run, directories[ccd]))
+
+        uploads = {}
+        for ccd in processing:
+            messages[ccd] = processing[ccd].get()
+            if messages[ccd] == storage.SUCCESS and not dry_run:
+                uploads[ccd] = upload_pool.apply_async(_store_task, (expnum, ccd, directories[ccd]))
+
+        for ccd in uploads:
+            messages[ccd] = uploads[ccd].get()
+    finally:
+        for pool in [download_pool, process_pool, upload_pool]:
+            pool.close()
+            pool.join()
+
+    return messages
+
+
 def main():
 
     parser = argparse.ArgumentParser(
@@ -105,11 +315,19 @@ def main():
     parser.add_argument("--dry-run",
                         action="store_true",
                         help="DRY RUN, don't copy results to VOSpace, implies --force")
+    parser.add_argument("--jobs", "-j",
+                        type=int,
+                        default=1,
+                        help="number of CCDs to process in parallel, each in its own working directory")
+    parser.add_argument("--mef",
+                        action="store_true",
+                        help="retrieve the whole MEF image and flat field once and split the CCDs out locally")
 
     parser.add_argument("--verbose", "-v",
                         action="store_true")
     parser.add_argument("--force", default=False,
                         action="store_true")
+    vospace.add_trace_argument(parser)
     parser.add_argument("--debug", "-d",
                         action="store_true")
 
@@ -117,6 +335,9 @@ def main():
     args = parser.parse_args()
 
     util.set_logger(args)
+    metrics.start(task)
+    if args.trace_vos:
+        vospace.enable_tracing()
     logging.info("Started {}".format(cmd_line))
 
     prefix = ''
@@ -135,8 +356,24 @@ def main():
                 ccdlist = range(0, 40)
         else:
             ccdlist = [args.ccd]
-        for ccd in ccdlist:
-            run(expnum, ccd, version, prefix, args.dry_run, args.force)
+        with storage.buffered_tags():
+            if args.jobs > 1:
+                messages = run_parallel(expnum, ccdlist, version, prefix, args.dry_run, args.force, args.jobs,
+                                        mef=args.mef)
+                if not args.dry_run:
+                    for ccd in messages:
+                        storage.set_status(task, prefix, expnum, version, ccd, messages[ccd])
+                continue
+            if args.mef:
+                statuses = storage.get_statuses(task, prefix, expnum, version, ccdlist)
+                try:
+                    with metrics.timer('download'):
+                        retrieve_mef(expnum, [ccd for ccd in ccdlist if args.force or not statuses[ccd]])
+                except Exception as ex:
+                    # fall back to retrieving each CCD.
+                    logging.error("Failed to retrieve MEF of {}: {}".format(expnum, ex))
+            for ccd in ccdlist:
+                run(expnum, ccd, version, prefix, args.dry_run, args.force)
     return exit_code
 
 if __name__ == '__main__':
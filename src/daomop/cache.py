@@ -0,0 +1,383 @@
+"""A shared, size bounded, on-disk cache of artifacts retrieved from VOSpace.
+
+Entries are keyed on the VOSpace URI plus the MD5 and length of the node so a changed file is never served from
+the cache.  Entries are written to a temporary file in the cache and renamed into place, which is atomic, so many
+jobs can share one cache directory.  The least recently used entries are evicted once the cache exceeds its size,
+which each process tracks from the entries it adds and only measures again, by walking the cache, to evict.
+
+The cache is enabled by setting DAOMOP_CACHE_DIR, DAOMOP_CACHE_MAX_BYTES sets the size limit.
+
+The QueryCache holds the tables returned by TAP queries, as FITS files keyed on the normalized query text and
+result format, for DAOMOP_QUERY_CACHE_TTL seconds in DAOMOP_QUERY_CACHE_DIR.  It is enabled by setting either, as
+a cached result can be up to the TTL out of date.
+
+The DirectoryCache, known_directories, remembers the VOSpace directories this process has seen exist, so the paths
+of uploads are only probed and created once."""
+import errno
+import hashlib
+import json
+import logging
+import os
+import re
+import shutil
+import tempfile
+import threading
+import time
+
+from astropy.table import Table
+
+CACHE_DIR_ENV = 'DAOMOP_CACHE_DIR'
+CACHE_MAX_BYTES_ENV = 'DAOMOP_CACHE_MAX_BYTES'
+DEFAULT_MAX_BYTES = 20 * 1024 ** 3
+QUERY_CACHE_DIR_ENV = 'DAOMOP_QUERY_CACHE_DIR'
+QUERY_CACHE_TTL_ENV = 'DAOMOP_QUERY_CACHE_TTL'
+DEFAULT_QUERY_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.daomop', 'tap_cache')
+# the TTL used when only DAOMOP_QUERY_CACHE_DIR is set.
+DEFAULT_QUERY_CACHE_TTL = 3600
+_QUOTED = re.compile(r"('(?:[^']|'')*')")
+
+
+class ArtifactCache(object):
+    """
+    Content addressed local cache of VOSpace artifacts.
+    """
+
+    def __init__(self, directory, max_bytes=None):
+        if max_bytes is None:
+            max_bytes = DEFAULT_MAX_BYTES
+        self.directory = directory
+        self.max_bytes = int(max_bytes)
+        self.hits = 0
+        self.misses = 0
+        self.bytes_saved = 0
+        self.bytes_fetched = 0
+        # bytes in the cache, measured on first use then added to as entries are written, see evict.
+        self._size = None
+        self._lock = threading.Lock()
+        if not os.access(self.directory, os.F_OK):
+            try:
+                os.makedirs(self.directory)
+            except OSError as ex:
+                # another job may have created it.
+                if ex.errno != errno.EEXIST:
+                    raise ex
+
+    @classmethod
+    def from_environment(cls):
+        """
+        Build the cache described by the DAOMOP_CACHE_DIR and DAOMOP_CACHE_MAX_BYTES environment variables.
+
+        :return: the cache or None if DAOMOP_CACHE_DIR is not set.
+        :rtype: ArtifactCache
+        """
+        directory = os.environ.get(CACHE_DIR_ENV, None)
+        if directory is None or len(directory) == 0:
+            return None
+        return cls(directory, os.environ.get(CACHE_MAX_BYTES_ENV, None))
+
+    @staticmethod
+    def key(uri, md5, length):
+        """
+        The cache key of a given version of the artifact at uri.
+        """
+        return hashlib.sha1("{} {} {}".format(uri, md5, length)).hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.directory, key[0:2], key)
+
+    def get(self, uri, destination, md5, length, fetch):
+        """
+        Copy the artifact at uri to destination, from the cache if possible otherwise using fetch.
+
+        :param uri: URI of the artifact
+        :param destination: local file to copy the artifact to.
+        :param md5: MD5 of the artifact, as reported by the VOSpace node.
+        :param length: size of the artifact, as reported by the VOSpace node.
+        :param fetch: function(uri, filename) that retrieves the artifact when it is not in the cache.
+        :return: size of the file at destination.
+        """
+        cached = self.path(self.key(uri, md5, length))
+        if os.access(cached, os.R_OK):
+            try:
+                # touch the entry so that it is the most recently used.
+                os.utime(cached, None)
+                shutil.copyfile(cached, destination)
+                size = os.stat(destination).st_size
+                self.hits += 1
+                self.bytes_saved += size
+                logging.debug("Retrieved {} from cache {}".format(uri, cached))
+                return size
+            except (IOError, OSError) as ex:
+                # entry was evicted by another job between the check and the copy.
+                logging.debug("Cache entry {} went away: {}".format(cached, ex))
+
+        self.misses += 1
+        dirname = os.path.dirname(cached)
+        if not os.access(dirname, os.F_OK):
+            try:
+                os.makedirs(dirname)
+            except OSError as ex:
+                if ex.errno != errno.EEXIST:
+                    raise ex
+        fd, partial = tempfile.mkstemp(dir=dirname, prefix='.partial-')
+        os.close(fd)
+        try:
+            fetch(uri, partial)
+            os.rename(partial, cached)
+        finally:
+            if os.access(partial, os.F_OK):
+                os.unlink(partial)
+        shutil.copyfile(cached, destination)
+        size = os.stat(destination).st_size
+        self.bytes_fetched += size
+        with self._lock:
+            if self._size is None:
+                self._size = sum([entry[1] for entry in self.entries()])
+            else:
+                self._size += size
+            full = self._size > self.max_bytes
+        if full:
+            self.evict()
+        return size
+
+    def entries(self):
+        """
+        List the (mtime, size, path) of each entry in the cache.
+        """
+        entries = []
+        for dirpath, dirnames, filenames in os.walk(self.directory):
+            for filename in filenames:
+                if filename.startswith('.partial-'):
+                    continue
+                path = os.path.join(dirpath, filename)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, path))
+        return entries
+
+    def evict(self):
+        """
+        Remove the least recently used entries until the cache is below max_bytes.
+
+        The cache is walked to find the entries, and their total size, which includes those added by other jobs.
+        """
+        entries = sorted(self.entries())
+        total = sum([entry[1] for entry in entries])
+        for mtime, size, path in entries:
+            if total <= self.max_bytes:
+                break
+            try:
+                os.unlink(path)
+                logging.debug("Evicted {} from cache".format(path))
+            except OSError as ex:
+                if ex.errno != errno.ENOENT:
+                    raise ex
+            total -= size
+        with self._lock:
+            self._size = total
+
+    @property
+    def stats(self):
+        return {'hits': self.hits,
+                'misses': self.misses,
+                'bytes_saved': self.bytes_saved,
+                'bytes_fetched': self.bytes_fetched}
+
+    def __str__(self):
+        return "cache {}: {hits} hits, {misses} misses, {bytes_saved} bytes saved, " \
+               "{bytes_fetched} bytes fetched".format(self.directory, **self.stats)
+
+
+def normalize_query(query):
+    """
+    Normalize the white space of an ADQL query so that trivially different versions of a query share a cache entry.
+
+    Runs of white space are collapsed and removed around punctuation, quoted literals are left alone.
+    """
+    parts = _QUOTED.split(query)
+    for idx in range(0, len(parts), 2):
+        text = re.sub(r'\s+', ' ', parts[idx])
+        parts[idx] = re.sub(r' ?([,()=<>]) ?', r'\1', text)
+    return "".join(parts).strip()
+
+
+class QueryCache(object):
+    """
+    Time limited on-disk cache of query result tables.
+    """
+
+    def __init__(self, directory, ttl=DEFAULT_QUERY_CACHE_TTL):
+        self.directory = directory
+        self.ttl = float(ttl)
+        self.hits = 0
+        self.misses = 0
+        if not os.access(self.directory, os.F_OK):
+            try:
+                os.makedirs(self.directory)
+            except OSError as ex:
+                if ex.errno != errno.EEXIST:
+                    raise ex
+
+    @classmethod
+    def from_environment(cls):
+        """
+        Build the cache described by the DAOMOP_QUERY_CACHE_DIR and DAOMOP_QUERY_CACHE_TTL environment variables.
+
+        :return: the cache or None if neither is set, or the TTL is 0.
+        :rtype: QueryCache
+        """
+        if QUERY_CACHE_TTL_ENV not in os.environ and QUERY_CACHE_DIR_ENV not in os.environ:
+            return None
+        ttl = float(os.environ.get(QUERY_CACHE_TTL_ENV, DEFAULT_QUERY_CACHE_TTL))
+        if ttl <= 0:
+            return None
+        return cls(os.environ.get(QUERY_CACHE_DIR_ENV, DEFAULT_QUERY_CACHE_DIR), ttl)
+
+    @staticmethod
+    def key(query, fmt):
+        return hashlib.sha1("{}\n{}".format(normalize_query(query), fmt).encode('utf-8')).hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.directory, key + ".fits")
+
+    def get(self, query, fmt, fetch, refresh=False):
+        """
+        The result of query, from the cache if it holds a result younger than the TTL otherwise using fetch.
+
+        :param query: the ADQL query
+        :param fmt: the format the result is requested in, part of the cache key.
+        :param fetch: function(query) that runs the query and returns an astropy Table.
+        :param refresh: run the query even if the result is cached.
+        :rtype: Table
+        """
+        key = self.key(query, fmt)
+        filename = self.path(key)
+        if not refresh:
+            try:
+                if time.time() - os.stat(filename).st_mtime < self.ttl:
+                    table = Table.read(filename)
+                    self.hits += 1
+                    logging.debug("Query result from cache {}".format(filename))
+                    return table
+            except (IOError, OSError) as ex:
+                logging.debug("No cached result for query {}: {}".format(key, ex))
+            except Exception as ex:
+                logging.warning("Ignoring unreadable query cache entry {}: {}".format(filename, ex))
+
+        self.misses += 1
+        table = fetch(query)
+        fd, partial = tempfile.mkstemp(dir=self.directory, prefix='.partial-', suffix='.fits')
+        os.close(fd)
+        try:
+            table.write(partial, format='fits', overwrite=True)
+            with open(os.path.join(self.directory, key + ".json"), 'w') as fobj:
+                json.dump({'query': normalize_query(query), 'format': fmt}, fobj)
+            os.rename(partial, filename)
+        except Exception as ex:
+            logging.warning("Failed to cache query result: {}".format(ex))
+        finally:
+            if os.access(partial, os.F_OK):
+                os.unlink(partial)
+        return table
+
+    def invalidate(self, query=None, fmt=None, pattern=None):
+        """
+        Remove cached results.
+
+        :param query: remove the result of this query, in format fmt.
+        :param pattern: remove the results of all queries containing this text.
+        :return: number of entries removed.
+        """
+        if query is not None:
+            keys = [self.key(query, fmt)]
+        else:
+            keys = [name[:-len(".json")] for name in os.listdir(self.directory) if name.endswith(".json")]
+            if pattern is not None:
+                keys = [key for key in keys
+                        if pattern in json.load(open(os.path.join(self.directory, key + ".json")))['query']]
+        count = 0
+        for key in keys:
+            for filename in [self.path(key), os.path.join(self.directory, key + ".json")]:
+                try:
+                    os.unlink(filename)
+                    count += filename.endswith(".fits")
+                except OSError as ex:
+                    if ex.errno != errno.ENOENT:
+                        raise ex
+        return count
+
+
+class DirectoryCache(object):
+    """
+    The VOSpace directories known to exist, learnt from successful probes, creates and listings.
+    """
+
+    def __init__(self):
+        self._known = set()
+        self._lock = threading.Lock()
+        self.probes = 0
+
+    def __contains__(self, dirname):
+        with self._lock:
+            return dirname in self._known
+
+    def add(self, dirname):
+        """
+        Record that dirname exists, which means its parents do too.
+        """
+        with self._lock:
+            while len(dirname) > 0 and dirname not in self._known:
+                self._known.add(dirname)
+                dirname = os.path.dirname(dirname)
+
+    def discard(self, dirname):
+        """
+        Forget dirname and everything below it, eg. after it is deleted.
+        """
+        with self._lock:
+            self._known = set([known for known in self._known
+                               if known != dirname and not known.startswith(dirname + "/")])
+
+    def clear(self):
+        with self._lock:
+            self._known = set()
+
+    def ensure(self, dirnames, isdir, mkdir):
+        """
+        Make sure each of dirnames exists, creating any missing directories, and their missing parents, in one pass.
+
+        Directories already known to exist are not probed and each missing parent is created once, parents first.
+
+        :param dirnames: list of directories that should exist.
+        :param isdir: function(dirname) that returns True if the directory exists, eg. vos.Client.isdir.
+        :param mkdir: function(dirname) that creates a directory, eg. vos.Client.mkdir.
+        :return: list of the directories created.
+        """
+        missing = set()
+        for dirname in set(dirnames):
+            while len(dirname) > 0 and dirname not in missing and dirname not in self:
+                self.probes += 1
+                if isdir(dirname):
+                    self.add(dirname)
+                    break
+                logging.debug("Queuing {} for mkdir.".format(dirname))
+                missing.add(dirname)
+                dirname = os.path.dirname(dirname)
+
+        created = []
+        for dirname in sorted(missing, key=len):
+            logging.info("Creating directory: {}".format(dirname))
+            try:
+                mkdir(dirname)
+                created.append(dirname)
+            except EnvironmentError as ex:
+                # another job may have created it.
+                if ex.errno != errno.EEXIST:
+                    raise ex
+            self.add(dirname)
+        return created
+
+
+known_directories = DirectoryCache()
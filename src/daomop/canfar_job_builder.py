@@ -0,0 +1,329 @@
+"""Build a Condor submission for CANFAR that packs many pipeline work items into each job.
+
+A work item is an exposure for build_cat (populate then build_cat) or a healpix for stationary.  The status tags
+of all the items are looked up in bulk and finished items are left out.  The rest are packed into jobs that each
+take about --budget seconds, using the TIMING lines that the jobs of earlier submissions wrote to their output.
+The items of each job are listed in a JSON manifest, and --resubmit packs the unfinished items of a manifest into
+a new submission.
+"""
+import argparse
+import glob
+import json
+import logging
+import os
+import pipes
+import stat
+import sys
+import time
+
+import numpy
+
+import scheduler
+import storage
+import util
+
+COMMAND_FILENAME = "daomop_job.sh"
+JOB_FILENAME = "job.in"
+MANIFEST_FILENAME = "manifest.json"
+TASKS = ['build_cat', 'stationary']
+DEFAULT_BUDGET = 4 * 3600
+# seconds an item is expected to take when no item of its task has been timed.
+DEFAULT_ESTIMATES = {'build_cat': 1200.0, 'stationary': 1800.0}
+
+
+def _create_shell_script(filename, catalogs, dbimages, footprint_index=None, refresh=False):
+    """
+    Create the shell script that runs the work items of a job, given as task:item arguments, one after the other.
+
+    The time taken by each item is written to the job output as: TIMING task item seconds exit_code
+
+    :param filename:  name of file to contain the processing shell script.
+    :param catalogs: dbimages subdirectory holding the healpix catalogs.
+    :param dbimages: vospace dbimages containerNode the tasks work in.
+    :param footprint_index: name of the footprint index transferred with the job, for stationary.
+    :param refresh: stationary re-runs TAP queries rather than using the query cache.
+    """
+    options = "--dbimages {}".format(pipes.quote(dbimages))
+    stationary_options = "{} --catalogs {}".format(options, pipes.quote(catalogs))
+    if footprint_index is not None:
+        stationary_options += " --footprint-index {}".format(pipes.quote(footprint_index))
+    if refresh:
+        stationary_options += " --refresh"
+    with open(filename, 'w') as fout:
+        fout.write("""#!/bin/bash -i
+export HOME=`cd ~ ; pwd`
+source activate ossos
+getCert
+
+status=0
+for work in "$@"; do
+    task=${{work%%:*}}
+    item=${{work#*:}}
+    echo "Processing ${{task}} ${{item}}"
+    start=`date +%s`
+    case ${{task}} in
+        build_cat) populate ${{item}} --verbose {options} && build_cat ${{item}} --verbose {options} ;;
+        stationary) stationary ${{item}} --verbose {stationary_options} ;;
+        *) false ;;
+    esac
+    code=$?
+    echo "TIMING ${{task}} ${{item}} $((`date +%s` - start)) ${{code}}"
+    if [ ${{code}} -ne 0 ]; then
+        status=${{code}}
+    fi
+done
+exit ${{status}}
+""".format(options=options, stationary_options=stationary_options))
+
+    os.chmod(filename, stat.S_IXGRP | stat.S_IRWXU | stat.S_IXOTH | stat.S_IROTH | stat.S_IRGRP)
+
+
+def _create_job_file_header(command_filename, input_files=()):
+    """
+    Create the header of the Condor job.in file.
+    :param command_filename: Name of the executable script that will be run.
+    :param input_files: local files to transfer to the node running the job.
+    :return:
+    """
+    header = """Universe   = vanilla
+should_transfer_files = YES
+when_to_transfer_output = ON_EXIT_OR_EVICT
+RunAsOwner = True
+transfer_output_files = /dev/null
+"""
+    if len(input_files) > 0:
+        header += "transfer_input_files = {}\n".format(",".join(input_files))
+    return header + """
+Executable = {}
+
+""".format(command_filename)
+
+
+def read_timings(filenames):
+    """
+    Collect the TIMING lines that the job script wrote to the output of earlier jobs.
+
+    :param filenames: list of job output files.
+    :return: seconds taken by each (task, item) that succeeded, the last run of an item wins.
+    :rtype: dict
+    """
+    timings = {}
+    for filename in filenames:
+        with open(filename) as fobj:
+            for line in fobj:
+                fields = line.split()
+                if len(fields) != 5 or fields[0] != 'TIMING' or fields[4] != '0':
+                    continue
+                timings[(fields[1], fields[2])] = float(fields[3])
+    return timings
+
+
+def estimate(items, timings):
+    """
+    The expected run time of each item: the time it took before, else the median time of its task, else the
+    default of its task.
+
+    :param items: list of (task, item)
+    :param timings: dict of seconds taken keyed on (task, item), see read_timings.
+    :return: list of seconds
+    """
+    medians = {}
+    for task in set([task for task, item in items]):
+        seconds = [timings[key] for key in timings if key[0] == task]
+        if len(seconds) > 0:
+            medians[task] = float(numpy.median(seconds))
+        else:
+            medians[task] = DEFAULT_ESTIMATES.get(task, 3600.0)
+    return [timings.get((task, str(item)), medians[task]) for task, item in items]
+
+
+def pack(estimates, budget, max_items=None):
+    """
+    Pack items into as few jobs as possible, each expected to take at most budget seconds.
+
+    First fit decreasing: the longest items are placed first, each into the first job with room for it.  An item
+    longer than the budget gets a job of its own.
+
+    :param estimates: list of the expected seconds of each item.
+    :param budget: wall-clock seconds of a job.
+    :param max_items: most items to put in one job.
+    :return: list of jobs, each a list of indexes into estimates.
+    """
+    jobs = []
+    loads = []
+    for idx in sorted(range(len(estimates)), key=lambda idx: -estimates[idx]):
+        for count, job in enumerate(jobs):
+            if loads[count] + estimates[idx] <= budget and (max_items is None or len(job) < max_items):
+                job.append(idx)
+                loads[count] += estimates[idx]
+                break
+        else:
+            jobs.append([idx])
+            loads.append(estimates[idx])
+    return jobs
+
+
+def unfinished(items, workers=scheduler.DEFAULT_WORKERS):
+    """
+    The items that have not finished, from one look up of the status tags of each exposure involved.
+
+    An exposure has finished when build_cat has run on all its CCDs, a healpix when stationary has run on all the
+    CCDs that overlap it.
+
+    :param items: list of (task, item)
+    :return: list of (task, item)
+    """
+    graph = scheduler.Graph()
+    nodes = {}
+    for task, item in items:
+        if task in scheduler.HEALPIX_TASKS:
+            nodes[(task, item)] = graph.add_healpix(item, storage.healpix_overlaps(int(item), runids=storage.RUNIDS),
+                                                    task=task).nodes
+        else:
+            nodes[(task, item)] = [graph.node(item, ccd, task) for ccd in storage.Observation(str(item)).ccd_list]
+    graph.load_statuses(workers)
+    return [key for key in items if not all([node.finished for node in nodes[key]])]
+
+
+def write_submission(items, estimates, jobs, budget, catalogs, directory=os.curdir, dbimages=None,
+                     footprint_index=None, refresh=False):
+    """
+    Write the job script, the Condor job.in with one Queue per job and the manifest of the items of each job.
+
+    :param items: list of (task, item)
+    :param estimates: list of the expected seconds of each item.
+    :param jobs: list of lists of indexes into items, see pack.
+    :param dbimages: vospace dbimages containerNode, default storage.DBIMAGES
+    :param footprint_index: local footprint index, transferred with each job for stationary to use.
+    :param refresh: stationary re-runs TAP queries rather than using the query cache.
+    :return: the manifest
+    :rtype: dict
+    """
+    if dbimages is None:
+        dbimages = storage.DBIMAGES
+    input_files = []
+    if footprint_index is not None:
+        input_files.append(os.path.abspath(footprint_index))
+        footprint_index = os.path.basename(footprint_index)
+    _create_shell_script(os.path.join(directory, COMMAND_FILENAME), catalogs, dbimages,
+                         footprint_index=footprint_index, refresh=refresh)
+    now = time.gmtime()
+    manifest = {'created': time.strftime("%Y-%m-%dT%H:%M:%S", now),
+                'budget': budget,
+                'dbimages': dbimages,
+                'catalogs': catalogs,
+                'jobs': []}
+    with open(os.path.join(directory, JOB_FILENAME), 'w') as job_file:
+        job_file.write(_create_job_file_header(COMMAND_FILENAME, input_files))
+        for count, job in enumerate(jobs):
+            # the outputs of earlier submissions are kept, they hold the timings the next submission is sized with.
+            name = "daomop_{}_{:05d}".format(time.strftime("%Y%m%dT%H%M%S", now), count)
+            params = [("Arguments", " ".join(["{}:{}".format(*items[idx]) for idx in job])),
+                      ("Log", "{}.log".format(name)),
+                      ("Output", "{}.out".format(name)),
+                      ("Error", "{}.err".format(name))]
+            for param in params:
+                job_file.write("{} = {}\n".format(*param))
+            job_file.write("Queue\n\n")
+            manifest['jobs'].append({'name': name,
+                                     'estimate': sum([estimates[idx] for idx in job]),
+                                     'items': [list(items[idx]) for idx in job]})
+    with open(os.path.join(directory, MANIFEST_FILENAME), 'w') as fobj:
+        json.dump(manifest, fobj, indent=1)
+    return manifest
+
+
+def main():
+    """Build a Condor submission that packs the unfinished work items into jobs of about --budget seconds."""
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("items",
+                        nargs='*',
+                        help="expnum(s) for build_cat, healpix for stationary, default is all of them")
+    parser.add_argument("--task",
+                        choices=TASKS,
+                        default='build_cat',
+                        help="pipeline step the items are for")
+    parser.add_argument("--item-file",
+                        action="store",
+                        default=None,
+                        help="file with one item per line")
+    parser.add_argument("--exclude",
+                        action="store",
+                        default=None,
+                        help="file of items, one per line as the first word, not to submit, eg. tkBAD")
+    parser.add_argument("--resubmit",
+                        action="store",
+                        default=None,
+                        help="manifest of an earlier submission, submit those of its items that have not finished")
+    parser.add_argument("--budget",
+                        type=float,
+                        default=DEFAULT_BUDGET,
+                        help="wall-clock seconds each job should take")
+    parser.add_argument("--max-items",
+                        type=int,
+                        default=None,
+                        help="most work items in one job")
+    parser.add_argument("--timings",
+                        nargs='*',
+                        default=None,
+                        help="output files of earlier jobs holding TIMING lines, default is *.out")
+    parser.add_argument("--workers",
+                        type=int,
+                        default=scheduler.DEFAULT_WORKERS,
+                        help="number of concurrent status look ups")
+    parser.add_argument("--dbimages",
+                        action="store",
+                        default="vos:cfis/solar_system/dbimages",
+                        help='vospace dbimages containerNode')
+    parser.add_argument("--catalogs",
+                        action="store",
+                        default="catalogs",
+                        help='dbimages subdirectory where the healpix catalogs are stored.')
+    parser.add_argument("--footprint-index",
+                        action="store",
+                        default=storage.FOOTPRINT_INDEX,
+                        help="local footprint index (SQLite) used to find the CCDs of each healpix")
+    parser.add_argument("--refresh",
+                        action="store_true",
+                        help="re-run TAP queries even if their results are in the query cache")
+    parser.add_argument("--verbose", "-v",
+                        action="store_true")
+    parser.add_argument("--debug", "-d",
+                        action="store_true")
+    args = parser.parse_args()
+
+    util.set_logger(args)
+    storage.DBIMAGES = args.dbimages
+    storage.CATALOG = args.catalogs
+    storage.FOOTPRINT_INDEX = args.footprint_index
+    storage.REFRESH_QUERIES = args.refresh
+
+    if args.resubmit is not None:
+        items = [tuple(item) for job in json.load(open(args.resubmit))['jobs'] for item in job['items']]
+    else:
+        names = list(args.items)
+        if args.item_file is not None:
+            names.extend([line.strip() for line in open(args.item_file) if len(line.strip()) > 0])
+        if len(names) == 0 and args.task == 'build_cat':
+            names = storage.list_exposures()['expnum']
+        elif len(names) == 0:
+            names = storage.list_healpix()
+        items = [(args.task, str(name)) for name in names]
+    if args.exclude is not None:
+        excluded = set([line.split()[0] for line in open(args.exclude) if len(line.split()) > 0])
+        items = [item for item in items if item[1] not in excluded]
+
+    logging.info("Checking the status of {} items".format(len(items)))
+    items = unfinished(items, workers=args.workers)
+    timings = read_timings(args.timings is None and glob.glob("*.out") or args.timings)
+    estimates = estimate(items, timings)
+    jobs = pack(estimates, args.budget, max_items=args.max_items)
+    write_submission(items, estimates, jobs, args.budget, args.catalogs, dbimages=args.dbimages,
+                     footprint_index=args.footprint_index, refresh=args.refresh)
+    logging.info("Packed {} unfinished items into {} jobs, {:.1f} hours of work".format(
+        len(items), len(jobs), sum(estimates) / 3600.0))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
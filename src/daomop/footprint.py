@@ -0,0 +1,411 @@
+"""A local, on-disk, index of the per-CCD footprints of CFHT exposures.
+
+The index is an SQLite table of expnum, ccd, MJD, runid and the RA/DEC corners of each CCD, built from the MEF
+.head files.  Once populated cone and overlap searches are answered locally and only exposures that are new to the
+index need their headers retrieved.
+
+The index also holds the healpix touched by each CCD, an inverted index from healpix to the CCDs that overlap it, see
+FootprintIndex.healpix_search.
+
+Searches only return the exposures the archive lists for a TAP cone search, CFHT r-band at calibration level 1,
+see add_archive, and those indexed from .head files, see fill_from_directory.  Each healpix whose archive listing is in the index is recorded with the modification time the
+listing is complete to, see storage.sync_footprint_index."""
+import argparse
+import json
+import logging
+import os
+import sqlite3
+import sys
+
+import Polygon
+import numpy
+
+import util
+from wcs import WCS
+
+FOOTPRINT_INDEX_ENV = 'DAOMOP_FOOTPRINT_INDEX'
+DEFAULT_FOOTPRINT_INDEX = os.path.join(os.path.expanduser('~'), '.daomop', 'footprints.sqlite')
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS exposures (
+    expnum TEXT PRIMARY KEY,
+    runid TEXT,
+    mjdate REAL,
+    mjdend REAL
+);
+CREATE TABLE IF NOT EXISTS footprints (
+    expnum TEXT,
+    ccd INTEGER,
+    ra REAL,
+    dec REAL,
+    radius REAL,
+    dec_min REAL,
+    dec_max REAL,
+    corners TEXT,
+    PRIMARY KEY (expnum, ccd)
+);
+CREATE INDEX IF NOT EXISTS footprints_dec ON footprints (dec_min, dec_max);
+CREATE TABLE IF NOT EXISTS healpix (
+    nside INTEGER,
+    healpix INTEGER,
+    expnum TEXT,
+    ccd INTEGER,
+    PRIMARY KEY (nside, healpix, expnum, ccd)
+);
+CREATE INDEX IF NOT EXISTS healpix_expnum ON healpix (expnum);
+CREATE TABLE IF NOT EXISTS healpix_levels (
+    nside INTEGER,
+    expnum TEXT,
+    PRIMARY KEY (nside, expnum)
+);
+CREATE TABLE IF NOT EXISTS archive (
+    expnum TEXT PRIMARY KEY
+);
+CREATE TABLE IF NOT EXISTS synced (
+    nside INTEGER,
+    healpix INTEGER,
+    modified TEXT,
+    PRIMARY KEY (nside, healpix)
+);
+"""
+
+
+def ccd_footprint(header):
+    """
+    Compute the RA/DEC corners of the DATASEC region of a CCD, as done by storage.Image.footprint.
+
+    :param header: the header of the CCD extension.
+    :return: array of the four (ra, dec) corners in degrees.
+    :rtype: numpy.ndarray
+    """
+    datasec = util.get_pixel_bounds_from_datasec_keyword(header['DATASEC'])
+    corners = numpy.array([[datasec[0][0], datasec[1][0]],
+                           [datasec[0][0], datasec[1][1]],
+                           [datasec[0][1], datasec[1][1]],
+                           [datasec[0][1], datasec[1][0]]], dtype=numpy.float64)
+    return WCS(header).wcs_pix2world(corners, 1)
+
+
+def _unwrap(ra, reference):
+    """Shift ra values to be within 180 degrees of reference."""
+    return reference + (numpy.asarray(ra) - reference + 180.0) % 360.0 - 180.0
+
+
+def _separation(ra1, dec1, ra2, dec2):
+    """Angular separation, in degrees, between positions given in degrees."""
+    ra1, dec1, ra2, dec2 = [numpy.radians(x) for x in (ra1, dec1, ra2, dec2)]
+    sin_ddec = numpy.sin((dec2 - dec1) / 2.0)
+    sin_dra = numpy.sin((ra2 - ra1) / 2.0)
+    return numpy.degrees(2 * numpy.arcsin(numpy.sqrt(sin_ddec ** 2 +
+                                                     numpy.cos(dec1) * numpy.cos(dec2) * sin_dra ** 2)))
+
+
+def _bounding_circle(corners):
+    """
+    Centre and radius, in degrees, of a circle containing the given corners.
+    """
+    ra = _unwrap(corners[:, 0], corners[0][0])
+    ra_centre = ra.mean() % 360.0
+    dec_centre = corners[:, 1].mean()
+    radius = _separation(ra_centre, dec_centre, corners[:, 0], corners[:, 1]).max()
+    return ra_centre, dec_centre, radius
+
+
+class FootprintIndex(object):
+    """
+    SQLite backed index of CCD footprints.
+    """
+
+    def __init__(self, filename=None):
+        if filename is None:
+            filename = os.environ.get(FOOTPRINT_INDEX_ENV, DEFAULT_FOOTPRINT_INDEX)
+        self.filename = filename
+        self._connection = None
+
+    @property
+    def connection(self):
+        """
+        :rtype: sqlite3.Connection
+        """
+        if self._connection is None:
+            dirname = os.path.dirname(self.filename)
+            if len(dirname) > 0 and not os.access(dirname, os.F_OK):
+                os.makedirs(dirname)
+            self._connection = sqlite3.connect(self.filename)
+            self._connection.executescript(_SCHEMA)
+        return self._connection
+
+    def close(self):
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
+
+    @property
+    def exposures(self):
+        """
+        The set of exposure numbers already in the index.
+        :rtype: set
+        """
+        return set([str(row[0]) for row in self.connection.execute("SELECT expnum FROM exposures")])
+
+    def has_exposure(self, expnum):
+        cursor = self.connection.execute("SELECT 1 FROM exposures WHERE expnum = ?", (str(expnum),))
+        return cursor.fetchone() is not None
+
+    def add_archive(self, expnums):
+        """
+        Record exposures the archive lists as matching the cone search, only these are returned by searches.
+        """
+        with self.connection:
+            self.connection.executemany("INSERT OR IGNORE INTO archive VALUES (?)",
+                                        [(str(expnum),) for expnum in expnums])
+
+    def synced_since(self, pixels, nside):
+        """
+        The modification time up to which the archive listing of all the healpix is in the index.
+
+        :param pixels: RING ordered healpix
+        :return: ISO time, or None if any of the healpix has not been synced.
+        """
+        modified = []
+        for pixel in pixels:
+            row = self.connection.execute("SELECT modified FROM synced WHERE nside = ? AND healpix = ?",
+                                          (nside, int(pixel))).fetchone()
+            if row is None:
+                return None
+            modified.append(row[0])
+        return len(modified) > 0 and min(modified) or None
+
+    def mark_synced(self, pixels, nside, modified):
+        """
+        Record that the archive listing of the healpix, up to the modification time, is in the index.
+        """
+        with self.connection:
+            self.connection.executemany("INSERT OR REPLACE INTO synced VALUES (?, ?, ?)",
+                                        [(nside, int(pixel), modified) for pixel in pixels])
+
+    def add_headers(self, expnum, headers):
+        """
+        Add (or replace) the footprints of an exposure given the list of headers of its MEF.
+
+        :param expnum: the exposure number
+        :param headers: list of headers, as returned by storage.Header.headers
+        :return: number of CCDs indexed, an exposure with none is not recorded so it is tried again.
+        """
+        expnum = str(expnum)
+        rows = []
+        runid = mjdate = mjdend = None
+        for header in headers:
+            if header.get('EXTVER', None) is None:
+                continue
+            try:
+                corners = ccd_footprint(header)
+            except Exception as ex:
+                logging.debug("Failed to compute footprint of {} extension {}: {}".format(expnum,
+                                                                                       header.get('EXTVER'),
+                                                                                       ex))
+                continue
+            ra, dec, radius = _bounding_circle(corners)
+            rows.append((expnum, int(header['EXTVER']), ra, dec, radius,
+                         corners[:, 1].min(), corners[:, 1].max(), json.dumps(corners.tolist())))
+            if mjdate is None and header.get('MJDATE', None) is not None:
+                runid = header.get('RUNID', None)
+                mjdate = float(header['MJDATE'])
+                mjdend = mjdate + float(header.get('EXPTIME', 0)) / 24.0 / 3600.0
+
+        if len(rows) == 0:
+            logging.warning("No CCD footprints in the headers of {}, not indexed".format(expnum))
+            return 0
+        with self.connection:
+            self.connection.execute("DELETE FROM footprints WHERE expnum = ?", (expnum,))
+            self.connection.execute("DELETE FROM healpix WHERE expnum = ?", (expnum,))
+            self.connection.execute("DELETE FROM healpix_levels WHERE expnum = ?", (expnum,))
+            self.connection.executemany("INSERT INTO footprints VALUES (?, ?, ?, ?, ?, ?, ?, ?)", rows)
+            self.connection.execute("INSERT OR REPLACE INTO exposures VALUES (?, ?, ?, ?)",
+                                    (expnum, runid, mjdate, mjdend))
+            self._add_healpix([(row[0], row[1], json.loads(row[7])) for row in rows], [expnum], util.HEALPIX_NSIDE)
+        logging.debug("Indexed {} CCDs of {}".format(len(rows), expnum))
+        return len(rows)
+
+    def _add_healpix(self, footprints, expnums, nside):
+        """
+        Record the healpix touched by each (expnum, ccd, corners) footprint, the caller commits.
+        """
+        pixels = util.footprints_to_healpix([corners for expnum, ccd, corners in footprints], nside)
+        self.connection.executemany("INSERT OR REPLACE INTO healpix VALUES (?, ?, ?, ?)",
+                                    [(nside, int(pixel), expnum, ccd)
+                                     for (expnum, ccd, corners), ccd_pixels in zip(footprints, pixels)
+                                     for pixel in ccd_pixels])
+        self.connection.executemany("INSERT OR REPLACE INTO healpix_levels VALUES (?, ?)",
+                                    [(nside, expnum) for expnum in expnums])
+
+    def index_healpix(self, nside=None):
+        """
+        Add the healpix, at nside, of the exposures whose footprints are indexed but not yet mapped to healpix.
+
+        :return: number of exposures mapped.
+        """
+        if nside is None:
+            nside = util.HEALPIX_NSIDE
+        rows = self.connection.execute("SELECT expnum, ccd, corners FROM footprints WHERE expnum NOT IN "
+                                       "(SELECT expnum FROM healpix_levels WHERE nside = ?)", (nside,)).fetchall()
+        if len(rows) == 0:
+            return 0
+        expnums = sorted(set([row[0] for row in rows]))
+        with self.connection:
+            self._add_healpix([(row[0], row[1], json.loads(row[2])) for row in rows], expnums, nside)
+        logging.debug("Mapped {} exposures to healpix at nside {}".format(len(expnums), nside))
+        return len(expnums)
+
+    def healpix_search(self, pixel, nside=None, runids=None):
+        """
+        Find the CCDs that touch a healpix, using the inverted healpix index.
+
+        :param pixel: the healpix, RING ordered.
+        :param runids: list of runid patterns (SQL LIKE syntax) to restrict the search to.
+        :return: list of [expnum, ccd] pairs.
+        """
+        if nside is None:
+            nside = util.HEALPIX_NSIDE
+        self.index_healpix(nside)
+        query = ("SELECT h.expnum, h.ccd FROM healpix AS h JOIN exposures AS e ON h.expnum = e.expnum "
+                 "JOIN archive AS a ON h.expnum = a.expnum "
+                 "WHERE h.nside = ? AND h.healpix = ? ")
+        params = [nside, int(pixel)]
+        if runids is not None and len(runids) > 0:
+            query += "AND ( " + " OR ".join(["e.runid LIKE ?"] * len(runids)) + " ) "
+            params.extend(runids)
+        query += "ORDER BY h.expnum, h.ccd"
+        return [[row[0], row[1]] for row in self.connection.execute(query, params)]
+
+    def healpixels(self, nside=None):
+        """
+        The healpix touched by any of the indexed CCDs.
+
+        :rtype: numpy.ndarray
+        """
+        if nside is None:
+            nside = util.HEALPIX_NSIDE
+        self.index_healpix(nside)
+        return numpy.array([row[0] for row in self.connection.execute(
+            "SELECT DISTINCT healpix FROM healpix WHERE nside = ? ORDER BY healpix", (nside,))], dtype=numpy.int64)
+
+    def add_header_file(self, filename, expnum=None):
+        """
+        Add the footprints from a MEF .head file, by default the expnum is the leading digits of the filename.
+
+        The exposure is searchable, the .head files given are taken to be those of exposures to search, as the
+        archive listing of a sync would be.
+        """
+        if expnum is None:
+            expnum = os.path.basename(filename).split('.')[0].rstrip('pos')
+        count = self.add_headers(expnum, util.MEFHeaders(filename, source=filename))
+        if count > 0:
+            self.add_archive([expnum])
+        return count
+
+    def fill_from_directory(self, directory, force=False):
+        """
+        Index all the .head files in directory, skipping exposures already indexed unless force is set.
+
+        :return: number of exposures added.
+        """
+        known = self.exposures
+        count = 0
+        for filename in sorted(os.listdir(directory)):
+            if not filename.endswith('.head'):
+                continue
+            expnum = filename.split('.')[0].rstrip('pos')
+            if expnum in known and not force:
+                continue
+            try:
+                self.add_header_file(os.path.join(directory, filename), expnum=expnum)
+                count += 1
+            except Exception as ex:
+                logging.error("Failed to index {}: {}".format(filename, ex))
+        return count
+
+    def search(self, polygon, runids=None, mjdate=None, minimum_time=None):
+        """
+        Find the CCDs whose footprint overlaps polygon, the local equivalent of MyPolygon.cone_search.
+
+        :param polygon: the area to search, a Polygon in RA/DEC degrees.
+        :param runids: list of runid patterns (SQL LIKE syntax) to restrict the search to.
+        :param mjdate: exclude exposures taken within minimum_time days of mjdate.
+        :param minimum_time: see mjdate.
+        :return: list of [expnum, ccd] pairs.
+        :rtype: list
+        """
+        contour = numpy.array(polygon.contour(0))
+        reference = contour[0][0]
+        corners = numpy.transpose((_unwrap(contour[:, 0], reference), contour[:, 1]))
+        ra, dec, radius = _bounding_circle(corners)
+        dec_min = corners[:, 1].min()
+        dec_max = corners[:, 1].max()
+
+        query = ("SELECT f.expnum, f.ccd, f.ra, f.dec, f.radius, f.corners "
+                 "FROM footprints AS f JOIN exposures AS e ON f.expnum = e.expnum "
+                 "JOIN archive AS a ON f.expnum = a.expnum "
+                 "WHERE f.dec_max >= ? AND f.dec_min <= ? ")
+        params = [dec_min, dec_max]
+        if runids is not None and len(runids) > 0:
+            query += "AND ( " + " OR ".join(["e.runid LIKE ?"] * len(runids)) + " ) "
+            params.extend(runids)
+        if mjdate is not None:
+            query += "AND ( e.mjdate < ? OR e.mjdend > ? ) "
+            params.extend([mjdate - minimum_time, mjdate + minimum_time])
+
+        rows = self.connection.execute(query, params).fetchall()
+        if len(rows) == 0:
+            return []
+
+        # cheap circle test before the exact polygon overlap test.
+        separation = _separation(ra, dec,
+                                 numpy.array([row[2] for row in rows]),
+                                 numpy.array([row[3] for row in rows]))
+        candidates = separation <= radius + numpy.array([row[4] for row in rows])
+
+        search_area = Polygon.Polygon(corners)
+        overlaps = []
+        for row, candidate in zip(rows, candidates):
+            if not candidate:
+                continue
+            ccd_corners = numpy.array(json.loads(row[5]))
+            ccd_corners[:, 0] = _unwrap(ccd_corners[:, 0], reference)
+            if search_area.overlaps(Polygon.Polygon(ccd_corners)):
+                overlaps.append([row[0], row[1]])
+        logging.debug("Found these overlapping CCDs in {}\n{}".format(self.filename, overlaps))
+        return overlaps
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Add the footprints of the MEF .head files in a directory to the local footprint index.')
+
+    parser.add_argument("directory",
+                        help="directory containing the .head files to index")
+    parser.add_argument("--index",
+                        action="store",
+                        default=None,
+                        help="footprint index file, default ${} or {}".format(FOOTPRINT_INDEX_ENV,
+                                                                              DEFAULT_FOOTPRINT_INDEX))
+    parser.add_argument("--force", default=False,
+                        action="store_true",
+                        help="re-index exposures that are already in the index")
+    parser.add_argument("--verbose", "-v",
+                        action="store_true")
+    parser.add_argument("--debug", "-d",
+                        action="store_true")
+
+    args = parser.parse_args()
+    util.set_logger(args)
+
+    index = FootprintIndex(args.index)
+    count = index.fill_from_directory(args.directory, force=args.force)
+    logging.info("Added {} exposures to {}".format(count, index.filename))
+    index.close()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
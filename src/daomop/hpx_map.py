@@ -20,30 +20,39 @@ def run(healpix, min_matches=0, max_matches=10, min_overlaps=0, max_overlaps=10,
     """
 
     logging.debug("Building coverage map using healpix: {}".format(healpix))
-    catalog = storage.HPXCatalog(healpix)
-    t = catalog.table
-
-    expnums = np.array([x.split('p')[0] for x in t['dataset_name']])
+    partitions = storage.HPXPartitions(healpix)
     colours = ['r', 'g', 'b', 'y']
-    count = 0
+    expnum_colours = {}
+
+    # one partition at a time, so a dense healpix is never loaded whole.
+    for leaf in partitions.leaves:
+        try:
+            t = partitions.catalog(leaf).table
+        except storage.NotFoundException:
+            t = None
+        if t is not None:
+            expnums = np.array([x.split('p')[0] for x in t['dataset_name']])
+            for expnum in np.unique(expnums):
+                label = None
+                if expnum not in expnum_colours:
+                    expnum_colours[expnum] = colours[len(expnum_colours) % len(colours)]
+                    label = str(expnum)
+                colour = expnum_colours[expnum]
+                cond = np.all((t['FLUX_RADIUS'] > 2.5, expnums == expnum, t['MATCHES'] >= min_matches, t['MATCHES'] <= max_matches, t['OVERLAPS'] >= min_overlaps, t['OVERLAPS'] <= max_overlaps), axis=0)
+                pyplot.plot(t['X_WORLD'][cond], t['Y_WORLD'][cond], ',{}'.format(colour), ms=1, alpha=.25, label=label)
 
-    for expnum in np.unique(expnums):
-        colour = colours[count % len(colours)]
-        cond = np.all((t['FLUX_RADIUS'] > 2.5, expnums == expnum, t['MATCHES'] >= min_matches, t['MATCHES'] <= max_matches, t['OVERLAPS'] >= min_overlaps, t['OVERLAPS'] <= max_overlaps), axis=0)
-        pyplot.plot(t['X_WORLD'][cond], t['Y_WORLD'][cond], ',{}'.format(colour), ms=1, alpha=.25, label=str(expnum))
-        count += 1
+        # Now convert to phi,theta representation:
+        phi_theta = util.healpix_to_corners(leaf[1], nside=leaf[0], nest=True)
+        xy = list(phi_theta)
+        xy.append(phi_theta[0])
+        xy = np.array(xy).transpose()
+        pyplot.plot(xy[0], xy[1], '-k')
 
     pyplot.legend(fontsize=8)
     pyplot.xlabel("RA")
     pyplot.ylabel("DEC")
-    pyplot.title(catalog.filename)
+    pyplot.title(partitions.catalog(partitions.root).filename)
 
-    # Now convert to phi,theta representation:
-    phi_theta = util.healpix_to_corners(healpix)
-    xy = list(phi_theta)
-    xy.append(phi_theta[0])
-    xy = np.array(xy).transpose()
-    pyplot.plot(xy[0], xy[1], '-k')
     artifact = storage.HPXCatalog(healpix, ext=".png")
     pyplot.savefig(artifact.filename)
     if not dry_run:
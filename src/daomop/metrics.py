@@ -0,0 +1,359 @@
+"""Timers and counters of the work a pipeline task does, and the CPU and memory of the programs it runs.
+
+Each phase of a task is timed with timer, eg. download, sextractor, upload, tag_write, and counts such as the bytes
+transferred are kept with count.  External programs run through check_output have their CPU time and peak memory
+recorded.  The metrics of each task run are written as JSON next to its log, see storage.LoggingManager, and start
+prints the metrics of the whole process as a METRICS line on stderr when it exits, so they end up in the error file
+of the Condor job without mixing with the tables the tools write to stdout.
+
+Run as a script, the JSON files and job outputs given are summarized: where the time went, for each task, and how
+much of it was spent on the CPU rather than waiting on the network.
+"""
+import argparse
+import atexit
+import copy
+import datetime
+import errno
+import json
+import logging
+import os
+import resource
+import socket
+import subprocess
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+import util
+
+METRICS_ENV = 'DAOMOP_METRICS'
+ENABLED = os.environ.get(METRICS_ENV, '1') != '0'
+METRICS_EXT = ".json"
+# job outputs hold the metrics of a process on a line starting with this.
+METRICS_TAG = "METRICS"
+# timers of the VOSpace calls, see vospace.MeteredClient, concurrent calls can add up to more than the wall time.
+VOSPACE_PREFIX = 'vospace.'
+
+
+class Metrics(object):
+    """
+    The timers, counters and external program resource usage of a process.
+    """
+
+    def __init__(self):
+        self.timers = {}
+        self.counters = {}
+        self.processes = {}
+        self._lock = threading.Lock()
+
+    def add_time(self, name, seconds):
+        with self._lock:
+            timer = self.timers.setdefault(name, {'calls': 0, 'seconds': 0.0})
+            timer['calls'] += 1
+            timer['seconds'] += seconds
+
+    def count(self, name, value=1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def add_process(self, program, seconds, rusage):
+        """
+        Record a run of an external program.
+
+        :param program: name of the program.
+        :param seconds: wall-clock time the program ran.
+        :param rusage: resource usage of the program, as returned by os.wait4.
+        """
+        with self._lock:
+            usage = self.processes.setdefault(program, {'calls': 0, 'seconds': 0.0, 'user': 0.0, 'system': 0.0,
+                                                        'max_rss_kb': 0})
+            usage['calls'] += 1
+            usage['seconds'] += seconds
+            usage['user'] += rusage.ru_utime
+            usage['system'] += rusage.ru_stime
+            usage['max_rss_kb'] = max(usage['max_rss_kb'], rusage.ru_maxrss)
+
+    def snapshot(self):
+        """
+        The metrics so far, and the resources this process and its children have used.
+
+        :rtype: dict
+        """
+        own = resource.getrusage(resource.RUSAGE_SELF)
+        children = resource.getrusage(resource.RUSAGE_CHILDREN)
+        with self._lock:
+            return {'start': datetime.datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%S'),
+                    'host': socket.gethostname(),
+                    'pid': os.getpid(),
+                    'wall': time.time(),
+                    'cpu': {'user': own.ru_utime, 'system': own.ru_stime},
+                    'children': {'user': children.ru_utime, 'system': children.ru_stime},
+                    'max_rss_kb': own.ru_maxrss,
+                    'timers': copy.deepcopy(self.timers),
+                    'counters': dict(self.counters),
+                    'processes': copy.deepcopy(self.processes)}
+
+
+_metrics = Metrics()
+_started = {}
+
+
+def get_metrics():
+    """
+    The metrics of this process.
+
+    :rtype: Metrics
+    """
+    return _metrics
+
+
+@contextmanager
+def timer(name):
+    """
+    Time the block, adding to the timer of the given name.
+
+    usage:
+
+    with metrics.timer('download'):
+        storage.copy(uri, filename)
+    """
+    start = time.time()
+    try:
+        yield
+    finally:
+        _metrics.add_time(name, time.time() - start)
+
+
+def count(name, value=1):
+    """
+    Add value to the counter of the given name, eg. bytes_downloaded.
+    """
+    _metrics.count(name, value)
+
+
+def check_output(args, **kwargs):
+    """
+    Run a program and return its output, as subprocess.check_output does, recording the CPU time and peak memory
+    it used.
+
+    :param args: the program and its arguments.
+    :param kwargs: passed on to subprocess.Popen, eg. stderr=subprocess.STDOUT
+    :rtype: str
+    """
+    start = time.time()
+    process = subprocess.Popen(args, stdout=subprocess.PIPE, **kwargs)
+    try:
+        output = process.stdout.read()
+    finally:
+        process.stdout.close()
+    while True:
+        try:
+            pid, status, rusage = os.wait4(process.pid, 0)
+            break
+        except OSError as ex:
+            if ex.errno != errno.EINTR:
+                raise
+    # the process has been reaped here, so Popen must not wait for it.
+    process.returncode = os.WIFSIGNALED(status) and -os.WTERMSIG(status) or os.WEXITSTATUS(status)
+    _metrics.add_process(os.path.basename(args[0]), time.time() - start, rusage)
+    if process.returncode != 0:
+        raise subprocess.CalledProcessError(process.returncode, " ".join(args), output=output)
+    return output
+
+
+def snapshot():
+    """
+    The metrics of this process so far, pass to since to get the metrics of what follows.
+
+    :rtype: dict
+    """
+    return _metrics.snapshot()
+
+
+def since(earlier):
+    """
+    The metrics of the work done since a snapshot.
+
+    Peak memory is that of the whole process, it can not be split between the work before and after the snapshot.
+
+    :param earlier: a snapshot.
+    :rtype: dict
+    """
+    current = snapshot()
+    record = {'start': earlier['start'],
+              'host': current['host'],
+              'pid': current['pid'],
+              'wall': current['wall'] - earlier['wall'],
+              'max_rss_kb': current['max_rss_kb'],
+              'counters': {},
+              'timers': {},
+              'processes': {}}
+    for key in ['cpu', 'children']:
+        record[key] = dict([(name, current[key][name] - earlier[key][name]) for name in current[key]])
+    for name, value in current['counters'].items():
+        if value != earlier['counters'].get(name, 0):
+            record['counters'][name] = value - earlier['counters'].get(name, 0)
+    for key in ['timers', 'processes']:
+        for name, values in current[key].items():
+            before = earlier[key].get(name, {})
+            if values['calls'] == before.get('calls', 0):
+                continue
+            record[key][name] = dict([(field, values[field] - before.get(field, 0)) for field in values])
+            if 'max_rss_kb' in values:
+                record[key][name]['max_rss_kb'] = values['max_rss_kb']
+    return record
+
+
+def summary(record):
+    """
+    One line summary of a metrics record: wall and CPU time and the three phases that took longest.
+
+    :rtype: str
+    """
+    cpu = sum(record['cpu'].values()) + sum(record['children'].values())
+    phases = sorted(record['timers'].items(), key=lambda item: -item[1]['seconds'])[:3]
+    return "{:.1f}s wall, {:.1f}s cpu, {}".format(record['wall'], cpu, ", ".join(
+        ["{} {:.1f}s/{}".format(name, timer['seconds'], timer['calls']) for name, timer in phases]))
+
+
+def _report(task):
+    if _started.get('pid', None) != os.getpid():
+        # a forked worker, the process that called start reports.
+        return
+    record = since(_started['snapshot'])
+    record.update({'task': task, 'scope': 'process'})
+    sys.stderr.write("{} {}\n".format(METRICS_TAG, json.dumps(record, sort_keys=True)))
+    sys.stderr.flush()
+
+
+def start(task):
+    """
+    Print the metrics of this process as a METRICS line on stderr when it exits.
+
+    :param task: name of the pipeline task the process runs.
+    """
+    if not ENABLED or _started.get('pid', None) == os.getpid():
+        return
+    _started.update({'pid': os.getpid(), 'snapshot': snapshot()})
+    atexit.register(_report, task)
+
+
+def read_metrics(filenames):
+    """
+    Read the metrics records in task JSON files and in the METRICS lines of job outputs.
+
+    :param filenames: list of files, and directories to search for .json, .out and .err files.
+    :return: list of records
+    """
+    records = []
+    for name in filenames:
+        if os.path.isdir(name):
+            for dirpath, dirnames, files in os.walk(name):
+                records.extend(read_metrics([os.path.join(dirpath, filename) for filename in sorted(files)
+                                             if os.path.splitext(filename)[1] in [METRICS_EXT, '.out', '.err']]))
+            continue
+        try:
+            with open(name) as fobj:
+                if name.endswith(METRICS_EXT):
+                    records.append(json.load(fobj))
+                    continue
+                for line in fobj:
+                    if line.startswith(METRICS_TAG + " "):
+                        records.append(json.loads(line[len(METRICS_TAG) + 1:]))
+        except (IOError, ValueError) as ex:
+            logging.warning("Skipping {}: {}".format(name, ex))
+    return records
+
+
+def aggregate(records):
+    """
+    Total the records of each task and scope.
+
+    :return: dict keyed on (task, scope) of the totals: runs, wall, cpu, counters, timers and processes.
+    :rtype: dict
+    """
+    totals = {}
+    for record in records:
+        key = (record.get('task', 'unknown'), record.get('scope', 'task'))
+        total = totals.setdefault(key, {'runs': 0, 'wall': 0.0, 'cpu': 0.0, 'max_rss_kb': 0,
+                                        'counters': {}, 'timers': {}, 'processes': {}})
+        total['runs'] += 1
+        total['wall'] += record['wall']
+        total['cpu'] += sum(record['cpu'].values()) + sum(record['children'].values())
+        total['max_rss_kb'] = max(total['max_rss_kb'], record['max_rss_kb'])
+        for name, value in record['counters'].items():
+            total['counters'][name] = total['counters'].get(name, 0) + value
+        for kind in ['timers', 'processes']:
+            for name, values in record[kind].items():
+                this = total[kind].setdefault(name, {})
+                for field, value in values.items():
+                    if field == 'max_rss_kb':
+                        this[field] = max(this.get(field, 0), value)
+                    else:
+                        this[field] = this.get(field, 0) + value
+    return totals
+
+
+def report(totals, top=10):
+    """
+    The hot spots of each task: the timers that took longest, external program CPU and memory, and the counters.
+
+    :param totals: see aggregate.
+    :param top: number of timers to list for each task.
+    :rtype: str
+    """
+    lines = []
+    for task, scope in sorted(totals):
+        total = totals[(task, scope)]
+        wall = max(total['wall'], 1e-9)
+        transfer = sum([timer['seconds'] for name, timer in total['timers'].items()
+                        if name.startswith(VOSPACE_PREFIX)])
+        lines.append("{} ({} scope): {} runs, {:.1f}s wall, cpu {:.0f}% of wall, VOSpace calls {:.0f}% of wall, "
+                     "peak rss {:.0f}MB".format(task, scope, total['runs'], total['wall'], 100 * total['cpu'] / wall,
+                                                100 * transfer / wall, total['max_rss_kb'] / 1024.0))
+        for name, timer in sorted(total['timers'].items(), key=lambda item: -item[1]['seconds'])[:top]:
+            lines.append("  {:<24} {:>10.1f}s {:>5.1f}% {:>8} calls {:>9.3f}s mean".format(
+                name, timer['seconds'], 100 * timer['seconds'] / wall, timer['calls'],
+                timer['seconds'] / max(timer['calls'], 1)))
+        for name, usage in sorted(total['processes'].items(), key=lambda item: -item[1]['seconds']):
+            lines.append("  {:<24} {:>10.1f}s {:>8} runs {:>9.1f}s cpu {:>7.0f}MB peak rss".format(
+                name, usage['seconds'], usage['calls'], usage['user'] + usage['system'],
+                usage['max_rss_kb'] / 1024.0))
+        for name, value in sorted(total['counters'].items()):
+            lines.append("  {:<24} {:>10}".format(name, value))
+    return "\n".join(lines)
+
+
+def main():
+    """Summarize the metrics in task JSON files and Condor job outputs."""
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("filenames",
+                        nargs='+',
+                        help="metrics JSON files, job outputs holding METRICS lines or directories of them")
+    parser.add_argument("--task",
+                        action="store",
+                        default=None,
+                        help="only summarize this task")
+    parser.add_argument("--top",
+                        type=int,
+                        default=10,
+                        help="number of timers to list for each task")
+    parser.add_argument("--verbose", "-v",
+                        action="store_true")
+    parser.add_argument("--debug", "-d",
+                        action="store_true")
+    args = parser.parse_args()
+
+    util.set_logger(args)
+    records = [record for record in read_metrics(args.filenames)
+               if args.task is None or record.get('task', None) == args.task]
+    if len(records) == 0:
+        logging.error("No metrics found")
+        return 1
+    print(report(aggregate(records), top=args.top))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
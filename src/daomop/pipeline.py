@@ -0,0 +1,302 @@
+"""Pipeline wide utilities, run as: pipeline <command> [options]"""
+import argparse
+import logging
+import os
+import sys
+from multiprocessing.pool import ThreadPool
+
+from astropy.table import Table
+
+import scheduler
+import storage
+import util
+import vospace
+
+TASKS = ['build_cat', 'stationary']
+
+
+def exposure_status(expnum, tasks, prefix='', version=storage.PROCESSED_VERSION):
+    """
+    Summarize the status of each task on all CCDs of an exposure using a single look up of the exposure tags.
+
+    :param expnum: exposure number
+    :param tasks: list of task names
+    :return: list of (expnum, task, n_success, n_failed, n_missing) rows
+    :rtype: list
+    """
+    ccds = storage.Observation(expnum).ccd_list
+    try:
+        storage.get_tags(expnum, force=True)
+    except Exception as ex:
+        logging.error("Failed to get status of {}: {}".format(expnum, ex))
+        return [(str(expnum), task, 0, 0, len(ccds)) for task in tasks]
+
+    rows = []
+    for task in tasks:
+        statuses = storage.get_statuses(task, prefix, expnum, version, ccds, return_message=True)
+        n_success = len([status for status in statuses.values() if status == storage.SUCCESS])
+        n_missing = len([status for status in statuses.values() if status is None])
+        rows.append((str(expnum), task, n_success, len(ccds) - n_success - n_missing, n_missing))
+    return rows
+
+
+def expnum_list(args):
+    """
+    The exposures given on the command line, in --expnum-file and, with --all, all those in the archive.
+    """
+    expnums = [str(expnum) for expnum in args.expnum]
+    if args.expnum_file is not None:
+        expnums.extend([line.strip() for line in open(args.expnum_file) if len(line.strip()) > 0])
+    if args.all:
+        expnums.extend([str(expnum) for expnum in storage.list_exposures()['expnum']])
+    return expnums
+
+
+def status(args):
+    """
+    Report the status of tasks for a list of exposures, looking up exposures concurrently.
+    """
+    expnums = expnum_list(args)
+
+    pool = ThreadPool(args.workers)
+    try:
+        results = pool.map(lambda expnum: exposure_status(expnum, args.tasks, args.prefix, args.version),
+                           expnums)
+    finally:
+        pool.close()
+        pool.join()
+
+    rows = [row for result in results for row in result]
+    table = Table([[row[idx] for row in rows] for idx in range(5)],
+                  names=('expnum', 'task', 'success', 'failed', 'missing'))
+    if args.failed_only:
+        table = table[table['failed'] + table['missing'] > 0]
+    if len(table) == 0:
+        logging.warning("No exposure status to report.")
+        return 0
+    if args.output is None:
+        table.write(sys.stdout, format='ascii.fixed_width_two_line')
+    else:
+        table.write(args.output, format='ascii.fixed_width_two_line', overwrite=True)
+    return 0
+
+
+def run(args):
+    """
+    Run the pipeline steps that have not finished on the given exposures and healpix, or write them as a DAGMan file.
+    """
+    # the pipeline scripts only process the default prefix and version, so the graph checks their tags.
+    graph = scheduler.Graph()
+    for expnum in expnum_list(args):
+        graph.add_exposure(expnum, args.tasks)
+    for healpix in args.healpix:
+        for task in args.tasks:
+            if task in scheduler.HEALPIX_TASKS:
+                graph.add_healpix(healpix, storage.healpix_overlaps(healpix, runids=storage.RUNIDS), task=task)
+    graph.load_statuses(args.workers)
+
+    if args.dag is not None:
+        count = graph.write_dag(args.dag)
+        logging.info("Wrote {} of {} jobs to {}".format(count, len(graph.jobs), args.dag))
+        return 0
+
+    finished, failed, blocked = graph.run(args.workers, dry_run=args.dry_run)
+    logging.info("{} jobs finished, {} failed, {} blocked, {} already done".format(
+        len(finished), len(failed), len(blocked), len(graph.jobs) - len(finished) - len(failed) - len(blocked)))
+    return len(failed) + len(blocked) > 0 and 1 or 0
+
+
+def compact(args):
+    """
+    Merge the appended partitions of healpix catalogs into their compacted catalog, splitting dense healpix.
+    """
+    for healpix in args.healpix:
+        try:
+            count, split = storage.HPXPartitions(healpix).compact(max_rows=args.max_rows, max_nside=args.max_nside)
+            logging.info("healpix {}: compacted {} partitions, split {} catalogs".format(healpix, count, split))
+        except Exception as ex:
+            logging.error("Failed to compact healpix {}: {}".format(healpix, ex))
+    return 0
+
+
+def logs(args):
+    """
+    Print the log of a task, merging the segments shipped by each run.
+    """
+    location = storage.log_location(args.expnum, args.ccd)
+    filename = storage.log_filename(args.prefix, args.task, version=args.version, ccd=args.ccd)
+    content = storage.merge_log_segments(location, filename)
+    if args.output is None:
+        sys.stdout.write(content)
+    else:
+        with open(args.output, 'w') as fout:
+            fout.write(content)
+    return 0
+
+
+def invalidate_queries(args):
+    """
+    Remove TAP query results from the query cache.
+    """
+    count = storage.invalidate_queries(pattern=args.pattern)
+    logging.info("Removed {} cached query results.".format(count))
+    return 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--dbimages",
+                        action="store",
+                        default="vos:cfis/solar_system/dbimages",
+                        help='vospace dbimages containerNode')
+    parser.add_argument("--refresh",
+                        action="store_true",
+                        help="re-run TAP queries even if their results are in the query cache")
+    parser.add_argument("--verbose", "-v",
+                        action="store_true")
+    vospace.add_trace_argument(parser)
+    parser.add_argument("--debug", "-d",
+                        action="store_true")
+    subparsers = parser.add_subparsers(title='commands')
+
+    status_parser = subparsers.add_parser('status', help='report the processing status of exposures')
+    status_parser.add_argument("expnum",
+                               nargs='*',
+                               help="expnum(s) to report on")
+    status_parser.add_argument("--expnum-file",
+                               action="store",
+                               default=None,
+                               help="file with one expnum per line to report on")
+    status_parser.add_argument("--all",
+                               action="store_true",
+                               help="report on all the exposures returned by storage.list_exposures")
+    status_parser.add_argument("--tasks",
+                               nargs='+',
+                               default=TASKS,
+                               help="tasks to report the status of")
+    status_parser.add_argument("--prefix",
+                               default='',
+                               help="prefix of the processed files")
+    status_parser.add_argument("--version",
+                               default=storage.PROCESSED_VERSION,
+                               help="version of the exposures (o, p, s)")
+    status_parser.add_argument("--workers",
+                               type=int,
+                               default=8,
+                               help="number of concurrent VOSpace look ups")
+    status_parser.add_argument("--failed-only",
+                               action="store_true",
+                               help="only report exposure/task pairs that are not complete")
+    status_parser.add_argument("--output",
+                               action="store",
+                               default=None,
+                               help="write the status table to this file, default is stdout")
+    status_parser.set_defaults(func=status)
+
+    run_parser = subparsers.add_parser('run', help='run the unfinished pipeline steps in dependency order')
+    run_parser.add_argument("expnum",
+                            nargs='*',
+                            help="expnum(s) to run the CCD steps on")
+    run_parser.add_argument("--expnum-file",
+                            action="store",
+                            default=None,
+                            help="file with one expnum per line to run the CCD steps on")
+    run_parser.add_argument("--all",
+                            action="store_true",
+                            help="run on all the exposures returned by storage.list_exposures")
+    run_parser.add_argument("--healpix",
+                            type=int,
+                            nargs='+',
+                            default=[],
+                            help="healpix to run the healpix steps (stationary) on, with the CCD steps they need")
+    run_parser.add_argument("--tasks",
+                            nargs='+',
+                            default=TASKS,
+                            choices=sorted(scheduler.DEPENDENCIES),
+                            help="pipeline steps to run")
+    run_parser.add_argument("--workers",
+                            type=int,
+                            default=scheduler.DEFAULT_WORKERS,
+                            help="number of jobs to run at once")
+    run_parser.add_argument("--footprint-index",
+                            action="store",
+                            default=storage.FOOTPRINT_INDEX,
+                            help="local footprint index (SQLite) used to find the CCDs of each healpix")
+    run_parser.add_argument("--catalogs",
+                            action="store",
+                            default="catalogs",
+                            help='dbimages subdirectory where the healpix catalogs are stored.')
+    run_parser.add_argument("--dag",
+                            action="store",
+                            default=None,
+                            help="write the unfinished jobs to this Condor DAGMan file rather than running them")
+    run_parser.add_argument("--dry-run",
+                            action="store_true",
+                            help="log the commands that would be run, in order, without running them")
+    run_parser.set_defaults(func=run)
+
+    compact_parser = subparsers.add_parser('compact', help='merge the appended partitions of healpix catalogs')
+    compact_parser.add_argument("healpix",
+                                type=int,
+                                nargs='+',
+                                help="healpix catalog(s) to compact")
+    compact_parser.add_argument("--catalogs",
+                                action="store",
+                                default="catalogs",
+                                help='dbimages subdirectory where catalogs are stored.')
+    compact_parser.add_argument("--max-rows",
+                                type=int,
+                                default=storage.HPX_MAX_ROWS,
+                                help="split catalogs with more rows than this into their NESTED children")
+    compact_parser.add_argument("--max-nside",
+                                type=int,
+                                default=util.HEALPIX_MAX_NSIDE,
+                                help="do not split catalogs beyond this nside")
+    compact_parser.set_defaults(func=compact)
+
+    logs_parser = subparsers.add_parser('logs', help='merge the log segments of a task into one log')
+    logs_parser.add_argument("expnum",
+                             help="expnum the task was run on")
+    logs_parser.add_argument("task",
+                             help="task whose log is merged, eg. build_cat")
+    logs_parser.add_argument("--ccd",
+                             type=int,
+                             default=None,
+                             help="ccd the task was run on")
+    logs_parser.add_argument("--prefix",
+                             default='',
+                             help="prefix of the processed files")
+    logs_parser.add_argument("--version",
+                             default=storage.PROCESSED_VERSION,
+                             help="version of the exposure (o, p, s)")
+    logs_parser.add_argument("--output",
+                             action="store",
+                             default=None,
+                             help="write the merged log to this file, default is stdout")
+    logs_parser.set_defaults(func=logs)
+
+    invalidate_parser = subparsers.add_parser('invalidate-queries', help='remove TAP query results from the cache')
+    invalidate_parser.add_argument("--pattern",
+                                   action="store",
+                                   default=None,
+                                   help="only remove the results of queries containing this text, default is all")
+    invalidate_parser.set_defaults(func=invalidate_queries)
+
+    args = parser.parse_args()
+    util.set_logger(args)
+    if args.trace_vos:
+        vospace.enable_tracing()
+        # the steps run by the run command trace their calls too.
+        os.environ[vospace.TRACE_ENV] = '1'
+
+    storage.DBIMAGES = args.dbimages
+    storage.REFRESH_QUERIES = args.refresh
+    if hasattr(args, 'catalogs'):
+        storage.CATALOG = args.catalogs
+    if hasattr(args, 'footprint_index'):
+        storage.FOOTPRINT_INDEX = args.footprint_index
+    return args.func(args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
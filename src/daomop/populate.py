@@ -1,8 +1,14 @@
 import argparse
+import os
 import sys
 import logging
+import time
+import metrics
 import util
+import vospace
 import errno
+from multiprocessing.pool import ThreadPool
+from astropy.table import Table
 
 import storage
 from storage import archive_url
@@ -13,6 +19,43 @@ from storage import make_link
 from storage import pitcairn_uri
 from storage import isfile
 
+DEFAULT_WORKERS = 10
+PROGRESS_INTERVAL = 100
+SKIPPED = 'skipped'
+
+
+def exposure_links(dataset_name):
+    """
+    The links that populate the dbimages directory of an exposure, in the order they are made.
+
+    @param dataset_name: the name of the CFHT dataset to make links to.
+    @return: list of (sources, destination, check), the first of sources that exists is linked to destination,
+    only sources with check set are looked for.
+    """
+    observation = Observation(dataset_name)
+    return [([archive_url(dataset_name, 'o')],
+             Image(observation, version='o', ext='.fits.fz').uri, False),
+            ([archive_url(dataset_name, version='o', fhead='true')],
+             Header(observation, version='o').uri, False),
+            # Source is either PITCAIRN processing or CFHT archive URL, pitcairn may be without the .fz
+            ([pitcairn_uri(dataset_name), pitcairn_uri(dataset_name, ext=".fits")],
+             Image(observation, version='p', ext='.fits.fz').uri, True),
+            # Can be the CFHTSG header or the one in the CFHT archive one.
+            ([archive_url(dataset_name, 'p', ext='.head', archive='CFHTSG')],
+             Header(observation, version='p').uri, True)]
+
+
+def resolve(sources, check):
+    """
+    @return: the first of sources that exists, or None if there is none.
+    """
+    if not check:
+        return sources[0]
+    for source in sources:
+        if isfile(source):
+            return source
+    return None
+
 
 def run(dataset_name):
     """Given a dataset_name created the desired dbimages directories
@@ -20,46 +63,104 @@ def run(dataset_name):
 
     @param dataset_name: the name of the CFHT dataset to make a link to.
     """
+    links = exposure_links(dataset_name)
+    make_path(links[0][1])
+    for sources, destination, check in links:
+        with metrics.timer('resolve'):
+            source = resolve(sources, check)
+        if source is None:
+            raise OSError(errno.EEXIST, "No file to link to for {}".format(sources[-1]), dataset_name)
+        logging.debug("Making link between {} and {}".format(source, destination))
+        with metrics.timer('link'):
+            make_link(source, destination)
 
-    observation = Observation(dataset_name)
+    return True
 
-    version = 'o'
-    ext = '.fits.fz'
-    artifact = Image(observation, version=version, ext=ext)
-    source = archive_url(dataset_name, version)
-    logging.debug("Making link between {} and {}".format(source, artifact.uri))
-    make_path(artifact.uri)
-    make_link(source, artifact.uri)
-
-    logging.debug("Linking to RAW header")
-    source = archive_url(dataset_name, version=version, fhead='true')
-    header = Header(observation, version=version)
-    make_link(source, header.uri)
-
-    logging.debug("Making link between PROC'd image and dbimages")
-    version = 'p'
-    ext = '.fits.fz'
-    artifact = Image(observation, version=version, ext=ext)
-    # Source is either PITCAIRN processing or CFHT archive URL
-    source = pitcairn_uri(dataset_name)
-    if not isfile(source):
-        # Try pitcairn wihtout the .fz
-        source = pitcairn_uri(dataset_name, ext=".fits")
-    if not isfile(source):
-        raise OSError(errno.EEXIST,"No file in pitcairn to link to for {}".format(source), dataset_name)
-
-    make_link(source, artifact.uri)
-
-    logging.debug("Link up the header")
-    # Can be the CFHTSG header or the one in the CFHT archive one.
-    source = archive_url(dataset_name, version, ext='.head', archive='CFHTSG')
-    header = Header(observation, version=version)
-    if not isfile(source):
-        raise OSError(errno.EEXIST,"No header to link to for {}".format(source), dataset_name)
-
-    make_link(source, header.uri)
 
-    return True
+def run_batch(expnums, workers=DEFAULT_WORKERS, force=False, dry_run=False):
+    """
+    Populate many exposures, looking up sources and making links through a pool of workers threads.
+
+    Exposures that already have a dbimages directory holding all their links are skipped, unless force is set,
+    based on one listing of dbimages and a listing of the directory of each exposure in it, so an exposure whose
+    links were only partly made is completed.  The sources of the missing links are looked for concurrently, then the
+    dbimages directories of the exposures whose sources were all found are made in one pass and their links are made
+    concurrently.
+
+    @param expnums: list of the exposures to populate.
+    @param workers: number of concurrent VOSpace/archive requests.
+    @param dry_run: look for the sources but don't make any links.
+    @return: summary with the status of each exposure and the number of links made.
+    @rtype: Table
+    """
+    start = time.time()
+    expnums = [str(expnum) for expnum in expnums]
+    expected = dict([(expnum, exposure_links(expnum)) for expnum in expnums])
+    populated = set()
+    if not force:
+        populated = set(storage.list_dbimages()) & set(expnums)
+
+    pool = ThreadPool(workers)
+    try:
+        def _missing(expnum):
+            links = expected[expnum]
+            if expnum not in populated:
+                return expnum, links
+            try:
+                existing = set(storage.listdir(os.path.dirname(links[0][1])))
+            except Exception as ex:
+                logging.debug("Unable to list the links of {}: {}".format(expnum, ex))
+                return expnum, links
+            return expnum, [link for link in links if os.path.basename(link[1]) not in existing]
+
+        missing = dict(pool.map(_missing, expnums))
+        statuses = dict([(expnum, len(missing[expnum]) == 0 and SKIPPED or storage.SUCCESS) for expnum in expnums])
+        linked = dict([(expnum, 0) for expnum in expnums])
+        todo = [expnum for expnum in expnums if len(missing[expnum]) > 0]
+        logging.info("Populating {} exposures, skipping {} already in {}".format(
+            len(todo), len(expnums) - len(todo), storage.DBIMAGES))
+
+        lookups = [(expnum, candidates, destination, check)
+                   for expnum in todo for candidates, destination, check in missing[expnum]]
+        sources = pool.map(lambda lookup: resolve(lookup[1], lookup[3]), lookups)
+        links = []
+        for (expnum, candidates, destination, check), source in zip(lookups, sources):
+            if source is None:
+                statuses[expnum] = "No file to link to for {}".format(candidates[-1])
+            else:
+                links.append((expnum, source, destination))
+        links = [link for link in links if statuses[link[0]] == storage.SUCCESS]
+        logging.info("Found the sources of {} exposures in {:.1f}s".format(
+            len(set([link[0] for link in links])), time.time() - start))
+
+        if not dry_run and len(links) > 0:
+            storage.make_paths([link[2] for link in links])
+
+            def _link(link):
+                try:
+                    make_link(link[1], link[2])
+                except Exception as ex:
+                    return link[0], str(ex)
+                return link[0], storage.SUCCESS
+
+            link_start = time.time()
+            for count, (expnum, message) in enumerate(pool.imap_unordered(_link, links)):
+                if message == storage.SUCCESS:
+                    linked[expnum] += 1
+                elif statuses[expnum] == storage.SUCCESS:
+                    statuses[expnum] = message
+                if (count + 1) % PROGRESS_INTERVAL == 0 or count + 1 == len(links):
+                    logging.info("Made {}/{} links, {:.1f} links/s".format(
+                        count + 1, len(links), (count + 1) / max(time.time() - link_start, 1e-6)))
+    finally:
+        pool.close()
+        pool.join()
+
+    elapsed = time.time() - start
+    logging.info("Populated {} exposures in {:.1f}s, {:.2f} exposures/s".format(
+        len(todo), elapsed, len(todo) / max(elapsed, 1e-6)))
+    return Table([expnums, [statuses[expnum] for expnum in expnums], [linked[expnum] for expnum in expnums]],
+                 names=('expnum', 'status', 'links'))
 
 
 def main():
@@ -72,8 +173,26 @@ def main():
                         help='vospace dbimages containerNode')
     parser.add_argument("expnum",
                         type=int,
-                        nargs='+',
+                        nargs='*',
                         help="expnum(s) to create directories for")
+    parser.add_argument("--expnum-file",
+                        action="store",
+                        default=None,
+                        help="file with one expnum per line to populate, implies --batch")
+    parser.add_argument("--tap",
+                        action="store_true",
+                        help="populate all the exposures returned by storage.list_exposures, implies --batch")
+    parser.add_argument("--batch",
+                        action="store_true",
+                        help="populate the exposures concurrently, skipping those already in dbimages")
+    parser.add_argument("--workers",
+                        type=int,
+                        default=DEFAULT_WORKERS,
+                        help="number of concurrent VOSpace/archive requests in batch mode")
+    parser.add_argument("--output",
+                        action="store",
+                        default=None,
+                        help="write the batch summary table to this file, default is stdout")
     parser.add_argument("--dry-run",
                         action="store_true",
                         help="DRY RUN, don't copy results to VOSpace, implies --force")
@@ -81,6 +200,7 @@ def main():
                         action="store_true")
     parser.add_argument("--force", default=False,
                         action="store_true")
+    vospace.add_trace_argument(parser)
     parser.add_argument("--debug", "-d",
                         action="store_true")
     parser.add_argument("--pitcairn", default="vos:cfis/pitcairn", action="store", help="vospace containing pitcairn processed images")
@@ -89,14 +209,35 @@ def main():
     args = parser.parse_args()
 
     util.set_logger(args)
+    metrics.start('populate')
+    if args.trace_vos:
+        vospace.enable_tracing()
     logging.info("Started {}".format(cmd_line))
 
     storage.DBIMAGES = args.dbimages
     storage.PITCAIRN = args.pitcairn
 
     exit_code = 0
-    for expnum in args.expnum:
-        run(expnum)
+    expnums = list(args.expnum)
+    if args.expnum_file is not None:
+        expnums.extend([line.strip() for line in open(args.expnum_file) if len(line.strip()) > 0])
+    if args.tap:
+        expnums.extend(storage.list_exposures()['expnum'])
+
+    if not (args.batch or args.tap or args.expnum_file is not None):
+        for expnum in expnums:
+            run(expnum)
+        return exit_code
+
+    summary = run_batch(expnums, workers=args.workers, force=args.force, dry_run=args.dry_run)
+    if args.output is None:
+        summary.write(sys.stdout, format='ascii.fixed_width_two_line')
+    else:
+        summary.write(args.output, format='ascii.fixed_width_two_line', overwrite=True)
+    failed = [status not in [storage.SUCCESS, SKIPPED] for status in summary['status']]
+    if any(failed):
+        logging.error("Failed to populate {} exposures".format(sum(failed)))
+        exit_code = 1
     return exit_code
 
 
@@ -0,0 +1,265 @@
+"""Run the daomop pipeline steps as a graph of (expnum, ccd, task) nodes.
+
+Each node is a storage.Task whose target is one CCD and whose dependency is the node, on the same CCD, of the task it
+depends on.  The statuses of all the nodes are read with one look up of the tags of each exposure and finished nodes
+are skipped.  The nodes are run by jobs, one per CCD for the CCD steps and one per healpix for stationary, that are
+either dispatched to a local pool of worker processes as soon as their nodes are ready or written out as a Condor
+DAGMan file.
+"""
+import logging
+import os
+import subprocess
+from multiprocessing.pool import ThreadPool
+
+from six.moves import queue
+
+import storage
+
+# the task each pipeline step depends on, on the same CCD.
+DEPENDENCIES = {'build_cat': None, 'stationary': 'build_cat'}
+# steps run once per healpix, on all the CCDs that overlap it, rather than once per CCD.
+HEALPIX_TASKS = ['stationary']
+DEFAULT_WORKERS = 4
+SUBMIT_FILENAME = "daomop.sub"
+SUBMIT = """Universe   = vanilla
+should_transfer_files = YES
+when_to_transfer_output = ON_EXIT_OR_EVICT
+RunAsOwner = True
+transfer_output_files = /dev/null
+getenv = True
+
+Executable = $(executable)
+Arguments = $(arguments)
+Log = $(job).log
+Output = $(job).out
+Error = $(job).err
+Queue
+"""
+
+
+class Job(object):
+    """
+    One run of a pipeline script, it runs the nodes it lists.
+    """
+
+    def __init__(self, name, task, arguments, nodes=None):
+        """
+        :param name: unique name of the job, used as the DAGMan job name.
+        :param task: the pipeline script to run.
+        :param arguments: list of the script arguments.
+        :param nodes: list of the storage.Task nodes the job runs.
+        """
+        self.name = name
+        self.task = task
+        self.arguments = arguments
+        self.nodes = nodes or []
+        self.parents = set()
+
+    def __str__(self):
+        return self.name
+
+    @property
+    def command(self):
+        command = [self.task, '--dbimages', storage.DBIMAGES]
+        if self.task in HEALPIX_TASKS:
+            command += ['--catalogs', storage.CATALOG]
+            if storage.FOOTPRINT_INDEX is not None:
+                command += ['--footprint-index', storage.FOOTPRINT_INDEX]
+            if storage.REFRESH_QUERIES:
+                command += ['--refresh']
+        return command + [str(argument) for argument in self.arguments]
+
+    @property
+    def expnums(self):
+        return sorted(set([node.expnum for node in self.nodes]))
+
+    @property
+    def finished(self):
+        return all([node.finished for node in self.nodes])
+
+    @property
+    def ready(self):
+        return all([node.ready for node in self.nodes])
+
+
+def execute(job, dry_run=False):
+    """
+    Run the command of a job in a sub-process.
+
+    :return: (job name, exit code)
+    """
+    logging.info("Running {}".format(" ".join(job.command)))
+    if dry_run:
+        return job.name, 0
+    try:
+        return job.name, subprocess.call(job.command)
+    except Exception as ex:
+        logging.error("Failed to run {}: {}".format(job, ex))
+        return job.name, -1
+
+
+class Graph(object):
+    """
+    The (expnum, ccd, task) nodes of the pipeline and the jobs that run them.
+    """
+
+    def __init__(self, prefix='', version=storage.PROCESSED_VERSION):
+        self.prefix = prefix
+        self.version = version
+        self.nodes = {}
+        self.jobs = {}
+        self._node_jobs = {}
+
+    def node(self, expnum, ccd, task):
+        """
+        The node of task on a CCD, added to the graph, with its dependencies, if not already there.
+
+        :rtype: storage.Task
+        """
+        key = (str(expnum), int(ccd), task)
+        if key in self.nodes:
+            return self.nodes[key]
+        dependency = DEPENDENCIES[task]
+        if dependency is not None:
+            dependency = self.node(expnum, ccd, dependency)
+        node = storage.Task(task, dependency=dependency)
+        node.target = storage.Artifact(storage.Observation(key[0]), version=self.version, ccd=key[1],
+                                       prefix=self.prefix)
+        self.nodes[key] = node
+        if task not in HEALPIX_TASKS:
+            self.add_job(Job("{}_{}_{:02d}".format(task, key[0], key[1]), task, ['--ccd', key[1], key[0]], [node]))
+        return node
+
+    def add_job(self, job):
+        self.jobs[job.name] = job
+        for node in job.nodes:
+            self._node_jobs.setdefault(self.key(node), []).append(job)
+
+    def key(self, node):
+        return node.expnum, node.target.ccd, node.name
+
+    def add_exposure(self, expnum, tasks):
+        """
+        Add the nodes of each of the CCD tasks on all the CCDs of an exposure.
+        """
+        for ccd in storage.Observation(str(expnum)).ccd_list:
+            for task in tasks:
+                if task not in HEALPIX_TASKS:
+                    self.node(expnum, ccd, task)
+
+    def add_healpix(self, pixel, overlaps, task='stationary'):
+        """
+        Add a job that runs a healpix task on the CCDs that overlap the healpix.
+
+        :param overlaps: list of the (expnum, ccd) that overlap the healpix, see storage.healpix_overlaps.
+        :rtype: Job
+        """
+        job = Job("{}_{}".format(task, pixel), task, [pixel],
+                  [self.node(expnum, ccd, task) for expnum, ccd in overlaps])
+        self.add_job(job)
+        return job
+
+    def link(self):
+        """
+        Set the parents of each job, the jobs that run the dependencies of its nodes.
+        """
+        for job in self.jobs.values():
+            job.parents = set()
+            for node in job.nodes:
+                if node.dependency is not None:
+                    job.parents.update([parent.name for parent in self._node_jobs.get(self.key(node.dependency), [])])
+
+    def load_statuses(self, workers=DEFAULT_WORKERS, expnums=None):
+        """
+        Read the tags of all the exposures in the graph, one look up per exposure, so node statuses are local.
+        """
+        if expnums is None:
+            expnums = sorted(set([key[0] for key in self.nodes]))
+
+        def load(expnum):
+            try:
+                storage.get_tags(expnum, force=True)
+            except Exception as ex:
+                logging.error("Failed to get status of {}: {}".format(expnum, ex))
+
+        pool = ThreadPool(workers)
+        try:
+            pool.map(load, expnums)
+        finally:
+            pool.close()
+            pool.join()
+
+    def pending(self):
+        """
+        The jobs that still have nodes to run, in name order.
+        """
+        return [self.jobs[name] for name in sorted(self.jobs) if not self.jobs[name].finished]
+
+    def run(self, workers=DEFAULT_WORKERS, dry_run=False):
+        """
+        Run the pending jobs, at most workers at a time, each as soon as all its nodes are ready.  A dry run only logs
+        the commands, in an order that respects the dependencies.
+
+        The tags of the exposures of a job are read again once it exits, to find the nodes it finished.
+
+        :return: lists of the names of the jobs that finished, failed and never became ready.
+        """
+        self.link()
+        pending = self.pending()
+        finished = []
+        failed = []
+        running = set()
+        done = queue.Queue()
+        pool = ThreadPool(workers)
+        try:
+            while True:
+                waiting = set([job.name for job in pending]) | running
+                for job in list(pending):
+                    # a dry run does not change any status, so follow the graph rather than the nodes.
+                    if (dry_run and len(job.parents & waiting) == 0) or (not dry_run and job.ready):
+                        pending.remove(job)
+                        running.add(job.name)
+                        pool.apply_async(execute, (job, dry_run), callback=done.put)
+                if len(running) == 0:
+                    break
+                name, exit_code = done.get()
+                running.remove(name)
+                job = self.jobs[name]
+                if not dry_run:
+                    self.load_statuses(workers, job.expnums)
+                if dry_run or job.finished:
+                    finished.append(name)
+                else:
+                    logging.error("{} exited with {} and has unfinished nodes".format(name, exit_code))
+                    failed.append(name)
+        finally:
+            pool.close()
+            pool.join()
+        blocked = [job.name for job in pending]
+        if len(blocked) > 0:
+            logging.warning("{} jobs not run as their dependencies did not finish".format(len(blocked)))
+        return finished, failed, blocked
+
+    def write_dag(self, filename, submit=SUBMIT_FILENAME):
+        """
+        Write the pending jobs as a Condor DAGMan file, and the submit description they share.
+
+        :return: number of jobs written.
+        """
+        self.link()
+        pending = self.pending()
+        names = set([job.name for job in pending])
+        submit_filename = os.path.join(os.path.dirname(filename), submit)
+        if not os.access(submit_filename, os.F_OK):
+            with open(submit_filename, 'w') as fobj:
+                fobj.write(SUBMIT)
+        with open(filename, 'w') as fobj:
+            for job in pending:
+                fobj.write("JOB {} {}\n".format(job.name, submit))
+                fobj.write('VARS {} job="{}" executable="{}" arguments="{}"\n'.format(
+                    job.name, job.name, job.task, " ".join(job.command[1:])))
+            for job in pending:
+                parents = sorted(job.parents & names)
+                if len(parents) > 0:
+                    fobj.write("PARENT {} CHILD {}\n".format(" ".join(parents), job.name))
+        return len(pending)
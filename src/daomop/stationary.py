@@ -1,19 +1,26 @@
 """Mark the stationary sources in a given source catalog by matching with other source catalogs"""
 import sys
 import errno
+import metrics
 import storage
 import util
-from astropy.io import fits
-from astropy.coordinates import SkyCoord
-from astropy.table import vstack
+import vospace
+import itertools
 import numpy
 import argparse
 import logging
 import traceback
 from cadcutils.exceptions import NotFoundException
+from scipy.spatial import cKDTree
 
 task = "stationary"
 dependency = None
+# sources closer than this, in degrees, are the same source.
+MATCH_TOLERANCE = 0.5 / 3600.0
+# catalogs are only matched against those taken at least this long, in days, before or after.
+MINIMUM_TIME = 2.0 / 24.0
+# largest number of CCD catalogs held in memory by match_healpix.
+MAX_WORKING_SET = 100
 
 
 def run(pixel, expnum, ccd, prefix, version, dry_run, force):
@@ -44,8 +51,10 @@ def run(pixel, expnum, ccd, prefix, version, dry_run, force):
             logging.info("Getting fits image from VOSpace")
 
             logging.info("Running match on %s %d" % (expnum, ccd))
-            catalog = match(pixel, expnum, ccd)
-            split_to_hpx(pixel, catalog)
+            with metrics.timer('match'):
+                catalog = match(pixel, expnum, ccd)
+            with metrics.timer('split_to_hpx'):
+                split_to_hpx(pixel, catalog)
 
             if dry_run:
                 return
@@ -61,7 +70,12 @@ def run(pixel, expnum, ccd, prefix, version, dry_run, force):
         storage.set_status(task, prefix, expnum, version, ccd=ccd, status=message)
 
 
-def split_to_hpx(pixel, catalog):
+def split_to_hpx(pixel, catalog, hpx_catalogs=None):
+    """
+    Append the sources of catalog that are in the healpix to the catalogs of its partitions.
+
+    :param hpx_catalogs: dict of the HPXCatalog of each partition already loaded, see match_partitions.
+    """
 
     dataset_name = "{}{}{}".format(catalog.observation.dataset_name, catalog.version, catalog.ccd)
     image = storage.Image(catalog.observation, ccd=catalog.ccd, version=catalog.version)
@@ -69,116 +83,324 @@ def split_to_hpx(pixel, catalog):
     catalog.table['mid_mjdate'] = image.header['MJDATE'] + image.header['EXPTIME']/24./3600.0
     catalog.table['exptime'] = image.header['EXPTIME']
 
-    pix = pixel
-    try:
-        healpix_catalog = storage.HPXCatalog(pixel=pix)
-        healpix_catalog.get()
-        healpix_catalog.table = healpix_catalog.table[healpix_catalog.table['dataset_name'] != dataset_name]
-        healpix_catalog.table = vstack([healpix_catalog.table, catalog.table[catalog.table['HEALPIX'] == pix]])
-    except NotFoundException:
-        healpix_catalog = storage.HPXCatalog(pixel=pix)
-        healpix_catalog.hdulist = fits.HDUList()
-        healpix_catalog.hdulist.append(catalog.hdulist[0])
-        healpix_catalog.table = catalog.table[catalog.table['HEALPIX'] == pix]
-    healpix_catalog.write()
-    healpix_catalog.put()
+    if hpx_catalogs is None:
+        hpx_catalogs = {}
+    partitions = storage.HPXPartitions(pixel)
+    leaf = partitions.assign(catalog.table['X_WORLD'], catalog.table['Y_WORLD'])
+    for idx in numpy.unique(leaf[leaf >= 0]):
+        hpx_cat = hpx_catalogs.get(partitions.leaves[idx], None)
+        if hpx_cat is None:
+            hpx_cat = partitions.catalog(partitions.leaves[idx])
+        hpx_cat.append(catalog.table[leaf == idx], dataset_name, header=catalog.hdulist[0].header)
 
 
-def match(pixel, expnum, ccd):
+def trim(table, datasec):
+    """
+    Select the sources that are inside the data section, have a PSF magnitude and are not smaller than the bright
+    stars (cosmic rays and hot pixels).
+
+    :param table: the source catalog of a CCD.
+    :param datasec: [x1, x2, y1, y2] data section of the CCD.
+    :return: the selected rows of table.
+    """
+    npts = numpy.sum([table['MAGERR_AUTO'] < 0.002])
+    if npts < 10:
+        flux_radius_lim = 1.8
+    else:
+        flux_radius_lim = numpy.median(table['FLUX_RADIUS'][table['MAGERR_AUTO'] < 0.002])
+
+    trim_condition = numpy.all((table['X_IMAGE'] > datasec[0],
+                                table['X_IMAGE'] < datasec[1],
+                                table['Y_IMAGE'] > datasec[2],
+                                table['Y_IMAGE'] < datasec[3],
+                                table['MAG_PSF'] < 99,
+                                table['FLUX_RADIUS'] > flux_radius_lim), axis=0)
+    return table[trim_condition]
+
+
+def load_catalog(expnum, ccd):
+    """
+    Retrieve the source catalog of a CCD and trim it to the sources used for matching.
 
+    :return: the trimmed catalog and the image it came from.
+    :rtype: storage.FitsTable, storage.Image
+    """
     observation = storage.Observation(expnum)
     image = storage.Image(observation, ccd=ccd)
     datasec = storage.datasec_to_list(image.header['DATASEC'])
-
     catalog = storage.FitsTable(observation, ccd=ccd, ext='.cat.fits')
-    # First match against the HPX catalogs (if they exist)
-    ra_dec = SkyCoord(catalog.table['X_WORLD'],
-                      catalog.table['Y_WORLD'],
-                      unit=('degree', 'degree'))
-    catalog.table['HEALPIX'] = util.skycoord_to_healpix(ra_dec)
+    catalog.table = trim(catalog.table, datasec)
+    return catalog, image
 
-    npts = numpy.sum([catalog.table['MAGERR_AUTO'] < 0.002])
-    if npts < 10:
-        flux_radius_lim = 1.8
-    else:
-        flux_radius_lim = numpy.median(catalog.table['FLUX_RADIUS'][catalog.table['MAGERR_AUTO'] < 0.002])
-
-    trim_condition = numpy.all((catalog.table['X_IMAGE'] > datasec[0],
-                                catalog.table['X_IMAGE'] < datasec[1],
-                                catalog.table['Y_IMAGE'] > datasec[2],
-                                catalog.table['Y_IMAGE'] < datasec[3],
-                                catalog.table['MAG_PSF'] < 99,
-                                catalog.table['FLUX_RADIUS'] > flux_radius_lim), axis=0)
-
-    catalog.table = catalog.table[trim_condition]
-    match_list = image.polygon.cone_search(runids=storage.RUNIDS,
-                                           minimum_time=2.0/24.0,
-                                           mjdate=image.header.get('MJDATE', None))
-
-    # First match against the HPX catalogs (if they exist)
-    # reshape the position vectors from the catalogues for use in match_lists
+
+def neighbours(expnum, ccd):
+    """
+    The CCDs, taken at least MINIMUM_TIME before or after the given CCD, whose catalogs it is matched against.
+
+    :return: list of (expnum, ccd)
+    """
+    image = storage.Image(storage.Observation(expnum), ccd=ccd)
+    return [(str(overlap[0]), int(overlap[1])) for overlap in image.polygon.cone_search(
+        runids=storage.RUNIDS, minimum_time=MINIMUM_TIME, mjdate=image.header.get('MJDATE', None))]
+
+
+class WorkingSet(object):
+    """
+    The trimmed catalogs of a group of CCDs, each retrieved once, and a single spatial index of all their sources.
+
+    Catalogs are loaded as the group grows and dropped as soon as they are no longer part of it, so the memory
+    used depends on the size of the group and not on how many CCDs are processed.
+    """
+
+    def __init__(self):
+        self.catalogs = {}
+        self.polygons = {}
+        self.loads = 0
+        self._tree = None
+        self._keys = None
+        self._owner = None
+        self._xyz = None
+
+    def load(self, keys):
+        """
+        Make the working set the catalogs of keys, retrieving those not already held and dropping the others.
+
+        A catalog that does not exist is held as None.
+
+        :param keys: list of (expnum, ccd)
+        """
+        keys = set(keys)
+        for key in list(self.catalogs):
+            if key not in keys:
+                del self.catalogs[key]
+                self.polygons.pop(key, None)
+                self._tree = None
+        for key in sorted(keys):
+            if key in self.catalogs:
+                continue
+            self._tree = None
+            self.loads += 1
+            try:
+                catalog, image = load_catalog(*key)
+                self.catalogs[key] = catalog
+                self.polygons[key] = image.polygon
+            except NotFoundException:
+                logging.info("no catalog for {}p{:02d}".format(*key))
+                self.catalogs[key] = None
+
+    def catalog(self, key):
+        """
+        :rtype: storage.FitsTable
+        """
+        catalog = self.catalogs.get(key, None)
+        if catalog is None:
+            raise NotFoundException("No catalog for {}p{:02d}".format(*key))
+        return catalog
+
+    def index(self):
+        """
+        The k-d tree of the unit vectors of every source in the working set, built when the set has changed.
+        """
+        if self._tree is None:
+            self._keys = sorted([key for key in self.catalogs if self.catalogs[key] is not None])
+            positions = [numpy.transpose((self.catalogs[key].table['X_WORLD'], self.catalogs[key].table['Y_WORLD']))
+                         for key in self._keys]
+            if len(positions) == 0:
+                positions = [numpy.zeros((0, 2))]
+            self._owner = numpy.repeat(numpy.arange(len(self._keys)), [len(position) for position in positions])
+            self._xyz = util.unit_vectors(numpy.concatenate(positions).astype(numpy.float64))
+            self._tree = cKDTree(self._xyz)
+        return self._tree
+
+    def count_matches(self, key, matches_against, tolerance=MATCH_TOLERANCE):
+        """
+        Set the MATCHES and OVERLAPS columns of the catalog of key.
+
+        MATCHES counts the catalogs of matches_against that have a source matching each source, the pairing is that of
+        util.match_lists, OVERLAPS counts the catalogs whose footprint holds the source.  All the catalogs are
+        searched with one query of the working set index.
+
+        :param key: (expnum, ccd) of the catalog.
+        :param matches_against: list of the (expnum, ccd) to match with, those without a catalog are skipped.
+        :param tolerance: match distance, in degrees.
+        """
+        table = self.catalog(key).table
+        matches_against = [other for other in matches_against if self.catalogs.get(other, None) is not None]
+        matches = numpy.zeros(len(table), dtype=numpy.int64)
+        overlaps = numpy.zeros(len(table), dtype=numpy.int64)
+        for other in matches_against:
+            overlaps += self.polygons[other].contains_points(table['X_WORLD'], table['Y_WORLD'])
+
+        if len(matches_against) > 0 and len(table) > 0:
+            tree = self.index()
+            wanted = numpy.zeros(len(self._keys), dtype=bool)
+            wanted[[self._keys.index(other) for other in matches_against]] = True
+            xyz = util.unit_vectors(numpy.transpose((table['X_WORLD'], table['Y_WORLD'])).astype(numpy.float64))
+            balls = tree.query_ball_point(xyz, 2 * numpy.sin(numpy.radians(tolerance) / 2.0))
+            counts = [len(ball) for ball in balls]
+            source = numpy.repeat(numpy.arange(len(table)), counts)
+            candidate = numpy.fromiter(itertools.chain.from_iterable(balls), dtype=numpy.int64, count=sum(counts))
+            keep = wanted[self._owner[candidate]]
+            source = source[keep]
+            candidate = candidate[keep]
+            distance = numpy.sqrt(((xyz[source] - self._xyz[candidate]) ** 2).sum(axis=1))
+            order = numpy.lexsort((candidate, source, distance))
+            source = source[order]
+            candidate = candidate[order]
+            # closest pairs first: the first pair of each (source, catalog) is the source's nearest member of that
+            # catalog, the first pair of each candidate is the candidate's nearest source, a match is both.
+            nearest_candidate = numpy.unique(source * len(self._keys) + self._owner[candidate], return_index=True)[1]
+            nearest_source = numpy.unique(candidate, return_index=True)[1]
+            mutual = numpy.intersect1d(nearest_candidate, nearest_source)
+            matches = numpy.bincount(source[mutual], minlength=len(table))
+
+        table['MATCHES'] = matches
+        table['OVERLAPS'] = overlaps
+
+
+def match_partitions(pixel, catalog, hpx_catalogs=None):
+    """
+    Set the HEALPIX and HPXID columns of catalog by matching against the catalogs of the partitions of the healpix.
+
+    One partition is loaded at a time, so only a bounded number of rows is ever held.  HPXID is unique within a
+    partition, sources not already in the partition are given new ids.
+
+    :param hpx_catalogs: dict of the HPXCatalog of each partition, those loaded here are added to it.
+    """
+    catalog.table['HEALPIX'] = util.radec_to_healpix(catalog.table['X_WORLD'], catalog.table['Y_WORLD'])
     p1 = numpy.transpose((catalog.table['X_WORLD'],
                           catalog.table['Y_WORLD']))
 
-    # Build the HPXID column by matching against the HPX catalogs that might exit.
+    if hpx_catalogs is None:
+        hpx_catalogs = {}
     catalog.table['HPXID'] = -1
-    healpix = pixel
-
-    hpx_cat = storage.HPXCatalog(pixel=healpix)
-    hpx_cat_len = 0
-    try:
-        hpx_cat.get()
-        p2 = numpy.transpose((hpx_cat.table['X_WORLD'],
-                              hpx_cat.table['Y_WORLD']))
-        idx1, idx2 = util.match_lists(p1, p2, tolerance=0.5 / 3600.0)
-        catalog.table['HPXID'][idx2.data[~idx2.mask]] = hpx_cat.table['HPXID'][~idx2.mask]
-        hpx_cat_len = len(hpx_cat.table)
-    except NotFoundException:
-        pass
-
-    # for all non-matched sources in this healpix we increment the counter.
-    cond = numpy.all((catalog.table['HPXID'] < 0,
-                      catalog.table['HEALPIX'] == healpix), axis=0)
-    catalog.table['HPXID'][cond] = [hpx_cat_len + numpy.arange(cond.sum()), ]
-
-    catalog.table['MATCHES'] = 0
-    catalog.table['OVERLAPS'] = 0
-    for match_set in match_list:
-        logging.info("trying to match against catalog {}p{:02d}.cat.fits".format(match_set[0], match_set[1]))
+    partitions = storage.HPXPartitions(pixel)
+    leaf = partitions.assign(catalog.table['X_WORLD'], catalog.table['Y_WORLD'])
+    for idx in numpy.unique(leaf[leaf >= 0]):
+        rows = numpy.flatnonzero(leaf == idx)
+        hpx_cat = hpx_catalogs.setdefault(partitions.leaves[idx], partitions.catalog(partitions.leaves[idx]))
+        next_hpxid = 0
         try:
-            match_catalog = storage.FitsTable(storage.Observation(match_set[0]), ccd=match_set[1], ext='.cat.fits')
-            match_image = storage.Image(storage.Observation(match_set[0]), ccd=match_set[1])
-            datasec = storage.datasec_to_list(match_image.header['DATASEC'])
-
-            npts = numpy.sum([match_catalog.table['MAGERR_AUTO'] < 0.002])
-            if npts < 10:
-                flux_radius_lim = 1.8
-            else:
-                flux_radius_lim = numpy.median(
-                    match_catalog.table['FLUX_RADIUS'][match_catalog.table['MAGERR_AUTO'] < 0.002])
-                
-            trim_condition = numpy.all((match_catalog.table['X_IMAGE'] > datasec[0],
-                                        match_catalog.table['X_IMAGE'] < datasec[1],
-                                        match_catalog.table['Y_IMAGE'] > datasec[2],
-                                        match_catalog.table['Y_IMAGE'] < datasec[3],
-                                        match_catalog.table['MAG_PSF'] < 99,
-                                        match_catalog.table['FLUX_RADIUS'] > flux_radius_lim), axis=0)
-
-            match_catalog.table = match_catalog.table[trim_condition]
-
-            # reshape the position vectors from the catalogues for use in match_lists
-            p2 = numpy.transpose((match_catalog.table['X_WORLD'],
-                                  match_catalog.table['Y_WORLD']))
-            idx1, idx2 = util.match_lists(p1, p2, tolerance=0.5/3600.0)
-            catalog.table['MATCHES'][idx2.data[~idx2.mask]] += 1
-            catalog.table['OVERLAPS'] += \
-                [match_image.polygon.isInside(row['X_WORLD'], row['Y_WORLD']) for row in catalog.table]
+            p2 = numpy.transpose((hpx_cat.table['X_WORLD'],
+                                  hpx_cat.table['Y_WORLD']))
+            idx1, idx2 = util.match_lists(p1[rows], p2, tolerance=MATCH_TOLERANCE, spherical=True)
+            catalog.table['HPXID'][rows[idx2.data[~idx2.mask]]] = hpx_cat.table['HPXID'][~idx2.mask]
+            if len(hpx_cat.table) > 0:
+                next_hpxid = hpx_cat.table['HPXID'].max() + 1
         except NotFoundException:
             pass
 
+        # for all non-matched sources in this partition we increment the counter.
+        rows = rows[catalog.table['HPXID'][rows] < 0]
+        catalog.table['HPXID'][rows] = next_hpxid + numpy.arange(len(rows))
+
+
+def match(pixel, expnum, ccd):
+    """
+    Match the sources of a CCD against the healpix catalog and the catalogs of the CCDs that overlap it.
+
+    :return: the trimmed catalog of the CCD with HPXID, MATCHES and OVERLAPS columns.
+    :rtype: storage.FitsTable
+    """
+    key = (str(expnum), int(ccd))
+    matches_against = neighbours(*key)
+    working_set = WorkingSet()
+    working_set.load([key] + matches_against)
+    catalog = working_set.catalog(key)
+    match_partitions(pixel, catalog)
+    working_set.count_matches(key, matches_against)
     return catalog
 
 
+def batches(targets, matches_against, max_catalogs=MAX_WORKING_SET):
+    """
+    Group the CCDs to process so that each group, with the CCDs it is matched against, needs at most max_catalogs
+    catalogs.  Consecutive CCDs share most of their neighbours, so groups are built in the order given.
+
+    :param targets: list of (expnum, ccd)
+    :param matches_against: dict of the list of (expnum, ccd) that each target is matched against.
+    :return: list of (targets, catalogs) pairs.
+    """
+    groups = []
+    group = []
+    needed = set()
+    for target in targets:
+        wanted = set([target] + matches_against.get(target, []))
+        if len(group) > 0 and len(needed | wanted) > max_catalogs:
+            groups.append((group, needed))
+            group = []
+            needed = set()
+        group.append(target)
+        needed |= wanted
+    if len(group) > 0:
+        groups.append((group, needed))
+    return groups
+
+
+def match_healpix(pixel, overlaps, prefix, version, dry_run, force, max_catalogs=MAX_WORKING_SET):
+    """
+    Run the stationary task on each of the CCDs that overlap a healpix.
+
+    The CCDs are processed in groups.  The catalogs of a group and of the CCDs they are matched against are each
+    retrieved and trimmed once, and one spatial index of them all answers the matching of every CCD of the group.
+    Catalogs not needed by the next group are dropped, so at most max_catalogs catalogs are held at a time.
+
+    :param pixel: the healpix being built.
+    :param overlaps: list of (expnum, ccd) of the CCDs that overlap the healpix.
+    :return: the WorkingSet used, for its statistics.
+    """
+    targets = []
+    for expnum, ccd in overlaps:
+        key = (str(expnum), int(ccd))
+        if storage.get_status(task, prefix, key[0], version=version, ccd=key[1]) and not force:
+            logging.info("{} completed successfully for {} {} {} {}".format(task, prefix, key[0], version, key[1]))
+            continue
+        targets.append(key)
+
+    matches_against = {}
+    errors = {}
+    for target in targets:
+        try:
+            matches_against[target] = neighbours(*target)
+        except Exception as ex:
+            logging.debug(traceback.format_exc())
+            errors[target] = ex
+
+    working_set = WorkingSet()
+    hpx_catalogs = {}
+    for group, needed in batches(targets, matches_against, max_catalogs=max_catalogs):
+        with metrics.timer('load_catalogs'):
+            working_set.load(needed)
+        # the healpix partitions are loaded once per group, and kept current as the group appends to them.
+        hpx_catalogs.clear()
+        for expnum, ccd in group:
+            message = storage.SUCCESS
+            with storage.LoggingManager(task, str(expnum), expnum, ccd, version, dry_run):
+                try:
+                    if (expnum, ccd) in errors:
+                        raise errors[(expnum, ccd)]
+                    if dependency is not None and not storage.get_status(dependency, prefix, expnum, "p", ccd=ccd):
+                        raise IOError("{} not yet run for {}".format(dependency, expnum))
+                    logging.info("Running match on %s %d" % (expnum, ccd))
+                    catalog = working_set.catalog((expnum, ccd))
+                    with metrics.timer('match'):
+                        match_partitions(pixel, catalog, hpx_catalogs)
+                        working_set.count_matches((expnum, ccd), matches_against[(expnum, ccd)])
+                    with metrics.timer('split_to_hpx'):
+                        split_to_hpx(pixel, catalog, hpx_catalogs)
+                    if dry_run:
+                        continue
+                    logging.info(message)
+                except Exception as e:
+                    logging.debug(traceback.format_exc())
+                    logging.debug(type(e))
+                    message = str(e)
+                    logging.error(message)
+            storage.set_status(task, prefix, expnum, version, ccd=ccd, status=message)
+    logging.info("matched {} CCDs of healpix {} loading {} catalogs".format(len(targets), pixel, working_set.loads))
+    return working_set
+
+
 def main():
     parser = argparse.ArgumentParser(
         description='Create a matches column in a source catalog to determine if a source is a stationary object.')
@@ -191,16 +413,36 @@ def main():
                         action="store",
                         default="catalogs",
                         help='dbimages subdirectory where catalogs will be stored.')
+    parser.add_argument("--footprint-index",
+                        action="store",
+                        default=storage.FOOTPRINT_INDEX,
+                        help="local footprint index (SQLite) used to answer overlap searches, "
+                             "only new exposures are looked up in the archive.")
     parser.add_argument("healpix",
                         type=int,
                         help="healpix to process")
     parser.add_argument("--dry-run",
                         action="store_true",
                         help="DRY RUN, don't copy results to VOSpace, implies --force")
+    parser.add_argument("--compact",
+                        action="store_true",
+                        help="merge the catalog partitions of the healpix once all the CCDs are processed")
+    parser.add_argument("--max-rows",
+                        type=int,
+                        default=storage.HPX_MAX_ROWS,
+                        help="with --compact, split healpix catalogs with more rows than this into NESTED children")
+    parser.add_argument("--max-catalogs",
+                        type=int,
+                        default=MAX_WORKING_SET,
+                        help="most CCD catalogs to hold in memory at once while matching")
+    parser.add_argument("--refresh",
+                        action="store_true",
+                        help="re-run TAP queries even if their results are in the query cache")
     parser.add_argument("--verbose", "-v",
                         action="store_true")
     parser.add_argument("--force", default=False,
                         action="store_true")
+    vospace.add_trace_argument(parser)
     parser.add_argument("--debug", "-d",
                         action="store_true")
 
@@ -208,19 +450,25 @@ def main():
     args = parser.parse_args()
 
     util.set_logger(args)
+    metrics.start(task)
+    if args.trace_vos:
+        vospace.enable_tracing()
     logging.info("Started {}".format(cmd_line))
 
     storage.DBIMAGES = args.dbimages
     storage.CATALOG = args.catalogs
+    storage.FOOTPRINT_INDEX = args.footprint_index
+    storage.REFRESH_QUERIES = args.refresh
     prefix = ''
     version = 'p'
 
     exit_code = 0
-    overlaps = storage.MyPolygon.from_healpix(args.healpix).cone_search(runids=storage.RUNIDS)
-    for overlap in overlaps:
-        expnum = overlap[0]
-        ccd = overlap[1]
-        run(args.healpix, expnum, ccd, prefix, version, args.dry_run, args.force)
+    overlaps = storage.healpix_overlaps(args.healpix, runids=storage.RUNIDS)
+    with storage.buffered_tags():
+        match_healpix(args.healpix, overlaps, prefix, version, args.dry_run, args.force,
+                      max_catalogs=args.max_catalogs)
+    if args.compact and not args.dry_run:
+        storage.HPXPartitions(args.healpix).compact(max_rows=args.max_rows)
     return exit_code
 
 
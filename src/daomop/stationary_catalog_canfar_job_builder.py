@@ -1,6 +1,7 @@
 """
 Build an input file to be run via calling condor on canfar.
 """
+import argparse
 import storage
 import sys
 import os
@@ -24,7 +25,7 @@ getCert
 
 echo "Building Catalog ",$1
 
-stattionary $1 --verbose --catalogs catalogs_20170527
+stationary $1 --verbose --catalogs catalogs_20170527
 
 """)
 
@@ -50,6 +51,12 @@ Executable = {}
 
 def main():
     """Build the stationary catalog builder job submission script."""
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--refresh",
+                        action="store_true",
+                        help="re-run the exposure list TAP query even if its result is in the query cache")
+    args = parser.parse_args()
+    storage.REFRESH_QUERIES = args.refresh
 
     _create_shell_script(_COMMAND_FILENAME)
     with open('job.in', 'w') as job:
@@ -65,7 +72,7 @@ def main():
 
             for param in params:
                 job.write("{} = {}\n".format(param, params[param]))
-            job.write("Qeueu\n\n")
+            job.write("Queue\n\n")
 
 
 if __name__ == '__main__':
@@ -1,23 +1,38 @@
 """OSSOS VOSpace storage convenience package."""
+import datetime
 import logging
 import errno
+import io
+import json
+import mmap
+import multiprocessing.util
 import os
+import socket
+import threading
 import urllib
 import re
-import tempfile
+import time
+from contextlib import contextmanager
+from distutils.version import LooseVersion
 import Polygon
 import numpy
+import astropy
 import requests
 from astropy.coordinates import SkyCoord
 from astropy import units
-from astropy.table import Table
+from astropy.table import Table, vstack
 from astropy.io import fits, ascii
-from astropy.time import Time
-from cadcutils.exceptions import BadRequestException, AlreadyExistsException
+from requests.exceptions import RequestException
+from cadcutils.exceptions import BadRequestException, AlreadyExistsException, NotFoundException
 
+import cache
+import footprint
+import metrics
+import transfer
 import util
 import vospace
-from wcs import WCS
+import webservice
+from wcs import WCS, Distortion
 
 # Try and turn off warnings, only works for some releases of requests.
 try:
@@ -29,6 +44,12 @@ except:
 
 VOS_PROTOCOL = 'vos:'
 MAX_RETRY = 10
+# size of the chunks responses are streamed in.
+CHUNK_SIZE = 512 * 1024
+# a URI that ends with the extension of the file it refers to, eg. the uri of a CCD Image.
+EXTENSION_PATTERN = re.compile(r'^(?P<uri>.*?)(?P<extension>\[\d+\])$')
+# HDUList.fromstring can not parse a buffer before astropy 3.0, there in-memory files are opened as file objects.
+FITS_FROMSTRING = LooseVersion(astropy.__version__) >= LooseVersion('3.0')
 MAXCOUNT = 30000
 _TARGET = "TARGET"
 SSOIS_SERVER = "http://www.cadc-ccda.hia-iha.nrc-cnrc.gc.ca/cadcbin/ssos/fixedssos.pl"
@@ -45,6 +66,10 @@ PSF_EXT = "psf.fits"
 HEADER_EXT = ".head"
 IMAGE_EXT = '.fits.fz'
 TEXT_EXT = ".txt"
+MANIFEST_EXT = ".manifest"
+PARTITIONS_EXT = ".partitions"
+LOG_SEGMENTS_SUFFIX = "_parts"
+METRICS_SUFFIX = "_metrics"
 PROCESSED_VERSION = 'p'
 RAW_VERSION = 'o'
 RUNIDS = ['%P30', '%P31']
@@ -55,6 +80,33 @@ FLATS_VOSPACE = 'vos:sgwyn/flats'
 ARCHIVE = 'CFHT'
 DEFAULT_FORMAT = 'fits'
 NSIDE = 32
+FOOTPRINT_INDEX = os.environ.get(footprint.FOOTPRINT_INDEX_ENV, None)
+_footprint_index = None
+# healpix are synced with the archive from this long before the last sync, see sync_footprint_index.
+SYNC_MARGIN = datetime.timedelta(days=1)
+TAG_CACHE_TTL = 30
+# seconds the MD5 of a node is used to look up the artifact cache before it is fetched again, see _node_checksum.
+CHECKSUM_CACHE_TTL = 60
+# write the log of each task run as a segment shipped in the background, DAOMOP_LOG_SEGMENTS=0 appends to one file.
+LOG_SEGMENTS_ENV = 'DAOMOP_LOG_SEGMENTS'
+LOG_SEGMENTS = os.environ.get(LOG_SEGMENTS_ENV, '1') != '0'
+# log uploads are waited for before the pools are shut down at exit, they finalize at priority 15.
+LOG_UPLOAD_EXIT_PRIORITY = 20
+_artifact_cache = None
+_transfer_engine = None
+_log_uploads = []
+_log_uploads_lock = threading.Lock()
+_log_uploads_pid = None
+# set REFRESH_QUERIES to re-run TAP queries whose results are in the query cache.
+REFRESH_QUERIES = False
+# a healpix catalog with more rows than this is split into its NESTED children when compacted.
+HPX_MAX_ROWS_ENV = 'DAOMOP_HPX_MAX_ROWS'
+HPX_MAX_ROWS = int(os.environ.get(HPX_MAX_ROWS_ENV, 1000000))
+_query_cache = None
+_tag_cache = {}
+_tag_buffer = None
+_checksum_cache = {}
+_checksum_cache_lock = threading.Lock()
 
 
 class MyRequests(object):
@@ -64,9 +116,7 @@ class MyRequests(object):
         self.requests = requests
 
     def get(self, *args, **kwargs):
-        resp = self.requests.get(*args, **kwargs)
-        resp.raise_for_status()
-        return resp
+        return webservice.get(*args, **kwargs)
 
 
 requests = MyRequests()
@@ -75,6 +125,8 @@ requests = MyRequests()
 class Task(object):
     """
     A task within the OSSOS pipeline work-flow.
+
+    Once its target is set a Task is one node of the pipeline graph, see scheduler.Graph.
     """
 
     def __init__(self, executable, dependency=None):
@@ -94,23 +146,20 @@ class Task(object):
         Get the string representation of the tag used to annotate the status in VOSpace.
         @return: str
         """
-        return "{}{}_{}{:02d}".format(self.target.prefix,
-                                      self,
-                                      self.target.version,
-                                      self.target.ccd)
+        return get_process_tag(self.target.prefix + self.name, self.target.ccd, self.target.version)
 
     @property
     def target(self):
         """
 
         @return: The target that this task is set to run on.
-        @rtype: Target
+        @rtype: Artifact
         """
         return self._target
 
     @target.setter
     def target(self, target):
-        assert isinstance(Artifact, target)
+        assert isinstance(target, Artifact)
         self._target = target
 
     @property
@@ -118,14 +167,16 @@ class Task(object):
         """
         @rtype: Task
         """
-        raise NotImplementedError()
+        return self._dependency
 
     @dependency.setter
     def dependency(self, dependency):
-        if dependency is None:
-            self._dependency = dependency
-        else:
-            assert isinstance(Task, dependency)
+        assert dependency is None or isinstance(dependency, Task)
+        self._dependency = dependency
+
+    @property
+    def expnum(self):
+        return self.target.observation.dataset_name
 
     @property
     def status(self):
@@ -134,19 +185,19 @@ class Task(object):
         @return: The status of running this task on the given target.
         @rtype: str
         """
-        return get_tag(self.target.expnum, self.tag)
+        return get_tag(self.expnum, self.tag)
 
     @status.setter
     def status(self, status):
-        status += Time.now().iso
-        set_tag(self.target.expnum, self.tag, status)
+        set_tag(self.expnum, self.tag, status)
 
     @property
     def finished(self):
         """
         @rtype: bool
         """
-        return self.status.startswith(SUCCESS)
+        status = self.status
+        return status is not None and status.startswith(SUCCESS)
 
     @property
     def ready(self):
@@ -178,7 +229,91 @@ class MyPolygon(Polygon.Polygon):
         corners = util.healpix_to_corners(healpix, nside)
         return cls.from_footprint(corners)
 
-    def cone_search(self, runids=None, mjdate=None, minimum_time=None):
+    def contains_points(self, ra, dec):
+        """
+        Vectorized point-in-polygon test, the array equivalent of isInside.
+
+        Each contour is unwrapped about its first vertex, as are the points, so footprints that straddle RA=0/360
+        are handled.  A point is inside if it is inside any solid contour and not inside any hole.
+
+        :param ra: array of RA values, degrees
+        :param dec: array of DEC values, degrees
+        :return: boolean mask, True where (ra, dec) is inside the polygon.
+        :rtype: numpy.ndarray
+        """
+        ra = numpy.asarray(ra, dtype=numpy.float64)
+        dec = numpy.asarray(dec, dtype=numpy.float64)
+        inside = numpy.zeros(ra.shape, dtype=bool)
+        in_hole = numpy.zeros(ra.shape, dtype=bool)
+
+        for idx in range(len(self)):
+            contour = numpy.array(self.contour(idx), dtype=numpy.float64)
+            reference = contour[0][0]
+            x = reference + (contour[:, 0] - reference + 180.0) % 360.0 - 180.0
+            y = contour[:, 1]
+            px = reference + (ra - reference + 180.0) % 360.0 - 180.0
+
+            # ray casting: count the edges crossed by a ray running from each point in the +RA direction.
+            crossings = numpy.zeros(ra.shape, dtype=bool)
+            with numpy.errstate(divide='ignore', invalid='ignore'):
+                for x1, y1, x2, y2 in zip(x, y, numpy.roll(x, -1), numpy.roll(y, -1)):
+                    straddles = (y1 > dec) != (y2 > dec)
+                    crossings ^= straddles & (px < (x2 - x1) * (dec - y1) / (y2 - y1) + x1)
+
+            if self.isHole(idx):
+                in_hole |= crossings
+            else:
+                inside |= crossings
+
+        return inside & ~in_hole
+
+    def cone_search(self, runids=None, mjdate=None, minimum_time=None, footprint_index=None):
+        """
+        Find the CCDs of exposures in the archive that overlap this polygon.
+
+        If a footprint index is given, or storage.FOOTPRINT_INDEX is set, the archive is only asked for the exposures
+        of the healpix under the polygon modified since they were last synced, see sync_footprint_index, and the
+        overlap is computed from the index.
+
+        :param runids: list of proposal ids (ADQL LIKE patterns) to restrict the search to.
+        :param mjdate: exclude exposures taken within minimum_time of mjdate.
+        :param minimum_time: days
+        :param footprint_index: footprint.FootprintIndex to use.
+        :return: list of [collectionID, ccd] pairs.
+        """
+        if footprint_index is None:
+            footprint_index = get_footprint_index()
+
+        if footprint_index is not None:
+            sync_footprint_index(util.footprints_to_healpix([self.footprint], util.HEALPIX_NSIDE)[0],
+                                 footprint_index, util.HEALPIX_NSIDE)
+            return footprint_index.search(self, runids=runids, mjdate=mjdate, minimum_time=minimum_time)
+
+        table = tap_query(self._cone_search_query(runids, mjdate, minimum_time))
+        overlaps = []
+        for collectionID in table['collectionID']:
+            try:
+                headers = Header(Observation(collectionID))
+                for header in headers.headers:
+                    if header.get('EXTVER', None) is None:
+                        continue
+                    headers.ccd = int(header['EXTVER'])
+                    logging.debug("Checking {} {} ".format(collectionID, headers.ccd))
+                    if headers.polygon.overlaps(self):
+                        logging.debug("{} {} OVERLAPS ".format(collectionID, headers.ccd))
+                        overlaps.append([collectionID, headers.ccd])
+            except Exception as ex:
+                logging.debug("ERROR processing {}: {}".format(collectionID, ex))
+                continue
+        logging.debug("Found these overlapping CCDs\n" + str(overlaps))
+        return overlaps
+
+    def _cone_search_query(self, runids=None, mjdate=None, minimum_time=None, modified_since=None):
+        """
+        Build the ADQL query for exposures that overlap this polygon.
+
+        :param modified_since: only exposures modified in the archive after this ISO time.
+        """
 
         query = (" SELECT Observation.observationID as collectionID "
                  " FROM caom2.Observation AS Observation "
@@ -203,27 +338,89 @@ class MyPolygon(Polygon.Polygon):
         if mjdate is not None:
             query += " AND ( Plane.time_bounds_lower < {} ".format(mjdate - minimum_time)
             query += " OR  Plane.time_bounds_upper > {} ) ".format(mjdate + minimum_time)
+        if modified_since is not None:
+            query += " AND Observation.maxLastModified > '{}' ".format(modified_since)
+        return query
 
-        table = tap_query(query)
-        overlaps = []
-        for collectionID in table['collectionID']:
-            try:
-                headers = Header(Observation(collectionID))
-                for header in headers.headers:
-                    if header.get('EXTVER', None) is None:
-                        continue
-                    headers.ccd = int(header['EXTVER'])
-                    logging.debug("Checking {} {} ".format(collectionID, headers.ccd))
-                    if headers.polygon.overlaps(self):
-                        logging.debug("{} {} OVERLAPS ".format(collectionID, headers.ccd))
-                        overlaps.append([collectionID, headers.ccd])
-            except Exception as ex:
-                logging.debug("ERROR processing {}: {}".format(collectionID, ex))
-                continue
-        logging.debug("Found these overlapping CCDs\n" + str(overlaps))
-        return overlaps
 
+def index_exposures(expnums, footprint_index):
+    """
+    Add the exposures that are not yet in the footprint index to it, from their MEF headers.
+
+    :return: the exposures that could not be indexed.
+    """
+    failed = []
+    for expnum in expnums:
+        if footprint_index.has_exposure(expnum):
+            continue
+        try:
+            if footprint_index.add_headers(expnum, Header(Observation(expnum)).headers) == 0:
+                failed.append(expnum)
+        except Exception as ex:
+            logging.debug("ERROR indexing {}: {}".format(expnum, ex))
+            failed.append(expnum)
+    return failed
+
+
+def sync_footprint_index(pixels, footprint_index, nside=None):
+    """
+    Bring the exposures the archive has for each healpix into the footprint index.
 
+    The first sync of a healpix lists all its exposures, later ones only those modified since, so the index learns of
+    new exposures without the archive being searched again for those it already holds.  Runid and date constraints
+    are not part of the query, the index applies them when searched.  A healpix with exposures that could not be
+    indexed is not marked as synced, so they are tried again.
+
+    :param pixels: RING ordered healpix.
+    :param footprint_index: footprint.FootprintIndex to update.
+    :param nside: of the healpix, default util.HEALPIX_NSIDE
+    """
+    if nside is None:
+        nside = util.HEALPIX_NSIDE
+    for pixel in pixels:
+        modified_since = footprint_index.synced_since([pixel], nside)
+        # a margin, as exposures can be ingested with modification times a little older than the query.
+        started = (datetime.datetime.utcnow() - SYNC_MARGIN).strftime('%Y-%m-%dT%H:%M:%S')
+        query = MyPolygon.from_healpix(pixel, nside)._cone_search_query(modified_since=modified_since)
+        expnums = [str(expnum) for expnum in tap_query(query)['collectionID']]
+        logging.debug("{} exposures of healpix {} modified since {}".format(len(expnums), pixel, modified_since))
+        footprint_index.add_archive(expnums)
+        failed = index_exposures(expnums, footprint_index)
+        if len(failed) > 0:
+            # keep the last sync time so the next sync lists these again.
+            logging.warning("Healpix {} not synced, could not index {}".format(pixel, failed))
+            continue
+        footprint_index.mark_synced([pixel], nside, started)
+
+
+def healpix_overlaps(healpix, runids=None, nside=None):
+    """
+    Find the CCDs that overlap a healpix.
+
+    With a footprint index the exposures near the healpix are brought into the index and the CCDs are looked up in its
+    inverted healpix index, otherwise this is a cone search of the healpix.
+
+    :return: list of [expnum, ccd] pairs.
+    """
+    footprint_index = get_footprint_index()
+    if footprint_index is None:
+        return MyPolygon.from_healpix(healpix, nside).cone_search(runids=runids)
+    sync_footprint_index([healpix], footprint_index, nside)
+    return footprint_index.healpix_search(healpix, nside=nside, runids=runids)
+
+
+def get_footprint_index():
+    """
+    The footprint index named by FOOTPRINT_INDEX, or None if no index is configured.
+
+    :rtype: footprint.FootprintIndex
+    """
+    global _footprint_index
+    if FOOTPRINT_INDEX is None:
+        return None
+    if _footprint_index is None or _footprint_index.filename != FOOTPRINT_INDEX:
+        _footprint_index = footprint.FootprintIndex(FOOTPRINT_INDEX)
+    return _footprint_index
 
 
 class Observation(object):
@@ -408,6 +605,7 @@ class Image(FitsArtifact):
         self._ccd = None
         self.ccd = kwargs.get('ccd', None)
         self._header = None
+        self._header_source = None
         self._wcs = None
         self._flat_field_name = None
         self._flat_field = None
@@ -443,14 +641,19 @@ class Image(FitsArtifact):
         else:
             ext = self.ccd + 1
         if self._header is None:
-            self._header = Header(self.observation, version=self.version).headers[ext]
+            self._header_source = Header(self.observation, version=self.version)
+            self._header = self._header_source.headers[ext]
         return self._header
 
     @property
     def wcs(self):
         if self._wcs is None:
             if self.ccd is not None:
-                self._wcs = WCS(self.header)
+                header = self.header
+                distortion = None
+                if self._header_source is not None:
+                    distortion = self._header_source.distortion(self.ccd + 1)
+                self._wcs = WCS(header, distortion=distortion)
             else:
                 self._wcs = [None, ]
                 for header in self.header[1:]:
@@ -539,16 +742,14 @@ class Image(FitsArtifact):
         :param return_file
         :return:
         """
-        fpt = tempfile.NamedTemporaryFile(suffix='.fits')
         try:
-            copy(self.uri + cutout, fpt.name)
+            hdu_list = read_hdulist(self.uri, cutout, scale_back=False)
         except BadRequestException as bre:
             if "No matching data" in str(bre):
                 logging.error(str(bre))
                 return []
+            raise bre
 
-        fpt.seek(0)
-        hdu_list = fits.open(fpt, scale_back=False)
         hdu_list.verify('silentfix+ignore')
         hdu_list[0].header['DATASEC'] = reset_datasec(cutout,
                                                       hdu_list[0].header['DATASEC'],
@@ -558,6 +759,7 @@ class Image(FitsArtifact):
             raise OSError(errno.EFAULT, "Failed to retrieve cutout of image", self.uri)
 
         self._header = [None]
+        self._header_source = None
         for hdu in hdu_list:
             self._header.append(hdu.header)
 
@@ -581,28 +783,405 @@ class Image(FitsArtifact):
 
 class HPXCatalog(FitsTable):
 
-    def __init__(self, pixel, version="_cat", ext=".fits", subdir="", nside=None, **kwargs):
+    def __init__(self, pixel, version="_cat", ext=".fits", subdir="", nside=None, nest=False, **kwargs):
+        """
+        :param pixel: the healpix of the catalog.
+        :param nside: nside of pixel, default is util.HEALPIX_NSIDE.
+        :param nest: pixel is NESTED ordered, the catalog is a partition of a split healpix, see HPXPartitions.
+        """
         self.pixel = pixel
         if nside is None:
             nside = util.HEALPIX_NSIDE
         self.nside = nside
+        self.nest = nest
         dbimages = os.path.join(os.path.dirname(DBIMAGES), CATALOG)
         super(HPXCatalog, self).__init__(Observation(self.dataset_name, dbimages=dbimages),
                                          version=version, ext=ext, subdir=subdir, **kwargs)
 
     @property
     def skycoord(self):
-        return util.healpix_to_skycoord(self.pixel, nside=self.nside)
+        return util.healpix_to_skycoord(self.pixel, nside=self.nside, nest=self.nest)
 
     @property
     def dataset_name(self):
         number_of_pix = 12 * self.nside ** 2
         field_size = len(str(number_of_pix))
         dataset_name = ("{" + ":0{:d}".format(field_size) + "}").format(self.pixel)
+        if self.nest:
+            dataset_name = "N{}_{}".format(self.nside, dataset_name)
         return "HPX_{}_RA_{:4.1f}_DEC_{:+4.1f}".format(dataset_name,
                                                        self.skycoord.ra.degree,
                                                        self.skycoord.dec.degree)
 
+    @property
+    def table(self):
+        """
+        The merged view of the compacted catalog and the partitions appended since, read on first access.
+
+        :return: Table of all sources in this healpix
+        :rtype: Table
+        """
+        if self._table is None:
+            self._table = self.merged_table()
+        return self._table
+
+    @table.setter
+    def table(self, table):
+        self._table = table
+
+    @property
+    def partitions_uri(self):
+        """
+        The container holding the partition files appended to this catalog since it was last compacted.
+        """
+        return "{}/{}{}_parts".format(os.path.dirname(self.uri), self.observation, self.version)
+
+    @property
+    def manifest(self):
+        """
+        The manifest lists the partition files already merged into the compacted catalog.
+
+        :rtype: Artifact
+        """
+        return HPXCatalog(self.pixel, version=self.version, ext=MANIFEST_EXT, nside=self.nside, nest=self.nest)
+
+    @staticmethod
+    def partition_dataset_name(partition):
+        """
+        The dataset_name whose rows are held in a partition file named {dataset_name}_{milliseconds}.fits
+        """
+        return partition.rsplit('_', 1)[0]
+
+    @staticmethod
+    def partition_time(partition):
+        return int(os.path.splitext(partition.rsplit('_', 1)[1])[0])
+
+    def partitions(self):
+        """
+        List the partition files appended to this catalog.
+
+        :return: list of partition filenames
+        :rtype: list
+        """
+        try:
+            return [name for name in listdir(self.partitions_uri, force=True) if name.endswith('.fits')]
+        except NotFoundException:
+            return []
+
+    def latest_partitions(self, partitions):
+        """
+        The most recent partition of each dataset_name, a dataset that was re-processed supersedes its older rows.
+
+        :return: partition filename keyed on dataset_name
+        :rtype: dict
+        """
+        latest = {}
+        for partition in sorted(partitions, key=self.partition_time):
+            latest[self.partition_dataset_name(partition)] = partition
+        return latest
+
+    def compacted_partitions(self):
+        """
+        The set of partition filenames that are already part of the compacted catalog.
+        """
+        manifest = self.manifest
+        try:
+            copy(manifest.uri, manifest.filename)
+        except NotFoundException:
+            return set()
+        return set(json.load(open(manifest.filename))['compacted'])
+
+    def get_partition(self, partition):
+        """
+        Retrieve a partition file, partitions are never modified so a local copy is always current.
+
+        :return: local filename of the partition
+        """
+        dirname = os.path.basename(self.partitions_uri)
+        if not os.access(dirname, os.F_OK):
+            os.makedirs(dirname)
+        filename = os.path.join(dirname, partition)
+        if not os.access(filename, os.F_OK):
+            copy("{}/{}".format(self.partitions_uri, partition), filename)
+        return filename
+
+    def merged_table(self, partitions=None):
+        """
+        Build the catalog from the compacted table with the rows of each newer partition replacing those of its
+        dataset_name.
+
+        :param partitions: list of partition filenames to merge, default is those currently in the container.
+        :return: the merged catalog
+        :rtype: Table
+        """
+        if partitions is None:
+            partitions = self.partitions()
+        compacted = self.compacted_partitions()
+        base = None
+        try:
+            # the compacted catalog is replaced by compact() so always fetch the current version.
+            copy(self.uri, self.filename)
+            base = Table.read(self.filename)
+        except NotFoundException:
+            pass
+
+        tables = []
+        replaced = []
+        latest = self.latest_partitions(partitions)
+        for dataset_name in sorted(latest):
+            if latest[dataset_name] in compacted:
+                continue
+            tables.append(Table.read(self.get_partition(latest[dataset_name])))
+            replaced.append(dataset_name)
+        if base is None and len(tables) == 0:
+            raise NotFoundException("No catalog or partitions for {}".format(self.uri))
+        if base is not None:
+            if len(replaced) > 0:
+                base = base[~numpy.in1d(base['dataset_name'], replaced)]
+            tables.insert(0, base)
+        if len(tables) == 1:
+            return tables[0]
+        return vstack(tables, metadata_conflicts='silent')
+
+    def append(self, table, dataset_name, header=None):
+        """
+        Add the rows of dataset_name to this catalog by writing them as a new partition file.
+
+        The cost does not depend on how many datasets are already in the catalog, and jobs appending different
+        datasets never overwrite each other.  Rows previously appended for dataset_name are superseded.
+
+        :param table: the rows to add.
+        :param dataset_name: the exposure/version/ccd the rows came from.
+        :param header: primary header to store with the rows.
+        :return: filename of the new partition.
+        """
+        partition = "{}_{:d}.fits".format(dataset_name, int(time.time() * 1000))
+        dirname = os.path.basename(self.partitions_uri)
+        if not os.access(dirname, os.F_OK):
+            os.makedirs(dirname)
+        filename = os.path.join(dirname, partition)
+        fits.HDUList([fits.PrimaryHDU(header=header), fits.table_to_hdu(table)]).writeto(filename)
+        uri = "{}/{}".format(self.partitions_uri, partition)
+        make_path(uri)
+        copy(filename, uri)
+        if self._table is not None:
+            # keep the merged view current rather than retrieving the catalog again.
+            self._table = vstack([self._table[self._table['dataset_name'] != dataset_name], table],
+                                 metadata_conflicts='silent')
+        return partition
+
+    def compact(self):
+        """
+        Merge the partition files into the compacted catalog and remove them.
+
+        The catalog is written before the manifest and partitions are only removed once both are stored, so readers
+        always see every row.  Compaction of a given healpix must not be run by two jobs at the same time.
+
+        :return: number of partitions compacted.
+        """
+        partitions = self.partitions()
+        if len(partitions) == 0:
+            return 0
+        table = self.merged_table(partitions)
+        fits.HDUList([fits.PrimaryHDU(), fits.table_to_hdu(table)]).writeto(self.filename, overwrite=True)
+        self.put()
+
+        manifest = self.manifest
+        with open(manifest.filename, 'w') as fobj:
+            json.dump({'compacted': sorted(partitions)}, fobj)
+        manifest.put()
+
+        for partition in partitions:
+            try:
+                delete("{}/{}".format(self.partitions_uri, partition))
+            except Exception as ex:
+                # the manifest records that this partition is already merged.
+                logging.warning("Failed to remove compacted partition {}: {}".format(partition, ex))
+        self._table = table
+        logging.info("Compacted {} partitions into {}".format(len(partitions), self.uri))
+        return len(partitions)
+
+
+class HPXPartitions(object):
+    """
+    The catalogs that together hold the sources of a healpix.
+
+    A dense healpix is split into its four NESTED children at twice the nside, and those again, until no catalog has
+    more than HPX_MAX_ROWS rows.  The leaves of that tree are listed in a manifest stored beside the healpix catalog,
+    a healpix that was never split has no manifest and one partition, the healpix catalog itself.
+    """
+
+    def __init__(self, pixel, version="_cat", nside=None):
+        """
+        :param pixel: the RING ordered healpix.
+        :param nside: nside of pixel, default is util.HEALPIX_NSIDE.
+        """
+        if nside is None:
+            nside = util.HEALPIX_NSIDE
+        self.pixel = pixel
+        self.nside = nside
+        self.version = version
+        self._leaves = None
+
+    @property
+    def root(self):
+        """
+        The (nside, NESTED healpix) of the whole healpix.
+        """
+        return self.nside, int(util.ring_to_nest(self.pixel, self.nside))
+
+    @property
+    def manifest(self):
+        """
+        The list of the partitions of a split healpix.
+
+        :rtype: Artifact
+        """
+        return HPXCatalog(self.pixel, version=self.version, ext=PARTITIONS_EXT, nside=self.nside)
+
+    @property
+    def leaves(self):
+        """
+        The (nside, NESTED healpix) of each partition, read from the manifest on first access.
+
+        :rtype: list
+        """
+        if self._leaves is None:
+            manifest = self.manifest
+            try:
+                # the manifest is replaced when a partition is split so always fetch the current version.
+                copy(manifest.uri, manifest.filename)
+                self._leaves = [tuple(leaf) for leaf in json.load(open(manifest.filename))['leaves']]
+            except NotFoundException:
+                self._leaves = [self.root]
+        return self._leaves
+
+    def catalog(self, leaf):
+        """
+        The catalog of one of the partitions, an unsplit healpix keeps its RING ordered catalog.
+
+        :param leaf: (nside, NESTED healpix) of the partition.
+        :rtype: HPXCatalog
+        """
+        if tuple(leaf) == self.root:
+            return HPXCatalog(self.pixel, version=self.version, nside=self.nside)
+        return HPXCatalog(leaf[1], version=self.version, nside=leaf[0], nest=True)
+
+    def catalogs(self):
+        """
+        The catalog of each partition, in the order of leaves.
+        """
+        return [self.catalog(leaf) for leaf in self.leaves]
+
+    def assign(self, ra, dec):
+        """
+        Find the partition that holds each of a list of positions.
+
+        :param ra: array of RA, in degrees.
+        :param dec: array of DEC, in degrees.
+        :return: index into leaves of the partition of each position, -1 for positions outside the healpix.
+        :rtype: numpy.ndarray
+        """
+        ra = numpy.asarray(ra, dtype=numpy.float64)
+        result = numpy.zeros(ra.shape, dtype=numpy.int64) - 1
+        leaves = numpy.array(self.leaves, dtype=numpy.int64)
+        for nside in numpy.unique(leaves[:, 0]):
+            level = numpy.flatnonzero(leaves[:, 0] == nside)
+            level = level[numpy.argsort(leaves[level, 1])]
+            pixels = leaves[level, 1]
+            healpix = util.radec_to_healpix(ra, dec, nside=nside, nest=True)
+            idx = numpy.clip(numpy.searchsorted(pixels, healpix), 0, len(pixels) - 1)
+            found = pixels[idx] == healpix
+            result[found] = level[idx[found]]
+        return result
+
+    def overlapping(self, corners):
+        """
+        Find the partitions that a footprint touches.
+
+        :param corners: array of shape (m, 2) of the (ra, dec) corners, in degrees, of a convex footprint.
+        :return: list of the (nside, NESTED healpix) partitions that overlap the footprint.
+        """
+        overlaps = []
+        for nside in sorted(set([leaf[0] for leaf in self.leaves])):
+            pixels = set(util.footprints_to_healpix([corners], nside=nside, nest=True)[0])
+            overlaps.extend([leaf for leaf in self.leaves if leaf[0] == nside and leaf[1] in pixels])
+        return overlaps
+
+    def save(self, leaves):
+        """
+        Replace the manifest with a new list of partitions.
+        """
+        manifest = self.manifest
+        with open(manifest.filename, 'w') as fobj:
+            json.dump({'nside': self.nside, 'pixel': self.pixel, 'leaves': sorted(leaves)}, fobj)
+        manifest.put()
+        self._leaves = sorted([tuple(leaf) for leaf in leaves])
+
+    def split(self, leaf, table, max_rows, max_nside):
+        """
+        Write the rows of a partition into the catalogs of its children, splitting again any child that is still
+        too big.  Empty children get no catalog but are still partitions.
+
+        :return: list of the partitions that replace leaf.
+        """
+        nside, pixel = leaf
+        if len(table) <= max_rows or nside >= max_nside:
+            if len(table) > 0:
+                catalog = self.catalog(leaf)
+                fits.HDUList([fits.PrimaryHDU(), fits.table_to_hdu(table)]).writeto(catalog.filename, overwrite=True)
+                catalog.put()
+            return [leaf]
+        healpix = util.radec_to_healpix(table['X_WORLD'], table['Y_WORLD'], nside=2 * nside, nest=True)
+        leaves = []
+        for child in util.healpix_children(pixel):
+            leaves.extend(self.split((2 * nside, int(child)), table[healpix == child], max_rows, max_nside))
+        return leaves
+
+    def compact(self, max_rows=None, max_nside=None):
+        """
+        Compact the catalog of each partition and split those with more than max_rows rows.
+
+        The children are written before the manifest and the split catalogs are only removed once the manifest is
+        stored.  Like HPXCatalog.compact this must not be run while jobs are appending to the healpix.
+
+        :param max_rows: largest catalog to keep, default is HPX_MAX_ROWS.
+        :param max_nside: do not split partitions beyond this nside, default is util.HEALPIX_MAX_NSIDE.
+        :return: number of partitions compacted and number split.
+        """
+        if max_rows is None:
+            max_rows = HPX_MAX_ROWS
+        if max_nside is None:
+            max_nside = util.HEALPIX_MAX_NSIDE
+        leaves = []
+        split = []
+        count = 0
+        for leaf in self.leaves:
+            catalog = self.catalog(leaf)
+            try:
+                count += catalog.compact()
+                table = catalog.table
+            except NotFoundException:
+                leaves.append(leaf)
+                continue
+            if len(table) <= max_rows or leaf[0] >= max_nside:
+                leaves.append(leaf)
+                continue
+            leaves.extend(self.split(leaf, table, max_rows, max_nside))
+            split.append(catalog)
+        if len(split) == 0:
+            return count, 0
+        self.save(leaves)
+        for catalog in split:
+            try:
+                catalog.delete()
+            except Exception as ex:
+                # the manifest no longer lists the partition, so its catalog is never read.
+                logging.warning("Failed to remove split catalog {}: {}".format(catalog.uri, ex))
+        logging.info("Split {} partitions of healpix {}, now {} partitions".format(len(split), self.pixel,
+                                                                                    len(leaves)))
+        return count, len(split)
+
 
 def set_tags_on_uri(uri, keys, values=None):
     node = vospace.client.get_node(uri)
@@ -622,28 +1201,46 @@ def set_tags_on_uri(uri, keys, values=None):
 
 def _set_tags(expnum, keys, values=None):
     uri = os.path.join(DBIMAGES, str(expnum))
-    node = vospace.client.get_node(uri, force=True)
     if values is None:
         values = []
         for idx in range(len(keys)):
             values.append(None)
     assert (len(values) == len(keys))
-    for idx in range(len(keys)):
-        key = keys[idx]
-        tag = tag_uri(key)
-        value = values[idx]
-        node.props[tag] = value
-    vospace.client.add_props(node)
-    return vospace.client.get_node(uri, force=True)
+    with metrics.timer('tag_write'):
+        node = vospace.client.get_node(uri, force=True)
+        for idx in range(len(keys)):
+            key = keys[idx]
+            tag = tag_uri(key)
+            value = values[idx]
+            node.props[tag] = value
+        vospace.client.add_props(node)
+    # the node we just wrote is the current state, no need to fetch it again.
+    _cache_tags(expnum, node.props)
+    return node
+
+
+def _cache_tags(expnum, props):
+    """
+    Record the tags of an exposure in the tag cache, None values are deleted tags.
+    """
+    _tag_cache[str(expnum)] = (time.time(), dict([(key, value) for key, value in props.items()
+                                                   if value is not None]))
 
 
 def set_tags(expnum, props):
     """Assign the key/value pairs in props as tags on on the given dataset_name.
 
+    Inside a buffered_tags block the tags are held in memory and written by flush_tags.
+
     @param expnum: str
     @param props: dict
     @return: success
     """
+    if _tag_buffer is not None:
+        pending = _tag_buffer.setdefault(str(expnum), {})
+        for key, value in props.items():
+            pending[tag_uri(key)] = value
+        return True
     # now set all the props
     return _set_tags(expnum, props.keys(), props.values())
 
@@ -660,6 +1257,53 @@ def set_tag(expnum, key, value):
     return set_tags(expnum, {key: value})
 
 
+def flush_tags():
+    """
+    Write the tags held by buffered_tags, one get_node/add_props per exposure.
+    """
+    global _tag_buffer
+    if not _tag_buffer:
+        return
+    pending = _tag_buffer
+    _tag_buffer = {}
+    failed = []
+    for expnum in pending:
+        logging.debug("Writing {} buffered tags to {}".format(len(pending[expnum]), expnum))
+        try:
+            _set_tags(expnum, pending[expnum].keys(), pending[expnum].values())
+        except Exception as ex:
+            logging.error("Failed to write tags to {}: {}".format(expnum, ex))
+            failed.append(expnum)
+    if len(failed) > 0:
+        raise IOError(errno.EIO, "Failed to write buffered tags", failed)
+
+
+@contextmanager
+def buffered_tags():
+    """
+    Buffer set_tag/set_status calls made inside the block and write them in one call per exposure on exit.
+
+    usage:
+
+    with storage.buffered_tags():
+        for ccd in ccds:
+            storage.set_status(task, prefix, expnum, version, ccd, status)
+    """
+    global _tag_buffer
+    if _tag_buffer is not None:
+        # already buffering, the outer block does the flush.
+        yield
+        return
+    _tag_buffer = {}
+    try:
+        yield
+    finally:
+        try:
+            flush_tags()
+        finally:
+            _tag_buffer = None
+
+
 def tag_uri(key):
     """Build the uri for a given tag key. 
 
@@ -680,10 +1324,7 @@ def get_tag(expnum, key):
     @rtype: str
     """
 
-    uri = tag_uri(key)
-    force = uri not in get_tags(expnum)
-    value = get_tags(expnum, force=force).get(uri, None)
-    return value
+    return get_tags(expnum).get(tag_uri(key), None)
 
 
 def get_process_tag(program, ccd, version=PROCESSED_VERSION):
@@ -699,14 +1340,23 @@ def get_process_tag(program, ccd, version=PROCESSED_VERSION):
 
 def get_tags(expnum, force=False):
     """
+    All the tags on an exposure, fetched with one get_node call and then cached for TAG_CACHE_TTL seconds.
+    Tags buffered by buffered_tags but not yet written are included.
 
     @param expnum:
-    @param force:
+    @param force: ignore the cache and fetch the node from VOSpace.
     @return: dict
     @rtype: dict
     """
-    uri = os.path.join(DBIMAGES, str(expnum))
-    return vospace.client.get_node(uri, force=force).props
+    cached = _tag_cache.get(str(expnum), None)
+    if force or cached is None or time.time() - cached[0] > TAG_CACHE_TTL:
+        uri = os.path.join(DBIMAGES, str(expnum))
+        with metrics.timer('tag_read'):
+            _cache_tags(expnum, vospace.client.get_node(uri, force=True).props)
+    tags = dict(_tag_cache[str(expnum)][1])
+    if _tag_buffer:
+        tags.update(_tag_buffer.get(str(expnum), {}))
+    return tags
 
 
 def get_status(task, prefix, expnum, version, ccd, return_message=False):
@@ -730,6 +1380,31 @@ def get_status(task, prefix, expnum, version, ccd, return_message=False):
         return status == SUCCESS
 
 
+def get_statuses(task, prefix, expnum, version, ccds, return_message=False, force=False):
+    """
+    Report the status of a task on a list of CCDs of an exposure with a single look up of the exposure tags.
+
+    @param task:  name of the process or task that will be checked.
+    @param prefix: prefix of the file that was processed (often fk or None)
+    @param expnum: which exposure number (or base filename)
+    @param version: which version of that exposure (p, s, o)
+    @param ccds: list of CCDs within the exposure.
+    @param return_message: Return what did the TAG said or just /True/False/ for Success/Failure?
+    @param force: ignore the tag cache.
+    @return: dictionary of status keyed on ccd.
+    @rtype: dict
+    """
+    tags = get_tags(expnum, force=force)
+    statuses = {}
+    for ccd in ccds:
+        status = tags.get(tag_uri(get_process_tag(prefix+task, ccd, version)), None)
+        if return_message:
+            statuses[ccd] = status
+        else:
+            statuses[ccd] = status == SUCCESS
+    return statuses
+
+
 def set_status(task, prefix, expnum, version, ccd, status):
     """
     set the processing status of the given program.
@@ -831,6 +1506,16 @@ def reset_datasec(cutout, datasec, naxis1, naxis2):
     return "[{}:{},{}:{}]".format(datasec[0], datasec[1], datasec[2], datasec[3])
 
 
+def _parse_distortion(header):
+    """
+    The distortion of a header as the dictionary of Distortion.to_dict, None if the header has no WCS.
+    """
+    try:
+        return Distortion.from_header(header).to_dict()
+    except KeyError:
+        return None
+
+
 class Header(Image):
 
     def __init__(self, *args, **kwargs):
@@ -838,31 +1523,37 @@ class Header(Image):
             kwargs['ext'] = HEADER_EXT
         super(Header, self).__init__(*args, **kwargs)
         self._headers = None
+        self._distortions = {}
 
     @property
     def headers(self):
         """
-        The a list of the headers assocaited with the MEF.
+        The a list of the headers assocaited with the MEF, holding the keywords in util.HEAD_KEYWORDS.
         :return: List of image headers
-        :rtype: list
+        :rtype: util.MEFHeaders
         """
         if self._headers is not None:
             return self._headers
         if not os.access(self.filename, os.R_OK):
             self.get()
 
-        header_str_list = re.split('END      \n', open(self.filename, 'r').read())
-
-        # make the first entry in the list a Null
-        _headers = []
-        for header_str in header_str_list[:-1]:
-            header = fits.Header.fromstring(header_str, sep='\n')
-            if len(_headers) == 0 and not header.get('SIMPLE', False):
-                _headers.append({"SOURCE": self.uri})
-            _headers.append(header)
-        self._headers = _headers
+        self._headers = util.MEFHeaders(self.filename, source=self.uri)
         return self._headers
 
+    def distortion(self, ext):
+        """
+        The parsed WCS Distortion of an extension, None if it has none.
+
+        Only the header of ext is built and parsed.  The distortion is kept in the sidecar of the .head file along
+        with its keywords, see util.MEFHeaders.cached, so later runs skip parsing the PV keywords.
+
+        :rtype: Distortion
+        """
+        if ext not in self._distortions:
+            values = self.headers.cached(ext, 'distortion', _parse_distortion)
+            self._distortions[ext] = values is not None and Distortion.from_dict(values) or None
+        return self._distortions[ext]
+
     @property
     def header(self):
         """
@@ -878,30 +1569,33 @@ def make_path(uri):
     mkdir(os.path.dirname(uri))
 
 
+def make_paths(uris):
+    """
+    Build the paths of a list of uris, probing and creating each missing directory once.
+    """
+    cache.known_directories.ensure([os.path.dirname(uri) for uri in uris], vospace.client.isdir, _vos_mkdir)
+
+
 def mkdir(dirname):
     """make directory tree in vospace.
 
+    Directories already known to exist, see cache.known_directories, are not looked up again.
+
     @param dirname: name of the directory to make
     """
-    dir_list = []
+    cache.known_directories.ensure([dirname], vospace.client.isdir, _vos_mkdir)
 
-    while not vospace.client.isdir(dirname):
-        logging.debug("Queuing {} for mkdir.".format(dirname))
-        dir_list.append(dirname)
-        dirname = os.path.dirname(dirname)
-    while len(dir_list) > 0:
-        logging.info("Creating directory: %s" % (dir_list[-1]))
-        try:
-            vospace.client.mkdir(dir_list.pop())
-        except IOError as e:
-            if e.errno == errno.EEXIST:
-                pass
-            else:
-                raise e
+
+def _vos_mkdir(dirname):
+    try:
+        vospace.client.mkdir(dirname)
+    except AlreadyExistsException:
+        pass
 
 
 def delete(uri):
     vospace.client.delete(uri)
+    cache.known_directories.discard(uri)
 
 
 def make_link(source, destination):
@@ -913,7 +1607,9 @@ def make_link(source, destination):
 
 
 def listdir(directory, force=False):
-    return vospace.client.listdir(directory, force=force)
+    listing = vospace.client.listdir(directory, force=force)
+    cache.known_directories.add(directory)
+    return listing
 
 
 def list_dbimages(dbimages=None):
@@ -934,6 +1630,7 @@ def exists(uri, force=False):
 
 def move(old_uri, new_uri):
     vospace.client.move(old_uri, new_uri)
+    cache.known_directories.discard(old_uri)
 
 
 def has_property(node_uri, property_name, ossos_base=True):
@@ -1002,9 +1699,112 @@ def log_location(expnum, ccd):
     return os.path.dirname(Artifact(Observation(expnum), ccd=ccd).uri)
 
 
+def log_segments_uri(location, filename):
+    """
+    The container holding the segments of a log, see LoggingManager.
+    """
+    return "{}/{}{}".format(location, os.path.splitext(filename)[0], LOG_SEGMENTS_SUFFIX)
+
+
+def metrics_uri(location, filename):
+    """
+    The container holding the metrics of each run of a task, see LoggingManager and metrics.py.
+    """
+    return "{}/{}{}".format(location, os.path.splitext(filename)[0], METRICS_SUFFIX)
+
+
+def log_segment_name():
+    """
+    A unique name for the log segment of this run, segment names sort in the order they were started.
+    """
+    return "{}-{}-{}{}".format(datetime.datetime.utcnow().strftime('%Y%m%dT%H%M%S.%f'), socket.gethostname(),
+                               os.getpid(), TEXT_EXT)
+
+
+def ship_log_segment(filename, uri):
+    """
+    Start uploading a log segment in the background, the local file is removed once it is in VOSpace.
+
+    The process, and any worker process forked from it, waits for its uploads to finish when it exits.
+
+    :return: future of the upload.
+    """
+    global _log_uploads_pid
+    with _log_uploads_lock:
+        if _log_uploads_pid != os.getpid():
+            del _log_uploads[:]
+            multiprocessing.util.Finalize(None, wait_for_log_uploads, exitpriority=LOG_UPLOAD_EXIT_PRIORITY)
+            _log_uploads_pid = os.getpid()
+        future = get_transfer_engine().submit(filename, uri, func=_ship_log_segment)
+        _log_uploads.append(future)
+    return future
+
+
+def _ship_log_segment(filename, uri):
+    make_path(uri)
+    copy(filename, uri)
+    os.unlink(filename)
+
+
+def wait_for_log_uploads():
+    """
+    Block until the log segments being shipped are in VOSpace.
+
+    :return: number of segments that failed to upload.
+    """
+    with _log_uploads_lock:
+        futures = list(_log_uploads)
+        del _log_uploads[:]
+    failures = 0
+    for future in futures:
+        try:
+            future.get()
+        except Exception as ex:
+            logging.error("Failed to upload log segment: {}".format(ex))
+            failures += 1
+    return failures
+
+
+def merge_log_segments(location, filename):
+    """
+    Concatenate a log written as a single file with the segments shipped by later runs, in the order they were run.
+
+    :param location: VOSpace container of the log, see log_location.
+    :param filename: name of the log, see log_filename.
+    :return: content of the log.
+    :rtype: str
+    """
+    parts = []
+    uri = "{}/{}".format(location, filename)
+    try:
+        parts.append(vospace.client.open(uri, view='data').read())
+    except Exception as ex:
+        logging.debug("No single file log {}: {}".format(uri, ex))
+    segments_uri = log_segments_uri(location, filename)
+    try:
+        segments = sorted(listdir(segments_uri, force=True))
+    except Exception as ex:
+        logging.debug("No log segments in {}: {}".format(segments_uri, ex))
+        segments = []
+    for segment in segments:
+        parts.append(vospace.client.open("{}/{}".format(segments_uri, segment), view='data').read())
+    return "".join([part if part.endswith("\n") or len(part) == 0 else part + "\n" for part in parts])
+
+
 class LoggingManager(object):
+    """
+    Send the log of a task to VOSpace, as well as to a local file.
+
+    With LOG_SEGMENTS set the records of each run are written to a segment of the log that is shipped in the
+    background when the task is done, see merge_log_segments, otherwise the VOSpace log is appended to on exit.
+
+    The metrics of the run, see metrics.py, are logged on exit and shipped as JSON to the metrics_uri container.
+    """
 
     def __init__(self, task, prefix, expnum, ccd, version, dry_run=False):
+        self.task = task
+        self.expnum = expnum
+        self.ccd = ccd
         self.logging = logging.getLogger('')
         self.log_format = logging.Formatter('%(asctime)s - %(module)s.%(funcName)s %(lineno)d: %(message)s')
         self.filename = log_filename(prefix, task, ccd=ccd, version=version)
@@ -1013,15 +1813,45 @@ class LoggingManager(object):
 
     def __enter__(self):
         if not self.dry_run:
-            self.vo_handler = util.VOFileHandler("/".join([self.location, self.filename]))
+            if LOG_SEGMENTS:
+                self.vo_handler = util.VOSegmentHandler("/".join([log_segments_uri(self.location, self.filename),
+                                                                  log_segment_name()]), ship_log_segment)
+            else:
+                self.vo_handler = util.VOFileHandler("/".join([self.location, self.filename]))
             self.vo_handler.setFormatter(self.log_format)
             self.logging.addHandler(self.vo_handler)
         self.file_handler = logging.FileHandler(filename=self.filename)
         self.file_handler.setFormatter(self.log_format)
         self.logging.addHandler(self.file_handler)
+        self.metrics = metrics.snapshot()
         return self
 
+    def ship_metrics(self):
+        """
+        Log the metrics of this run and start shipping them to VOSpace.
+        """
+        record = metrics.since(self.metrics)
+        record.update({'task': self.task, 'scope': 'task', 'expnum': str(self.expnum), 'ccd': self.ccd})
+        logging.info("Metrics: {}".format(metrics.summary(record)))
+        if self.dry_run or not metrics.ENABLED:
+            return
+        filename = os.path.splitext(log_segment_name())[0] + metrics.METRICS_EXT
+        with open(filename, 'w') as fobj:
+            json.dump(record, fobj, sort_keys=True)
+        ship_log_segment(filename, "/".join([metrics_uri(self.location, self.filename), filename]))
+
     def __exit__(self, *args):
+        try:
+            self.ship_metrics()
+        except Exception as ex:
+            logging.error("Failed to record metrics: {}".format(ex))
+        if _artifact_cache is not None:
+            logging.info(str(_artifact_cache))
+        if _transfer_engine is not None:
+            logging.info(str(_transfer_engine))
+        latencies = webservice.latency_report()
+        if len(latencies) > 0:
+            logging.info("Web service latencies:\n" + latencies)
         if not self.dry_run:
             self.logging.removeHandler(self.vo_handler)
             self.vo_handler.close()
@@ -1066,18 +1896,230 @@ def isfile(uri):
 
 
 def copy(source, destination):
-    """Copy a file to/from VOSpace. With upto 10 retries on errors"""
-    count = 1
-    while True:
+    """Copy a file to/from VOSpace. With upto 10 retries on errors.
+
+    Retrievals from VOSpace go through the local artifact cache when one is configured, see cache.py.
+    """
+    artifact_cache = get_artifact_cache()
+    if artifact_cache is not None and source.startswith(VOS_PROTOCOL) and not destination.startswith(VOS_PROTOCOL):
+        checksum = _node_checksum(source, force=False)
+        if checksum is not None:
+            return artifact_cache.get(source, destination, checksum[0], checksum[1], _copy)
+    try:
+        return _copy(source, destination)
+    finally:
+        if destination.startswith(VOS_PROTOCOL):
+            with _checksum_cache_lock:
+                _checksum_cache.pop(re.sub(r'(\[[^\]]*\])+$', '', destination), None)
+
+
+def _copy(source, destination):
+    """Copy a file to/from VOSpace. With upto 10 retries on errors, see transfer.TransferEngine."""
+    return get_transfer_engine().transfer(source, destination)
+
+
+def _vos_copy(source, destination):
+    """One attempt at copying a file to/from VOSpace, counting the bytes transferred."""
+    result = vospace.client.copy(source, destination)
+    if source.startswith(VOS_PROTOCOL) and not destination.startswith(VOS_PROTOCOL):
+        metrics.count('bytes_downloaded', os.path.getsize(destination))
+    elif destination.startswith(VOS_PROTOCOL) and not source.startswith(VOS_PROTOCOL):
+        metrics.count('bytes_uploaded', os.path.getsize(source))
+    return result
+
+
+def copy_async(pairs):
+    """
+    Start copying each (source, destination) pair, concurrently, in the background.
+
+    :param pairs: list of (source, destination) tuples, as would be passed to copy.
+    :return: list of futures, one per pair, whose get() returns the result of the copy or raises its error.
+    """
+    return get_transfer_engine().submit_batch(pairs, func=copy)
+
+
+def copy_many(pairs):
+    """
+    Copy each (source, destination) pair concurrently, returning once all are done.
+
+    :raises: the first error of any of the copies.
+    """
+    return transfer.TransferEngine.wait(copy_async(pairs))
+
+
+def get_transfer_engine():
+    """
+    The process wide transfer engine, built on first use.
+
+    :rtype: transfer.TransferEngine
+    """
+    global _transfer_engine
+    if _transfer_engine is None:
+        _transfer_engine = transfer.TransferEngine(_vos_copy, checksum=_node_checksum, retries=MAX_RETRY)
+    return _transfer_engine
+
+
+def split_extension(uri, cutout=None):
+    """
+    Move the extension a URI ends with, eg. the [N] of a CCD image, to the front of the cutout.
+
+    VOSpace has no node for the extension of a file, so the extension is part of the cutout requested.
+
+    :return: (uri of the file, cutout)
+    """
+    match = EXTENSION_PATTERN.match(uri)
+    if match is None:
+        return uri, cutout
+    return match.group('uri'), match.group('extension') + (cutout or "")
+
+
+def read_hdulist(uri, cutout=None, shared=False, **kwargs):
+    """
+    Stream a VOSpace file, or a cutout of it, straight into an in-memory HDUList, without a temporary file.
+
+    The body of the response is read into a buffer the size of the file and the HDUList is built on that buffer, with
+    astropy 3.0 or later the data arrays are views of the buffer rather than copies.  Failures are retried by the
+    transfer engine, as copies are.
+
+    :param uri: VOSpace URI of the file, it may end with the extension to cut out of, eg. the uri of a CCD Image.
+    :param cutout: cutout section to retrieve, eg. '[1][1:100,1:100]', default is the whole file.
+    :param shared: read into an anonymous memory map, which is shared with processes forked later, not a bytearray.
+    :param kwargs: passed to fits.HDUList.fromstring, eg. scale_back.
+    :rtype: fits.HDUList
+    """
+    uri, cutout = split_extension(uri, cutout)
+    return get_transfer_engine().retry(lambda: _read_hdulist(uri, cutout, shared, **kwargs),
+                                       "read {}{}".format(uri, cutout or ""))
+
+
+def _read_hdulist(uri, cutout=None, shared=False, **kwargs):
+    """
+    One attempt at read_hdulist, trying each of the URLs of the node.
+    """
+    view = cutout is None and 'data' or 'cutout'
+    urls = vospace.client.get_node_url(uri, method='GET', cutout=cutout, view=view)
+    if not isinstance(urls, list):
+        urls = [urls]
+    error = IOError(errno.ENOENT, "No URL to retrieve", uri)
+    for url in urls:
+        try:
+            response = vospace.client.conn.session.get(url, stream=True)
+        except RequestException as ex:
+            logging.debug("Failed to connect to {}: {}".format(url, ex))
+            error = ex
+            continue
         try:
-            return vospace.client.copy(source, destination)
-        except OSError as ex:
-            if ex.errno == errno.ENOENT:
-                raise ex
-            count += 1
-            logging.debug(str(ex))
-            if count > MAX_RETRY:
-                raise ex
+            if response.status_code == 400:
+                raise BadRequestException(response.text)
+            if response.status_code == 404:
+                raise IOError(errno.ENOENT, "Not found", uri)
+            response.raise_for_status()
+            body = _read_body(response, shared)
+            metrics.count('bytes_downloaded', len(body))
+            return _parse_hdulist(body, **kwargs)
+        except RequestException as ex:
+            logging.debug("Failed to read {}: {}".format(url, ex))
+            error = ex
+        finally:
+            response.close()
+    raise error
+
+
+def read_hdulists_async(cutouts, shared=False):
+    """
+    Start streaming many files/cutouts into memory concurrently, on the transfer engine's worker threads.
+
+    :param cutouts: list of (uri, cutout) pairs, as would be passed to read_hdulist.
+    :return: list of futures, one per pair, whose get() returns the HDUList.
+    """
+    pool = get_transfer_engine().pool
+    return [pool.apply_async(read_hdulist, (uri, cutout, shared)) for uri, cutout in cutouts]
+
+
+def _parse_hdulist(buf, **kwargs):
+    """
+    Build an HDUList on an in-memory FITS file.
+    """
+    if FITS_FROMSTRING:
+        return fits.HDUList.fromstring(buf, **kwargs)
+    if not isinstance(buf, mmap.mmap):
+        buf = io.BytesIO(buf)
+    return fits.open(buf, **kwargs)
+
+
+def _read_body(response, shared=False):
+    """
+    Read the body of a streamed response into a buffer, allocated once when the length of the body is known.
+
+    :return: bytearray or mmap holding the body.
+    """
+    response.raw.decode_content = True
+    length = response.headers.get('Content-Length', None)
+    chunks = response.iter_content(chunk_size=CHUNK_SIZE)
+    if length is None or response.headers.get('Content-Encoding', 'identity') != 'identity':
+        # the length of the decoded body is not known in advance.
+        body = bytearray()
+        for chunk in chunks:
+            body.extend(chunk)
+        if not shared:
+            return body
+        length = len(body)
+        chunks = [body]
+    length = int(length)
+    if shared:
+        buf = mmap.mmap(-1, max(length, 1))
+    else:
+        buf = bytearray(length)
+    offset = 0
+    for chunk in chunks:
+        if offset + len(chunk) > length:
+            raise IOError(errno.EIO, "Response longer than its Content-Length", response.url)
+        buf[offset:offset + len(chunk)] = bytes(chunk)
+        offset += len(chunk)
+    if offset != length:
+        raise IOError(errno.EIO, "Response truncated at {} of {} bytes".format(offset, length), response.url)
+    return buf
+
+
+def _node_checksum(uri, force=True):
+    """
+    The MD5 and length of the VOSpace node holding uri, following links, or None if not known.
+
+    Any cutout section on the uri is ignored, the node is that of the whole file.  Checksums are kept for
+    CHECKSUM_CACHE_TTL seconds, so artifacts retrieved again soon after do not need another look up of their node.
+
+    :param force: look the node up rather than use a cached checksum, as the check of an upload must.
+    """
+    uri = re.sub(r'(\[[^\]]*\])+$', '', uri)
+    with _checksum_cache_lock:
+        cached = _checksum_cache.get(uri, None)
+    if not force and cached is not None and time.time() - cached[0] <= CHECKSUM_CACHE_TTL:
+        return cached[1]
+    try:
+        node = vospace.client.get_node(uri, force=True)
+        if node.islink() and getattr(node, 'target', '').startswith(VOS_PROTOCOL):
+            node = vospace.client.get_node(node.target, force=True)
+    except Exception as ex:
+        logging.debug("Unable to get checksum of {}: {}".format(uri, ex))
+        return None
+    md5 = node.props.get('MD5', None)
+    length = node.props.get('length', None)
+    checksum = md5 is not None and (md5, length) or None
+    with _checksum_cache_lock:
+        _checksum_cache[uri] = (time.time(), checksum)
+    return checksum
+
+
+def get_artifact_cache():
+    """
+    The process wide artifact cache, built from the environment on first use.
+
+    :rtype: cache.ArtifactCache
+    """
+    global _artifact_cache
+    if _artifact_cache is None:
+        _artifact_cache = cache.ArtifactCache.from_environment()
+    return _artifact_cache
 
 
 def list_exposures(proposal_title='cfis'):
@@ -1100,42 +2142,82 @@ def list_exposures(proposal_title='cfis'):
     return tap_query(query)
 
 
-def list_healpix():
+def list_healpix(footprint_index=None):
+    """
+    The healpix that the project's exposures fall in.
+
+    The healpix of the centre of each exposure, plus, from the footprint index, every healpix touched by a CCD of the
+    exposures indexed.
+
+    :param footprint_index: footprint.FootprintIndex to use, default is that of get_footprint_index.
+    :rtype: numpy.ndarray
+    """
     exposure_table = list_exposures()
     skycoords = SkyCoord(exposure_table['RA']*units.degree,
                          exposure_table['DE']*units.degree)
-    healpix = []
-    for coord in skycoords:
-        healpix.append(util.skycoord_to_healpix(coord))
-
+    healpix = util.skycoord_to_healpix(skycoords)
+    if footprint_index is None:
+        footprint_index = get_footprint_index()
+    if footprint_index is not None:
+        healpix = numpy.concatenate((healpix, footprint_index.healpixels()))
     return numpy.unique(healpix)
 
 
-def tap_query(query):
+def tap_query(query, refresh=None):
     """
     Send query to a TAP service and return an astropy table. (could use astroquery instead)
+
+    Results are kept in the query cache, see get_query_cache.
+
     :param query: SQL to send to the TAP service.
     :type query: str
+    :param refresh: run the query even if the result is cached, default is REFRESH_QUERIES.
     :return: Table of results
     :rtype: Table
     """
+    if refresh is None:
+        refresh = REFRESH_QUERIES
+    query_cache = get_query_cache()
+    if query_cache is None:
+        return _tap_query(query)
+    return query_cache.get(query, 'tsv', _tap_query, refresh=refresh)
+
 
+def _tap_query(query):
+    """Send query to the TAP service, bypassing the query cache."""
     data = dict(QUERY=query,
                 REQUEST="doQuery",
                 LANG="ADQL",
                 FORMAT="tsv")
 
     logging.debug("QUERY: {}".format(data["QUERY"]))
-    try:
-        result = requests.get(TAP_WEB_SERVICE, params=data, verify=False)
-        result.raise_for_status()
-    except Exception as ex:
-        logging.error(str(ex))
-
+    result = webservice.get(TAP_WEB_SERVICE, params=data, stream=True)
     logging.debug("Doing TAP Query using url: %s" % (str(result.url)))
+    return webservice.read_tsv(result)
+
+
+def get_query_cache():
+    """
+    The process wide TAP query cache, built from the environment on first use.
+
+    :return: the cache or None if query caching is turned off.
+    :rtype: cache.QueryCache
+    """
+    global _query_cache
+    if _query_cache is None:
+        _query_cache = cache.QueryCache.from_environment()
+    return _query_cache
+
+
+def invalidate_queries(query=None, pattern=None):
+    """
+    Remove TAP query results from the query cache, all of them if neither query nor pattern is given.
 
-    table_reader = ascii.get_reader(Reader=ascii.Basic)
-    table_reader.header.splitter.delimiter = '\t'
-    table_reader.data.splitter.delimiter = '\t'
-    table = table_reader.read(result.text)
-    return table
+    :param query: the query whose result is removed.
+    :param pattern: remove the results of every query containing this text.
+    :return: number of results removed.
+    """
+    query_cache = get_query_cache()
+    if query_cache is None:
+        return 0
+    return query_cache.invalidate(query=query, fmt='tsv', pattern=pattern)
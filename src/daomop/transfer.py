@@ -0,0 +1,221 @@
+"""Parallel, verified, file transfers to and from VOSpace.
+
+A TransferEngine runs batches of (source, destination) copies on a bounded pool of worker threads.  Each copy is
+retried with jittered exponential backoff and, once an upload is done, the MD5 of the local file is checked against
+that of the VOSpace node, a mismatch is retried like any other failure.  Downloads are not checked here, vos.Client.copy
+compares the MD5 of the data it receives with that the service sends.  submit and submit_batch return a future per
+copy (a multiprocessing AsyncResult, use get() for the result), wait blocks until a batch is complete.
+
+The number of worker threads is set by DAOMOP_TRANSFER_WORKERS, DAOMOP_TRANSFER_VERIFY=0 turns off the MD5 check."""
+import errno
+import hashlib
+import logging
+import os
+import random
+import threading
+import time
+from multiprocessing.pool import ThreadPool
+
+WORKERS_ENV = 'DAOMOP_TRANSFER_WORKERS'
+VERIFY_ENV = 'DAOMOP_TRANSFER_VERIFY'
+DEFAULT_WORKERS = 4
+DEFAULT_RETRIES = 10
+BACKOFF = 1.0
+MAX_BACKOFF = 60.0
+# the MD5 of a node can lag an upload that overwrote it, a mismatch is looked up again this many times before failing.
+CHECK_ATTEMPTS = 3
+CHECK_DELAY = 2.0
+VOS_PROTOCOL = 'vos:'
+
+
+class TransferError(IOError):
+    """The file transferred does not match its VOSpace node."""
+    pass
+
+
+def file_md5(filename, block_size=2 ** 20):
+    """
+    :return: hex digest of the MD5 of the content of filename.
+    """
+    md5 = hashlib.md5()
+    with open(filename, 'rb') as fobj:
+        while True:
+            block = fobj.read(block_size)
+            if not block:
+                break
+            md5.update(block)
+    return md5.hexdigest()
+
+
+class TransferEngine(object):
+    """
+    Copy files to/from VOSpace, one at a time with transfer or many concurrently with submit_batch.
+    """
+
+    def __init__(self, copy, checksum=None, workers=None, retries=DEFAULT_RETRIES, verify=None):
+        """
+        :param copy: function(source, destination) that makes one attempt at a copy, eg. vos.Client.copy.
+        :param checksum: function(uri) returning the (md5, length) of a VOSpace node, or None if not known.
+        :param workers: maximum number of concurrent transfers.
+        :param retries: number of times a failed copy is retried.
+        :param verify: check the MD5 of each upload, requires checksum.
+        """
+        if workers is None:
+            workers = int(os.environ.get(WORKERS_ENV, DEFAULT_WORKERS))
+        if verify is None:
+            verify = os.environ.get(VERIFY_ENV, '1') not in ['0', 'false', 'False', 'no']
+        self.copy = copy
+        self.checksum = checksum
+        self.workers = workers
+        self.retries = retries
+        self.verify = verify and checksum is not None
+        self.stats = {'transfers': 0, 'retries': 0, 'failures': 0, 'verified': 0}
+        self._pool = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    @property
+    def pool(self):
+        """The worker threads, only started once something is submitted, again in a forked process."""
+        with self._lock:
+            if self._pool is None or self._pid != os.getpid():
+                self._pool = ThreadPool(self.workers)
+                self._pid = os.getpid()
+            return self._pool
+
+    def _count(self, stat):
+        with self._lock:
+            self.stats[stat] += 1
+
+    def check(self, source, destination):
+        """
+        Compare the MD5 of the local file uploaded with that of the VOSpace node.
+
+        Downloads are not compared, vos.Client.copy has already checked them.
+
+        :return: False if the two differ, True if they match or could not be compared.
+        """
+        if not destination.startswith(VOS_PROTOCOL) or source.startswith(VOS_PROTOCOL) or not os.path.isfile(source):
+            return True
+        local_md5 = None
+        for attempt in range(CHECK_ATTEMPTS):
+            if attempt > 0:
+                time.sleep(CHECK_DELAY)
+            expected = self.checksum(destination)
+            if expected is None:
+                return True
+            if local_md5 is None:
+                local_md5 = file_md5(source)
+                self._count('verified')
+            if local_md5 == expected[0]:
+                return True
+            logging.debug("MD5 of {} does not yet match {}".format(destination, source))
+        return False
+
+    def transfer(self, source, destination):
+        """
+        Copy source to destination, retrying failures with jittered exponential backoff.
+
+        Missing sources (ENOENT) are not retried.
+
+        :return: result of the copy function.
+        """
+        def attempt():
+            result = self.copy(source, destination)
+            if self.verify and not self.check(source, destination):
+                raise TransferError(errno.EIO, "MD5 of {} does not match {}".format(source, destination))
+            return result
+
+        result = self.retry(attempt, "copy {} -> {}".format(source, destination))
+        self._count('transfers')
+        return result
+
+    def retry(self, func, description):
+        """
+        Call func, retrying the errors it raises with jittered exponential backoff, as transfer does for copies.
+
+        Errors that are not EnvironmentErrors, and missing files (ENOENT), are not retried.
+
+        :param func: function of no arguments that makes one attempt.
+        :param description: what func does, for the log.
+        :return: result of func.
+        """
+        attempt = 0
+        while True:
+            try:
+                return func()
+            except EnvironmentError as ex:
+                if ex.errno == errno.ENOENT or attempt >= self.retries:
+                    self._count('failures')
+                    raise ex
+                error = ex
+            delay = random.uniform(0, min(MAX_BACKOFF, BACKOFF * 2 ** attempt))
+            attempt += 1
+            self._count('retries')
+            logging.warning("{} failed ({}), retry {} of {} in {:.1f}s".format(
+                description, error, attempt, self.retries, delay))
+            time.sleep(delay)
+
+    def submit(self, source, destination, func=None):
+        """
+        Start copying source to destination in the background.
+
+        :param func: function(source, destination) to run in place of transfer, eg. one that wraps transfer.
+        :return: future of the result of the copy.
+        :rtype: multiprocessing.pool.AsyncResult
+        """
+        return self.pool.apply_async(func or self.transfer, (source, destination))
+
+    def submit_batch(self, pairs, func=None):
+        """
+        Start copying each of a list of (source, destination) pairs, at most workers at a time.
+
+        :return: list of futures, in the order of pairs.
+        """
+        return [self.submit(source, destination, func=func) for source, destination in pairs]
+
+    @staticmethod
+    def wait(futures):
+        """
+        Block until all the futures are done.
+
+        :return: list of the results.
+        :raises: the first error raised by a transfer, after all the transfers have finished.
+        """
+        results = []
+        error = None
+        for future in futures:
+            try:
+                results.append(future.get())
+            except Exception as ex:
+                results.append(None)
+                if error is None:
+                    error = ex
+        if error is not None:
+            raise error
+        return results
+
+    def copy_batch(self, pairs, func=None):
+        """
+        Copy each of a list of (source, destination) pairs concurrently, blocking until they are done.
+        """
+        return self.wait(self.submit_batch(pairs, func=func))
+
+    def close(self):
+        """Wait for the submitted transfers to finish and stop the worker threads."""
+        with self._lock:
+            pool = self._pool
+            self._pool = None
+        if pool is not None and self._pid == os.getpid():
+            pool.close()
+            pool.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def __str__(self):
+        return "transfers: {transfers} done, {retries} retries, {failures} failed, {verified} verified".format(
+            **self.stats)
@@ -12,9 +12,13 @@ import Polygon
 import healpy
 import numpy
 import six
+import cache
 import vospace
 from healpy import pixelfunc
+from six.moves import cPickle as pickle
 from astropy.coordinates import SkyCoord
+from astropy.io import fits
+from scipy.spatial import cKDTree
 
 try:
     from astropy._erfa import d2dtf
@@ -27,7 +31,18 @@ except:
 from astropy.time import TimeString
 
 MATCH_TOLERANCE = 100.0
-HEALPIX_NSIDE = 32
+HEALPIX_NSIDE_ENV = 'DAOMOP_HEALPIX_NSIDE'
+HEALPIX_NSIDE = int(os.environ.get(HEALPIX_NSIDE_ENV, 32))
+# dense healpix are split into NESTED children, down to at most this nside (about 12 square arcminutes per pixel).
+HEALPIX_MAX_NSIDE = 1024
+# the keywords of a MEF .head file that the pipeline uses, see MEFHeaders.
+HEAD_KEYWORDS = ('SIMPLE', 'EXTVER', 'EXTNAME', 'NAXIS', 'NAXIS1', 'NAXIS2',
+                 'CTYPE1', 'CTYPE2', 'CUNIT1', 'CUNIT2', 'CRPIX1', 'CRPIX2', 'CRVAL1', 'CRVAL2',
+                 'CD1_1', 'CD1_2', 'CD2_1', 'CD2_2', 'EQUINOX', 'RADESYS', 'NORDFIT',
+                 'DATASEC', 'MJDATE', 'EXPTIME', 'PHOTZP', 'FLAT', 'RUNID')
+HEAD_KEYWORD_PREFIXES = ('PV1_', 'PV2_')
+HEAD_CACHE_EXT = '.keys'
+_END_CARD = re.compile(r'^END\s*$', re.M)
 
 def config_logging(level):
     """
@@ -46,30 +61,85 @@ def config_logging(level):
     logger.addHandler(sh)
 
 
-def healpix_to_corners(pix, nside=None):
+def healpix_to_corners(pix, nside=None, nest=False):
     if nside is None:
         nside = HEALPIX_NSIDE
-    corners = healpy.boundaries(nside, pix)
+    corners = healpy.boundaries(nside, pix, nest=nest)
     return numpy.transpose(healpy.vec2ang(numpy.transpose(corners), lonlat=True))
 
 
-def healpix_to_skycoord(pix, nside=None):
+def healpix_to_skycoord(pix, nside=None, nest=False):
     """
     given a healpix pix and the nside level of the healpix return the SkyCoord representing the centre of the field
     """
     if nside is None:
         nside = HEALPIX_NSIDE
-    ra, dec = pixelfunc.pix2ang(nside, pix, lonlat=True)
+    ra, dec = pixelfunc.pix2ang(nside, pix, nest=nest, lonlat=True)
     return SkyCoord(ra, dec, unit='degree')
 
 
-def skycoord_to_healpix(skycoord, nside=None):
+def skycoord_to_healpix(skycoord, nside=None, nest=False):
     """
     Convert an array of RA DEC values to their HEALPIX values.
     """
+    return radec_to_healpix(skycoord.ra.degree, skycoord.dec.degree, nside=nside, nest=nest)
+
+
+def radec_to_healpix(ra, dec, nside=None, nest=False):
+    """
+    Convert arrays of RA and DEC, in degrees, to their HEALPIX values without building a SkyCoord.
+    """
     if nside is None:
         nside = HEALPIX_NSIDE
-    return pixelfunc.ang2pix(nside, skycoord.ra.degree, skycoord.dec.degree, lonlat=True)
+    return pixelfunc.ang2pix(nside, numpy.asarray(ra, dtype=numpy.float64), numpy.asarray(dec, dtype=numpy.float64),
+                             nest=nest, lonlat=True)
+
+
+def ring_to_nest(pix, nside=None):
+    """
+    The NESTED number of a RING ordered healpix.
+    """
+    if nside is None:
+        nside = HEALPIX_NSIDE
+    return pixelfunc.ring2nest(nside, pix)
+
+
+def healpix_children(pix):
+    """
+    The four NESTED healpix, at twice the nside, that make up the NESTED healpix pix.
+    """
+    return 4 * pix + numpy.arange(4)
+
+
+def footprints_to_healpix(footprints, nside=None, nest=False):
+    """
+    Find the healpix touched by each of a list of footprints.
+
+    :param footprints: array of shape (n, m, 2) of the (ra, dec) corners, in degrees, of n convex footprints.
+    :param nest: return NESTED rather than RING ordered healpix.
+    :return: list of n arrays of the healpix that overlap each footprint, this may include a few neighbouring
+    pixels that do not.  A footprint healpy can not search, one that is degenerate or not convex, has no healpix.
+    """
+    if nside is None:
+        nside = HEALPIX_NSIDE
+    footprints = numpy.asarray(footprints, dtype=numpy.float64)
+    if len(footprints) == 0:
+        return []
+    vertices = healpy.ang2vec(footprints[:, :, 0].ravel(), footprints[:, :, 1].ravel(), lonlat=True)
+    vertices = vertices.reshape(footprints.shape[0], footprints.shape[1], 3)
+    # inclusive, as a CCD is much smaller than a healpix so is often not over any pixel centre.  The inclusive
+    # RING ordered search can miss pixels whose corner is inside the footprint, the NESTED search does not.
+    pixels = []
+    for idx, polygon in enumerate(vertices):
+        try:
+            pixels.append(healpy.query_polygon(nside, polygon, inclusive=True, nest=True))
+        except (RuntimeError, ValueError) as ex:
+            logging.warning("Skipping footprint {}, {}: {}".format(idx, footprints[idx].tolist(), ex))
+            pixels.append(numpy.array([], dtype=numpy.int64))
+    if nest:
+        return [numpy.sort(nested) for nested in pixels]
+    return [numpy.sort(healpy.nest2ring(nside, nested)) for nested in pixels]
+
 
 def set_logger(args):
 
@@ -149,13 +219,8 @@ class VOFileHandler(handlers.BufferingHandler):
                 self.stream.flush()
                 _name = self.stream.name
                 self.stream.close()
-                dirname = os.path.dirname(self.filename)
-                paths = []
-                while not self.client.access(dirname) and len(dirname) > 0:
-                      paths.append(dirname)
-                      dirname = os.path.dirname(dirname)
-                while paths:
-                      self.client.mkdir(paths.pop())
+                cache.known_directories.ensure([os.path.dirname(self.filename)], self.client.access,
+                                               self.client.mkdir)
                 self.client.copy(_name, self.filename)
         except Exception as ex:
             logging.error(str(ex))
@@ -167,6 +232,39 @@ class VOFileHandler(handlers.BufferingHandler):
         self.buffer = []
 
 
+class VOSegmentHandler(logging.FileHandler):
+    """
+    A handler that writes the records of one run to a local log segment, shipped to VOSpace in the background on close.
+    """
+    def __init__(self, uri, ship):
+        """
+        @param uri: the VOSpace URI of the segment.
+        @param ship: function(filename, uri) that starts uploading the segment and returns without waiting for it.
+        """
+        fd, filename = tempfile.mkstemp(prefix='log_segment_', suffix='.txt')
+        os.close(fd)
+        self.uri = uri
+        self._ship = ship
+        self.shipped = None
+        super(VOSegmentHandler, self).__init__(filename, mode='w', delay=True)
+
+    def close(self):
+        """
+        Closes the segment and starts shipping it, empty segments are dropped.
+        """
+        super(VOSegmentHandler, self).close()
+        if self.shipped is not None or not os.access(self.baseFilename, os.F_OK):
+            return
+        if os.path.getsize(self.baseFilename) == 0:
+            os.unlink(self.baseFilename)
+            self.shipped = False
+            return
+        try:
+            self.shipped = self._ship(self.baseFilename, self.uri)
+        except Exception as ex:
+            logging.error("Failed to ship log segment {} to {}: {}".format(self.baseFilename, self.uri, ex))
+
+
 def get_pixel_bounds_from_datasec_keyword(datasec):
     """
     Return the x/y pixel boundaries of the data section.
@@ -182,10 +280,234 @@ def get_pixel_bounds_from_datasec_keyword(datasec):
     return (x1, x2), (y1, y2)
 
 
+def read_mef_headers(filename, source=None):
+    """
+    Read a MEF .head file, the concatenated headers of each extension, into a list of FITS headers.
+
+    :param filename: name of the .head file to read.
+    :param source: used to build a place holder primary header if the file has none.
+    :return: list of headers with the primary header first, so extension N is at index N.
+    :rtype: list
+    """
+    header_str_list = re.split('END      \n', open(filename, 'r').read())
+
+    headers = []
+    for header_str in header_str_list[:-1]:
+        header = fits.Header.fromstring(header_str, sep='\n')
+        if len(headers) == 0 and not header.get('SIMPLE', False):
+            headers.append({"SOURCE": source})
+        headers.append(header)
+    return headers
+
+
+class MEFHeaders(object):
+    """
+    Lazy, list like, access to the headers of a MEF .head file holding only the keywords the pipeline needs.
+
+    The file is scanned once for the END cards; the cards of an extension are only selected, and the header built,
+    when that extension is accessed.  Once every extension has been read the selected cards are saved in a
+    pickled sidecar file, keyed on the mtime and size of the .head file, which later reads use in place of the text.
+    Values derived from the header of an extension, eg. its parsed distortion, are kept in the same sidecar, see
+    cached.
+    """
+
+    def __init__(self, filename, source=None, keywords=HEAD_KEYWORDS, prefixes=HEAD_KEYWORD_PREFIXES):
+        """
+        :param filename: name of the .head file to read.
+        :param source: used to build a place holder primary header if the file has none.
+        :param keywords: keywords to keep.
+        :param prefixes: keep the keywords that start with one of these, eg. the PV coefficients.
+        """
+        self.filename = filename
+        self.source = source
+        self.keywords = frozenset(keywords)
+        self.prefixes = tuple(prefixes)
+        self.sidecar = filename + HEAD_CACHE_EXT
+        stat = os.stat(filename)
+        self._key = (stat.st_mtime, stat.st_size, sorted(self.keywords), sorted(self.prefixes))
+        self._text = None
+        self._extents = None
+        self._values = {}
+        self._cards = self._load_sidecar()
+        if self._cards is None:
+            self._text = open(filename, 'r').read()
+            self._extents = []
+            start = 0
+            for end_card in _END_CARD.finditer(self._text):
+                self._extents.append((start, end_card.start()))
+                start = end_card.end() + 1
+            self._cards = [None] * len(self._extents)
+        # mirror read_mef_headers: index N is extension N even when the file has no primary header.
+        self._offset = 0
+        if len(self._cards) > 0:
+            if not fits.Header.fromstring(''.join(self._extension_cards(0))).get('SIMPLE', False):
+                self._offset = 1
+        self._headers = [None] * (len(self._cards) + self._offset)
+
+    def _load_sidecar(self):
+        try:
+            with open(self.sidecar, 'rb') as fobj:
+                saved = pickle.load(fobj)
+            if saved['key'] == self._key:
+                self._values = saved.get('values', {})
+                return saved['cards']
+        except Exception as ex:
+            logging.debug("Not using {}: {}".format(self.sidecar, ex))
+        return None
+
+    def _save_sidecar(self):
+        for idx in range(len(self._cards)):
+            self._extension_cards(idx, save=False)
+        try:
+            with open(self.sidecar, 'wb') as fobj:
+                pickle.dump({'key': self._key, 'cards': self._cards, 'values': self._values}, fobj,
+                            pickle.HIGHEST_PROTOCOL)
+        except (IOError, OSError) as ex:
+            logging.warning("Failed to write {}: {}".format(self.sidecar, ex))
+
+    def _extension_cards(self, idx, save=True):
+        """
+        The images of the wanted cards of the idx'th header in the file, padded to 80 characters.
+
+        :param save: write the sidecar once the cards of every header have been selected.
+        """
+        if self._cards[idx] is None:
+            cards = []
+            start, end = self._extents[idx]
+            for line in self._text[start:end].split('\n'):
+                keyword = line[0:8].rstrip()
+                if line[8:10] != '= ' or (keyword not in self.keywords and not keyword.startswith(self.prefixes)):
+                    continue
+                cards.append(line.ljust(80))
+            self._cards[idx] = cards
+            if save and None not in self._cards:
+                self._save_sidecar()
+        return self._cards[idx]
+
+    def cached(self, ext, name, build):
+        """
+        A value derived from the header of an extension, built once and then kept in the sidecar.
+
+        :param ext: the extension.
+        :param name: name of the value, eg. 'distortion'.
+        :param build: function(header) returning the value, it must be picklable.
+        """
+        if ext < 0:
+            ext += len(self)
+        key = (name, ext)
+        if key not in self._values:
+            self._values[key] = build(self[ext])
+            self._save_sidecar()
+        return self._values[key]
+
+    def __len__(self):
+        return len(self._headers)
+
+    def __getitem__(self, ext):
+        """
+        :return: the header of extension ext
+        :rtype: fits.Header
+        """
+        if isinstance(ext, slice):
+            return [self[idx] for idx in range(*ext.indices(len(self)))]
+        if ext < 0:
+            ext += len(self)
+        if self._headers[ext] is None:
+            if ext < self._offset:
+                self._headers[ext] = {"SOURCE": self.source}
+            else:
+                # astropy only parses the value of a card built from its image when the value is accessed.
+                self._headers[ext] = fits.Header.fromstring(''.join(self._extension_cards(ext - self._offset)))
+        return self._headers[ext]
+
+    def __iter__(self):
+        for ext in range(len(self)):
+            yield self[ext]
+
+
+def unit_vectors(pos):
+    """
+    Convert an array of RA/DEC (degrees) positions to unit vectors on the sphere.
+
+    :param pos: array of shape (N, 2) holding RA/DEC in degrees.
+    :rtype: numpy.ndarray
+    """
+    ra = numpy.radians(pos[:, 0])
+    dec = numpy.radians(pos[:, 1])
+    cos_dec = numpy.cos(dec)
+    return numpy.transpose((cos_dec * numpy.cos(ra), cos_dec * numpy.sin(ra), numpy.sin(dec)))
+
+
 def match_lists(pos1, pos2, tolerance=MATCH_TOLERANCE, spherical=False):
     """
     Given two sets of x/y positions match the lists, uniquely.
 
+    :rtype : numpy.ma, numpy.ma
+    :param pos1: list of x/y positions.
+    :param pos2: list of x/y positions.
+    :param tolerance: float distance, in pixels (degrees if spherical), to consider a match
+    :param spherical: positions are RA/DEC in degrees, match using the true angular separation.
+
+    Algorithm:
+        - Build a k-d tree on each list (on unit vectors when spherical).
+        - Find the nearest member of pos2, within tolerance, of each pos1[idx1].
+        - Find the nearest member of pos1, within tolerance, of each pos2[idx2].
+        - pos1[idx1] and pos2[idx2] match if each is the nearest neighbour of the other.
+
+    The returned arrays follow the match_lists_bruteforce contract: match1[idx1] is the index in pos2 of the
+    match to pos1[idx1] and match2[idx2] is the index in pos1 of the match to pos2[idx2], masked where no
+    match was found.
+    """
+
+    assert isinstance(pos1, numpy.ndarray)
+    assert isinstance(pos2, numpy.ndarray)
+
+    npts1 = len(pos1)
+    npts2 = len(pos2)
+
+    match1 = numpy.ma.zeros(npts1, dtype=numpy.int64)
+    match1.mask = True
+    match2 = numpy.ma.zeros(npts2, dtype=numpy.int64)
+    match2.mask = True
+
+    if npts1 == 0 or npts2 == 0:
+        return match1, match2
+
+    if spherical:
+        # compare chord lengths between unit vectors, that is monotonic in the angular separation.
+        xyz1 = unit_vectors(pos1)
+        xyz2 = unit_vectors(pos2)
+        distance = 2 * numpy.sin(numpy.radians(min(tolerance, 180.0)) / 2.0)
+    else:
+        xyz1 = pos1[:, 0:2]
+        xyz2 = pos2[:, 0:2]
+        distance = tolerance
+
+    # cKDTree treats the upper bound as exclusive, nudge it so sep <= tolerance still matches.
+    distance = numpy.nextafter(distance, numpy.inf)
+
+    # nearest pos2 entry of each pos1 entry, index npts2 is returned when there is none within tolerance.
+    sep12, idx12 = cKDTree(xyz2).query(xyz1, k=1, distance_upper_bound=distance)
+    sep21, idx21 = cKDTree(xyz1).query(xyz2, k=1, distance_upper_bound=distance)
+
+    idx1 = numpy.arange(npts1)[numpy.isfinite(sep12)]
+    idx2 = idx12[idx1]
+    mutual = idx21[idx2] == idx1
+    idx1 = idx1[mutual]
+    idx2 = idx2[mutual]
+
+    match1[idx1] = idx2
+    match2[idx2] = idx1
+
+    return match1, match2
+
+
+def match_lists_bruteforce(pos1, pos2, tolerance=MATCH_TOLERANCE, spherical=False):
+    """
+    Given two sets of x/y positions match the lists, uniquely, by brute force.
+
+    This is the original O(N*M) implementation, kept as the reference for match_lists.
+
     :rtype : numpy.ma, numpy.ma
     :param pos1: list of x/y positions.
     :param pos2: list of x/y positions.
@@ -205,16 +527,16 @@ def match_lists(pos1, pos2, tolerance=MATCH_TOLERANCE, spherical=False):
 
     # build some arrays to hold the index of things that matched between lists.
     npts1 = len(pos1[:, 0])
-    pos1_idx_array = numpy.arange(npts1, dtype=numpy.int16)
+    pos1_idx_array = numpy.arange(npts1, dtype=numpy.int64)
     npts2 = len(pos2[:, 0])
-    pos2_idx_array = numpy.arange(npts2, dtype=numpy.int16)
+    pos2_idx_array = numpy.arange(npts2, dtype=numpy.int64)
 
     # this is the array of final matched index, -1 indicates no match found.
-    match1 = numpy.ma.zeros(npts1, dtype=numpy.int16)
+    match1 = numpy.ma.zeros(npts1, dtype=numpy.int64)
     match1.mask = True
 
     # this is the array of matches in pos2, -1 indicates no match found.
-    match2 = numpy.ma.zeros(npts2, dtype=numpy.int16)
+    match2 = numpy.ma.zeros(npts2, dtype=numpy.int64)
     match2.mask = True
 
     for idx1 in range(npts1):
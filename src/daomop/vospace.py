@@ -1,36 +1,204 @@
 """This module abstracts all vospace activities.  Including a switch to using username/password pairs."""
 from getpass import getpass
 from requests.auth import HTTPBasicAuth
-from vos.vos import Client, Connection
+from vos.vos import Client
+import atexit
+import collections
+import os
 import sys
+import time
 import types
 import netrc
 import logging
+import threading
+import six
+import metrics
+import webservice
 logging.getLogger('vos').setLevel(logging.ERROR)
 
 VOSPACE_SERVER = "www.canfar.phys.uvic.ca"
+VOS_PROTOCOL = "vos:"
+# set to trace the VOSpace calls of a process, see enable_tracing, and the number of calls to hold.
+TRACE_ENV = 'DAOMOP_TRACE_VOS'
+TRACE_SIZE_ENV = 'DAOMOP_TRACE_VOS_SIZE'
+TRACE_SIZE = 10000
+# calls that only read, making one of these again on the same URI is a redundant round trip.
+LOOKUP_METHODS = ['get_node', 'getNode', 'isdir', 'isfile', 'listdir', 'access', 'get_info', 'get_node_url',
+                  'status']
 
 
-class Wrapper(Client):
+class MeteredClient(Client):
+    """
+    A Client that times each call made to it, as metrics timer vospace.<method>.
+
+    Calls the Client makes to itself while answering a call are part of that call and not timed on their own.
+    """
+    _calls = threading.local()
 
     def __getattribute__(self, item):
         func = object.__getattribute__(self, item)
-        if isinstance(func, types.MethodType):
-            def my_func(*args, **kwargs):
-                sys.stderr.write("{} -> {} {}\n".format(item, args[1:], kwargs))
-                result = func(*args[1:], **kwargs)
-                sys.stderr.write("{} <- {}\n".format(item, result))
-                return result
-            meth = types.MethodType(my_func, self, Client)
-        elif isinstance(func, Connection):
-            sys.stderr.write("*-"*40+"\n")
-            meth = func
-        else:
-            meth = func
-
-        return meth
-
-client = Client()
+        if item.startswith('_') or not isinstance(func, types.MethodType):
+            return func
+        call = object.__getattribute__(self, '_call')
+
+        def timed(*args, **kwargs):
+            calls = MeteredClient._calls
+            if getattr(calls, 'active', False):
+                return func(*args, **kwargs)
+            calls.active = True
+            try:
+                return call(item, func, args, kwargs)
+            finally:
+                calls.active = False
+        return timed
+
+    def _call(self, method, func, args, kwargs):
+        with metrics.timer("vospace.{}".format(method)):
+            return func(*args, **kwargs)
+
+
+class Trace(object):
+    """
+    The most recent VOSpace calls, in a ring buffer, and the latency of all the calls of each method.
+
+    Each call is kept as a dict of: method, uri, start, seconds, bytes, retry and error.  A call is a retry when the
+    last call of the same method on the same URI failed.
+    """
+
+    def __init__(self, size=TRACE_SIZE):
+        self.calls = collections.deque(maxlen=size)
+        self.histograms = {}
+        self.counts = {}
+        self.retries = {}
+        self._failed = set()
+        self._lock = threading.Lock()
+
+    def record(self, method, uri, start, seconds, size=0, error=None):
+        key = (method, uri)
+        with self._lock:
+            retry = key in self._failed
+            if error is None:
+                self._failed.discard(key)
+            else:
+                self._failed.add(key)
+            if retry:
+                self.retries[method] = self.retries.get(method, 0) + 1
+            self.counts[key] = self.counts.get(key, 0) + 1
+            self.histograms.setdefault(method, webservice.LatencyHistogram()).record(seconds, error is not None)
+            self.calls.append({'method': method, 'uri': uri, 'start': start, 'seconds': seconds, 'bytes': size,
+                               'retry': retry, 'error': error is not None and str(error) or None})
+
+    def redundant(self):
+        """
+        The look ups made more than once on the same URI, most repeated first.
+
+        :return: list of (method, uri, calls)
+        """
+        with self._lock:
+            repeated = [(method, uri, count) for (method, uri), count in self.counts.items()
+                        if count > 1 and method in LOOKUP_METHODS]
+        return sorted(repeated, key=lambda item: (-item[2], item[0], item[1]))
+
+    def report(self, top=10):
+        """
+        :return: the latency histogram of each method, the slowest calls held and the most repeated look ups.
+        :rtype: str
+        """
+        with self._lock:
+            lines = ["VOSpace calls by method:"]
+            for method, histogram in sorted(self.histograms.items()):
+                lines.append("  {}: {}, {} retries".format(method, histogram, self.retries.get(method, 0)))
+            slowest = sorted(self.calls, key=lambda call: -call['seconds'])[:top]
+        if len(slowest) > 0:
+            lines.append("Slowest of the last {} calls:".format(self.calls.maxlen))
+            for call in slowest:
+                lines.append("  {seconds:.3f}s {method} {uri} {bytes} bytes{failed}".format(
+                    failed=call['error'] is not None and " failed" or "", **call))
+        redundant = self.redundant()
+        if len(redundant) > 0:
+            lines.append("Redundant look ups, {} URIs looked up more than once:".format(len(redundant)))
+            for method, uri, count in redundant[:top]:
+                lines.append("  {} x {} {}".format(count, method, uri))
+        return "\n".join(lines)
+
+
+def _call_uri(args, kwargs):
+    """
+    The URI a call is about, its first argument or the URI of the node given.
+    """
+    target = len(args) > 0 and args[0] or kwargs.get('uri', kwargs.get('node', None))
+    return getattr(target, 'uri', target)
+
+
+def _call_bytes(method, args):
+    """
+    The bytes a copy transferred, the size of its local end, 0 for the other calls.
+    """
+    if method != 'copy' or len(args) < 2:
+        return 0
+    for filename in args[:2]:
+        if isinstance(filename, six.string_types) and not filename.startswith(VOS_PROTOCOL) and \
+                os.path.isfile(filename):
+            return os.path.getsize(filename)
+    return 0
+
+
+class Wrapper(MeteredClient):
+    """
+    A Client that traces each call made to it, see Trace, as well as timing it.
+
+    Set DAOMOP_TRACE_VOS, or pass --trace-vos to a pipeline step, to use it as the client, see enable_tracing.
+    """
+
+    def __init__(self, *args, **kwargs):
+        self.trace = Trace(kwargs.pop('size', TRACE_SIZE))
+        super(Wrapper, self).__init__(*args, **kwargs)
+
+    def _call(self, method, func, args, kwargs):
+        start = time.time()
+        try:
+            result = super(Wrapper, self)._call(method, func, args, kwargs)
+        except Exception as ex:
+            self.trace.record(method, _call_uri(args, kwargs), start, time.time() - start, error=ex)
+            raise
+        self.trace.record(method, _call_uri(args, kwargs), start, time.time() - start, _call_bytes(method, args))
+        return result
+
+
+def _report_trace(trace, pid):
+    if pid == os.getpid():
+        sys.stderr.write(trace.report() + "\n")
+
+
+def enable_tracing(size=TRACE_SIZE):
+    """
+    Make the client a tracing Wrapper, whose trace is written to stderr when the process exits.
+
+    :param size: number of calls held in the ring buffer.
+    :rtype: Wrapper
+    """
+    global client
+    if not isinstance(client, Wrapper):
+        client = Wrapper(size=size)
+        atexit.register(_report_trace, client.trace, os.getpid())
+    return client
+
+
+def add_trace_argument(parser):
+    """
+    Add the --trace-vos option, that enable_tracing acts on, to the argument parser of a pipeline script.
+
+    :param parser: argparse.ArgumentParser
+    """
+    parser.add_argument("--trace-vos",
+                        action="store_true",
+                        help="trace the VOSpace calls, their latencies and redundant look ups are written to stderr "
+                             "on exit")
+
+
+client = MeteredClient()
+if os.environ.get(TRACE_ENV, '0') not in ['0', '']:
+    enable_tracing(int(os.environ.get(TRACE_SIZE_ENV, TRACE_SIZE)))
 
 #try:
 #    username, account, password = netrc.netrc().authenticators(VOSPACE_SERVER)
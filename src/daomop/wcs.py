@@ -8,12 +8,54 @@ import numpy
 import logging
 __author__ = "David Rusk <drusk@uvic.ca>"
 PI180 = 57.2957795130823208767981548141052
+PV_TOLERANCE = 0.001 / 3600
+
+
+class Distortion(object):
+    """
+    The tangent point, CD matrix (and its inverse) and PV coefficients of a header, parsed once.
+
+    A Distortion holds only plain numbers so it can be saved next to the header it came from, see to_dict.
+    """
+
+    def __init__(self, crpix1, crpix2, crval1, crval2, cd, pv, nord):
+        self.crpix1 = float(crpix1)
+        self.crpix2 = float(crpix2)
+        self.crval1 = float(crval1)
+        self.crval2 = float(crval2)
+        self.cd = [[float(value) for value in row] for row in cd]
+        self.dc = numpy.linalg.inv(self.cd)
+        self.pv = [[float(value) for value in row] for row in pv]
+        self.nord = int(nord)
+
+    @classmethod
+    def from_header(cls, header):
+        """
+        :param header: header with the CRPIX, CRVAL, CD, PV and NORDFIT keywords.
+        :rtype: Distortion
+        """
+        return cls(header['CRPIX1'], header['CRPIX2'], header['CRVAL1'], header['CRVAL2'],
+                   parse_cd(header), parse_pv(header), parse_order_fit(header))
+
+    def to_dict(self):
+        return {'crpix1': self.crpix1, 'crpix2': self.crpix2,
+                'crval1': self.crval1, 'crval2': self.crval2,
+                'cd': self.cd, 'pv': self.pv, 'nord': self.nord}
+
+    @classmethod
+    def from_dict(cls, values):
+        """
+        Build the distortion from the dictionary returned by to_dict.
+        """
+        return cls(**values)
 
 
 class WCS(astropy_wcs.WCS):
-    def __init__(self, header):
+    def __init__(self, header, distortion=None):
         """
         Create the bits needed for working with sky2xy
+
+        :param distortion: the already parsed Distortion of header, built from the header when first needed if None.
         """
         astropy_header = deepcopy(header)
         del (astropy_header['PV*'])
@@ -23,63 +65,75 @@ class WCS(astropy_wcs.WCS):
                 "ignore", astropy_wcs.FITSFixedWarning, append=True)
             super(WCS, self).__init__(astropy_header)
         self.header = header
+        self._distortion = distortion
+        self._pv_inverse = None
+
+    @property
+    def distortion(self):
+        """
+        The parsed distortion model of the header.
+
+        :rtype: Distortion
+        """
+        if self._distortion is None:
+            self._distortion = Distortion.from_header(self.header)
+        return self._distortion
 
     @property
     def cd(self):
         """
         CD Rotation matrix values.
         """
-        return parse_cd(self.header)
+        return self.distortion.cd
 
     @property
     def dc(self):
         """
         CD Rotation matrix INVERTED i.e.  []^-1
         """
-
-        return numpy.array(numpy.mat(self.cd).I)
+        return self.distortion.dc
 
     @property
     def pv(self):
         """
         Array of PV keywords used for hi-odered astrogwyn mapping
         """
-        return parse_pv(self.header)
+        return self.distortion.pv
 
     @property
     def crpix1(self):
         """
         1st reference coordinate
         """
-        return self.header['CRPIX1']
+        return self.distortion.crpix1
 
     @property
     def crpix2(self):
         """
         2nd reference coordinate
         """
-        return self.header['CRPIX2']
+        return self.distortion.crpix2
 
     @property
     def crval1(self):
         """
         Reference Coordinate of 1st reference pixel
         """
-        return self.header['CRVAL1']
+        return self.distortion.crval1
 
     @property
     def crval2(self):
         """
         Reference Coordinate of 2nd reference pixel
         """
-        return self.header['CRVAL2']
+        return self.distortion.crval2
 
     @property
     def nord(self):
         """
         The order of the PV fit, provided by astgwyn
         """
-        return self.header['NORDFIT']
+        return self.distortion.nord
 
     def xy2sky(self, x, y, usepv=True):
         if usepv:
@@ -99,7 +153,27 @@ class WCS(astropy_wcs.WCS):
         pos = self.wcs_pix2world(xy, 1).transpose()
         return pos[0] * units.degree, pos[1] * units.degree
 
+    @property
+    def pv_inverse(self):
+        """
+        Polynomial approximation of the inverse PV distortion over the image, used to start sky2xypv.
+
+        :return: the inverse or None if the header has no distortion or image size.
+        :rtype: PVInverse
+        """
+        if self._pv_inverse is None:
+            if self.nord < 0 or 'NAXIS1' not in self.header or 'NAXIS2' not in self.header:
+                return None
+            self._pv_inverse = PVInverse.from_image(self.header['NAXIS1'], self.header['NAXIS2'],
+                                                    self.crpix1, self.crpix2, self.cd, self.pv, self.nord)
+        return self._pv_inverse
+
     def sky2xy(self, ra, dec, usepv=True):
+        """
+        Convert sky positions to pixel positions, ra/dec may be scalars or arrays.
+
+        :return: x, y of the same shape as ra/dec.
+        """
         if isinstance(ra, Quantity):
             ra = ra.to(units.degree).value
         if isinstance(dec, Quantity):
@@ -114,15 +188,246 @@ class WCS(astropy_wcs.WCS):
                                 crval2=self.crval2,
                                 dc=self.dc,
                                 pv=self.pv,
-                                nord=self.nord)
+                                nord=self.nord,
+                                inverse=self.pv_inverse)
         except Exception as ex:
-            logger.warning("sky2xy raised exception: {0}".format(ex))
-            logger.warning("Reverted to CD-Matrix WCS to convert: {0} {1} ".format(ra, dec))
-        pos = self.wcs_world2pix([[ra, dec], ], 1)
-        return pos[0][0], pos[0][1]
+            logging.warning("sky2xy raised exception: {0}".format(ex))
+            logging.warning("Reverted to CD-Matrix WCS to convert: {0} {1} ".format(ra, dec))
+        pos = self.wcs_world2pix(numpy.transpose((numpy.atleast_1d(ra), numpy.atleast_1d(dec))), 1)
+        if numpy.ndim(ra) == 0:
+            return pos[0][0], pos[0][1]
+        return pos[:, 0], pos[:, 1]
+
+
+class PVInverse(object):
+    """
+    Least squares polynomial fit of the undistorted coordinates as a function of the distorted ones (xi, eta).
+
+    Where the fit is better than the Newton tolerance sky2xypv uses it directly for positions inside the fitted
+    region, otherwise it is the starting point of the Newton iterations.
+    """
+
+    def __init__(self, x, y, pv, nord, order=5):
+        """
+        :param x: undistorted coordinates, degrees, spanning the region the inverse is needed for.
+        :param y: undistorted coordinates, degrees.
+        :param order: order of the inverse polynomial.
+        """
+        xi, eta = pv_distort(x, y, pv, nord)[0:2]
+        self.order = order
+        self.offset = (xi.mean(), eta.mean())
+        self.scale = max(numpy.ptp(xi), numpy.ptp(eta), 1e-10)
+        self.bounds = (xi.min(), xi.max(), eta.min(), eta.max())
+        design = self._design(xi, eta)
+        self.coefficients = numpy.linalg.lstsq(design, numpy.transpose((x, y)), rcond=-1)[0]
+        self.max_residual = numpy.fabs(design.dot(self.coefficients) - numpy.transpose((x, y))).max()
+
+    @classmethod
+    def from_image(cls, naxis1, naxis2, crpix1, crpix2, cd, pv, nord, margin=0.1, npts=30, order=5):
+        """
+        Fit the inverse over an image of naxis1 by naxis2 pixels, plus a margin around the edges.
+        """
+        x, y = numpy.meshgrid(numpy.linspace(-margin * naxis1, (1 + margin) * naxis1, npts),
+                              numpy.linspace(-margin * naxis2, (1 + margin) * naxis2, npts))
+        xp = x.ravel() - crpix1
+        yp = y.ravel() - crpix2
+        return cls(cd[0][0] * xp + cd[0][1] * yp, cd[1][0] * xp + cd[1][1] * yp, pv, nord, order=order)
+
+    def _design(self, xi, eta):
+        u = (xi - self.offset[0]) / self.scale
+        v = (eta - self.offset[1]) / self.scale
+        return numpy.column_stack([u ** i * v ** j
+                                   for i in range(self.order + 1) for j in range(self.order + 1 - i)])
+
+    def covers(self, xi, eta):
+        """
+        :return: mask of the positions inside the region the inverse was fitted over.
+        """
+        return (xi >= self.bounds[0]) & (xi <= self.bounds[1]) & (eta >= self.bounds[2]) & (eta <= self.bounds[3])
+
+    def __call__(self, xi, eta):
+        """
+        :return: the approximate undistorted coordinates of xi, eta.
+        """
+        result = self._design(xi, eta).dot(self.coefficients)
+        return result[:, 0], result[:, 1]
+
+
+def sky2xypv(ra, dec, crpix1, crpix2, crval1, crval2, dc, pv, nord, maxiter=300, inverse=None):
+    """
+    Transforms from celestial coordinates to pixel coordinates to taking
+    non-linear distortion into account with the World Coordinate System
+    FITS keywords as used in MegaPipe.
+
+    Arrays of positions are converted together, the Newton iterations run on all the points that have not yet
+    converged at once.  For the scalar reference implementation see sky2xypv_scalar.
 
+    Args:
+      ra: float or array
+        Right ascension
+      dec: float or array
+        Declination
+      crpix1, crpix2, crval1, crval2, dc, pv, nord, maxiter:
+        as for sky2xypv_scalar
+      inverse: PVInverse
+        optional approximate inverse of the distortion, used as the starting point of the Newton iterations.
+
+    Returns:
+      x, y: float or array
+        Pixel coordinates, scalars if ra and dec are scalars.
+    """
+    scalar = numpy.ndim(ra) == 0 and numpy.ndim(dec) == 0
+    ra = numpy.array(ra, dtype=numpy.float64, ndmin=1)
+    dec = numpy.array(dec, dtype=numpy.float64, ndmin=1)
+
+    wrap = numpy.fabs(ra - crval1) > 100
+    ra[wrap] += crval1 < 180 and -360 or 360
+
+    ra = ra / PI180
+    dec = dec / PI180
+
+    tdec = numpy.tan(dec)
+    ra0 = crval1 / PI180
+    dec0 = crval2 / PI180
+    ctan = numpy.tan(dec0)
+    ccos = numpy.cos(dec0)
+
+    traoff = numpy.tan(ra - ra0)
+    craoff = numpy.cos(ra - ra0)
+    etar = (1 - ctan * craoff / tdec) / (ctan + craoff / tdec)
+    xir = traoff * ccos * (1 - etar * ctan)
+    xi = xir * PI180
+    eta = etar * PI180
+
+    if nord < 0:
+        # The simple solution
+        x = xi
+        y = eta
+    else:
+        if inverse is not None:
+            x, y = inverse(xi, eta)
+        else:
+            x, y = xi.copy(), eta.copy()
+        # the fast path: where the fitted inverse is known to be within tolerance there is nothing to iterate.
+        solve = numpy.ones(len(x), dtype=bool)
+        if inverse is not None and inverse.max_residual < PV_TOLERANCE:
+            solve = ~inverse.covers(xi, eta)
+        if solve.any():
+            x[solve], y[solve], converged = pv_newton(xi[solve], eta[solve], x[solve], y[solve], pv, nord,
+                                                      maxiter=maxiter)
+            if not converged.all():
+                logging.debug("sky2xypv: {} of {} positions did not converge".format((~converged).sum(), len(x)))
 
-def sky2xypv(ra, dec, crpix1, crpix2, crval1, crval2, dc, pv, nord, maxiter=300):
+    xp = dc[0][0] * x + dc[0][1] * y
+    yp = dc[1][0] * x + dc[1][1] * y
+
+    x = xp + crpix1
+    y = yp + crpix2
+
+    if scalar:
+        return float(x[0]), float(y[0])
+    return x, y
+
+
+def pv_distort(x, y, pv, nord):
+    """
+    Apply the PV distortion polynomial to undistorted coordinates.
+
+    Args:
+      x, y: array
+        undistorted coordinates, degrees.
+      pv: 2d array
+      nord: int
+        order of the fit, must be >= 0
+
+    Returns:
+      f, g, fx, fy, gx, gy: array
+        the distorted coordinates (xi, eta) and their derivatives with respect to x and y.
+    """
+    f = numpy.zeros(len(x)) + pv[0][0]
+    g = numpy.zeros(len(x)) + pv[1][0]
+    fx = numpy.zeros(len(x))
+    fy = numpy.zeros(len(x))
+    gx = numpy.zeros(len(x))
+    gy = numpy.zeros(len(x))
+
+    if nord >= 1:
+        r = numpy.sqrt(x ** 2 + y ** 2)
+        # the radial term has no derivative at the origin, its coefficient is normally zero anyway.
+        safe_r = numpy.where(r > 0, r, 1.0)
+        xr = numpy.where(r > 0, x / safe_r, 0.0)
+        yr = numpy.where(r > 0, y / safe_r, 0.0)
+        f += pv[0][1] * x + pv[0][2] * y + pv[0][3] * r
+        g += pv[1][1] * y + pv[1][2] * x + pv[1][3] * r
+        fx += pv[0][1] + pv[0][3] * xr
+        fy += pv[0][2] + pv[0][3] * yr
+        gx += pv[1][2] + pv[1][3] * xr
+        gy += pv[1][1] + pv[1][3] * yr
+
+    if nord >= 2:
+        x2 = x ** 2
+        xy = x * y
+        y2 = y ** 2
+
+        f += pv[0][4] * x2 + pv[0][5] * xy + pv[0][6] * y2
+        g += pv[1][4] * y2 + pv[1][5] * xy + pv[1][6] * x2
+        fx += pv[0][4] * 2 * x + pv[0][5] * y
+        fy += pv[0][5] * x + pv[0][6] * 2 * y
+        gx += pv[1][5] * y + pv[1][6] * 2 * x
+        gy += pv[1][4] * 2 * y + pv[1][5] * x
+
+    if nord >= 3:
+        x3 = x ** 3
+        x2y = x2 * y
+        xy2 = x * y2
+        y3 = y ** 3
+
+        f += pv[0][7] * x3 + pv[0][8] * x2y + pv[0][9] * xy2 + pv[0][10] * y3
+        g += pv[1][7] * y3 + pv[1][8] * xy2 + pv[1][9] * x2y + pv[1][10] * x3
+        fx += pv[0][7] * 3 * x2 + pv[0][8] * 2 * xy + pv[0][9] * y2
+        fy += pv[0][8] * x2 + pv[0][9] * 2 * xy + pv[0][10] * 3 * y2
+        gx += pv[1][8] * y2 + pv[1][9] * 2 * xy + pv[1][10] * 3 * x2
+        gy += pv[1][7] * 3 * y2 + pv[1][8] * 2 * xy + pv[1][9] * x2
+
+    return f, g, fx, fy, gx, gy
+
+
+def pv_newton(xi, eta, x, y, pv, nord, tolerance=PV_TOLERANCE, maxiter=300):
+    """
+    Invert the PV distortion by Newton's method, iterating only on the points that have not yet converged.
+
+    Args:
+      xi, eta: array
+        distorted coordinates, degrees.
+      x, y: array
+        starting guess of the undistorted coordinates, updated in place.
+
+    Returns:
+      x, y, converged: array
+        the undistorted coordinates and a mask of the points that converged within tolerance.
+    """
+    x = numpy.array(x, dtype=numpy.float64)
+    y = numpy.array(y, dtype=numpy.float64)
+    active = numpy.ones(len(x), dtype=bool)
+    for iteration in range(maxiter + 1):
+        idx = numpy.flatnonzero(active)
+        if len(idx) == 0:
+            break
+        f, g, fx, fy, gx, gy = pv_distort(x[idx], y[idx], pv, nord)
+        f -= xi[idx]
+        g -= eta[idx]
+        det = fx * gy - fy * gx
+        dx = (-f * gy + g * fy) / det
+        dy = (-g * fx + f * gx) / det
+        x[idx] += dx
+        y[idx] += dy
+        active[idx[(numpy.fabs(dx) < tolerance) & (numpy.fabs(dy) < tolerance)]] = False
+        # there is no point iterating on positions that can not be solved.
+        active[idx[~numpy.isfinite(dx) | ~numpy.isfinite(dy)]] = False
+    return x, y, ~active & numpy.isfinite(x) & numpy.isfinite(y)
+
+
+def sky2xypv_scalar(ra, dec, crpix1, crpix2, crval1, crval2, dc, pv, nord, maxiter=300):
     """
     Transforms from celestial coordinates to pixel coordinates to taking
     non-linear distortion into account with the World Coordinate System
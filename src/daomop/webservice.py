@@ -0,0 +1,223 @@
+"""A shared HTTP client for the TAP, SSOIS and Horizons web services.
+
+All queries go through one requests.Session so connections are pooled and kept alive between calls.  Failed
+requests (connection errors, timeouts and 5xx responses) are retried with jittered exponential backoff, and the
+latency of each call is recorded in a histogram per endpoint, see latency_report.
+
+The pool size is set by DAOMOP_HTTP_POOL_SIZE and the number of retries by DAOMOP_HTTP_RETRIES.  TLS certificates
+are verified, except for the hosts listed in DAOMOP_HTTP_UNVERIFIED_HOSTS, by default the CADC services."""
+import logging
+import os
+import random
+import threading
+import time
+
+import requests
+from astropy.io import ascii
+from astropy.io.votable import parse
+from six.moves.urllib.parse import urlsplit
+
+POOL_SIZE_ENV = 'DAOMOP_HTTP_POOL_SIZE'
+RETRIES_ENV = 'DAOMOP_HTTP_RETRIES'
+UNVERIFIED_HOSTS_ENV = 'DAOMOP_HTTP_UNVERIFIED_HOSTS'
+DEFAULT_POOL_SIZE = 10
+DEFAULT_RETRIES = 5
+BACKOFF = 0.5
+MAX_BACKOFF = 30.0
+TIMEOUT = 300
+VERIFY = True
+# the CADC services have long been queried without checking their certificates, other hosts are verified.
+UNVERIFIED_HOSTS = ('www.cadc-ccda.hia-iha.nrc-cnrc.gc.ca', 'www.canfar.phys.uvic.ca')
+# upper edges of the latency histogram bins, seconds.
+LATENCY_BINS = (0.01, 0.03, 0.1, 0.3, 1.0, 3.0, 10.0, 30.0, 100.0)
+
+_client = None
+_client_lock = threading.Lock()
+
+try:
+    requests.packages.urllib3.disable_warnings()
+except Exception:
+    pass
+
+
+class LatencyHistogram(object):
+    """
+    Count of calls by latency, in the bins given by LATENCY_BINS plus an overflow bin.
+    """
+
+    def __init__(self, bins=LATENCY_BINS):
+        self.bins = bins
+        self.counts = [0] * (len(bins) + 1)
+        self.total = 0.0
+        self.failures = 0
+
+    def record(self, elapsed, failed=False):
+        idx = 0
+        while idx < len(self.bins) and elapsed > self.bins[idx]:
+            idx += 1
+        self.counts[idx] += 1
+        self.total += elapsed
+        if failed:
+            self.failures += 1
+
+    @property
+    def calls(self):
+        return sum(self.counts)
+
+    def __str__(self):
+        labels = ["<{}s".format(edge) for edge in self.bins] + [">{}s".format(self.bins[-1])]
+        counts = " ".join(["{}:{}".format(label, count) for label, count in zip(labels, self.counts) if count > 0])
+        return "{} calls, {} failed, {:.3f}s mean [{}]".format(self.calls, self.failures,
+                                                               self.total / max(self.calls, 1), counts)
+
+
+class Client(object):
+    """
+    Pooled, keep-alive, HTTP client with retries.
+    """
+
+    def __init__(self, pool_size=None, retries=None, verify=VERIFY, timeout=TIMEOUT, unverified_hosts=None):
+        """
+        :param verify: check the TLS certificates of the hosts not in unverified_hosts.
+        :param unverified_hosts: hosts whose certificates are not checked, default is DAOMOP_HTTP_UNVERIFIED_HOSTS,
+        a comma separated list, or UNVERIFIED_HOSTS.
+        """
+        if unverified_hosts is None:
+            unverified_hosts = os.environ.get(UNVERIFIED_HOSTS_ENV, ",".join(UNVERIFIED_HOSTS)).split(",")
+        self.unverified_hosts = set([host.strip() for host in unverified_hosts if len(host.strip()) > 0])
+        if pool_size is None:
+            pool_size = int(os.environ.get(POOL_SIZE_ENV, DEFAULT_POOL_SIZE))
+        if retries is None:
+            retries = int(os.environ.get(RETRIES_ENV, DEFAULT_RETRIES))
+        self.retries = retries
+        self.verify = verify
+        self.timeout = timeout
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.histograms = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def endpoint(url):
+        """
+        The endpoint, the url without its query, that latencies are recorded against.
+        """
+        parts = urlsplit(url)
+        return "{}://{}{}".format(parts.scheme, parts.netloc, parts.path)
+
+    def _record(self, url, elapsed, failed=False):
+        with self._lock:
+            self.histograms.setdefault(self.endpoint(url), LatencyHistogram()).record(elapsed, failed)
+
+    def request(self, method, url, **kwargs):
+        """
+        Send a request, retrying connection errors, timeouts and server errors with jittered exponential backoff.
+
+        :param method: HTTP method, GET or POST.
+        :param url: URL to send the request to.
+        :param kwargs: passed on to requests.Session.request, eg. params, data, stream.
+        :return: the response, its status has been checked.
+        :rtype: requests.Response
+        """
+        kwargs.setdefault('verify', self.verify and urlsplit(url).hostname not in self.unverified_hosts)
+        kwargs.setdefault('timeout', self.timeout)
+        attempt = 0
+        while True:
+            start = time.time()
+            try:
+                response = self.session.request(method, url, **kwargs)
+                if response.status_code < 500 or attempt >= self.retries:
+                    response.raise_for_status()
+                    self._record(url, time.time() - start)
+                    return response
+                error = requests.HTTPError("{} Server Error for url: {}".format(response.status_code, url),
+                                           response=response)
+                response.close()
+            except (requests.ConnectionError, requests.Timeout) as ex:
+                if attempt >= self.retries:
+                    self._record(url, time.time() - start, failed=True)
+                    raise
+                error = ex
+            except requests.HTTPError:
+                self._record(url, time.time() - start, failed=True)
+                raise
+            self._record(url, time.time() - start, failed=True)
+            delay = random.uniform(0, min(MAX_BACKOFF, BACKOFF * 2 ** attempt))
+            attempt += 1
+            logging.warning("{} {} failed ({}), retry {} of {} in {:.1f}s".format(method, url, error, attempt,
+                                                                                 self.retries, delay))
+            time.sleep(delay)
+
+    def get(self, url, **kwargs):
+        return self.request('GET', url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request('POST', url, **kwargs)
+
+    def latency_report(self):
+        """
+        :return: one line summarizing the latency histogram of each endpoint called.
+        :rtype: str
+        """
+        with self._lock:
+            return "\n".join(["{}: {}".format(endpoint, histogram)
+                              for endpoint, histogram in sorted(self.histograms.items())])
+
+
+def get_client():
+    """
+    The process wide client, built on first use.
+
+    :rtype: Client
+    """
+    global _client
+    with _client_lock:
+        if _client is None:
+            _client = Client()
+    return _client
+
+
+def get(url, **kwargs):
+    return get_client().get(url, **kwargs)
+
+
+def post(url, **kwargs):
+    return get_client().post(url, **kwargs)
+
+
+def latency_report():
+    """
+    :return: latency summary of the web service calls made by this process, empty if there were none.
+    """
+    if _client is None:
+        return ""
+    return _client.latency_report()
+
+
+def read_tsv(response):
+    """
+    Read a tab separated table from a streamed response.
+
+    :type response: requests.Response
+    :rtype: astropy.table.Table
+    """
+    table_reader = ascii.get_reader(Reader=ascii.Basic)
+    table_reader.header.splitter.delimiter = '\t'
+    table_reader.data.splitter.delimiter = '\t'
+    return table_reader.read([line.decode('utf-8') if isinstance(line, bytes) else line
+                              for line in response.iter_lines()])
+
+
+def read_votable(response):
+    """
+    Parse a VOTable directly from a streamed response.
+
+    :type response: requests.Response
+    :return: the first table in the VOTable
+    :rtype: astropy.io.votable.tree.Table
+    """
+    # let urllib3 undo any content-encoding as the parser reads.
+    response.raw.decode_content = True
+    return parse(response.raw).get_first_table()
@@ -26,7 +26,9 @@ if sys.version_info[0] > 2:
 #        scripts.append(os.path.join(script_dir, script))
 
 console_scripts = [ 'populate = daomop.populate:main', 'stationary = daomop.stationary:main', 'build_cat = daomop.build_cat:main', 
-                     'hpx_map = daomop.hpx_map:main']
+                     'hpx_map = daomop.hpx_map:main', 'footprint_index = daomop.footprint:main',
+                     'pipeline = daomop.pipeline:main', 'canfar_job_builder = daomop.canfar_job_builder:main',
+                     'daomop_metrics = daomop.metrics:main']
 
 setup(name='daomop',
       version=version,
@@ -0,0 +1,97 @@
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+
+import numpy
+from astropy.io import fits
+from mock import patch, PropertyMock
+
+import build_cat
+import storage
+
+
+def _process(expnum, ccd):
+    if ccd == 2:
+        raise OSError("sex failed")
+    open("{}.cat.fits".format(ccd), 'w').close()
+
+
+class TestRunParallel(TestCase):
+    """
+    Check the stages of build_cat.run_parallel are chained together and report a status per CCD.
+    """
+
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.directory = tempfile.mkdtemp()
+        os.chdir(self.directory)
+        open('1000001p.head', 'w').close()
+        for target, kwargs in [('storage.get_statuses', {'return_value': {0: True, 1: False, 2: False, 3: False}}),
+                               ('build_cat.retrieve', {}),
+                               ('build_cat.store', {}),
+                               ('build_cat.process', {'side_effect': _process})]:
+            patcher = patch(target, **kwargs)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        shutil.rmtree(self.directory)
+
+    def test_run_parallel(self):
+        messages = build_cat.run_parallel('1000001', range(4), 'p', '', True, False, jobs=2)
+        self.assertEqual(sorted(messages.keys()), [1, 2, 3])
+        self.assertEqual(messages[1], storage.SUCCESS)
+        self.assertEqual(messages[2], "sex failed")
+        # each CCD is processed in its own directory.
+        self.assertTrue(os.access(os.path.join('1000001p03', '3.cat.fits'), os.F_OK))
+        self.assertFalse(build_cat.store.called)
+
+    def test_mef_failure_falls_back(self):
+        with patch('build_cat.retrieve_mef', side_effect=IOError("MEF transfer failed")):
+            messages = build_cat.run_parallel('1000001', range(4), 'p', '', True, False, jobs=2, mef=True)
+        self.assertEqual(messages[1], storage.SUCCESS)
+        self.assertEqual(sorted([call[0][1] for call in build_cat.retrieve.call_args_list]), [1, 2, 3])
+
+
+class TestRetrieveMef(TestCase):
+    """
+    Check the whole MEF image and flat field are retrieved once and split into the per-CCD files.
+    """
+
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.directory = tempfile.mkdtemp()
+        os.chdir(self.directory)
+        self.sources = {}
+        for uri, filename in [(storage.Image(storage.Observation('1000001')).uri, 'source.fits'),
+                              (storage.Image(storage.Observation('weight', dbimages=storage.FLATS_VOSPACE),
+                                             subdir="", ext=".fits", version="").uri, 'source_weight.fits')]:
+            hdulist = fits.HDUList([fits.PrimaryHDU()])
+            for ccd in range(3):
+                hdulist.append(fits.ImageHDU(data=numpy.zeros((4, 4)) + ccd))
+            hdulist.writeto(filename)
+            self.sources[uri] = filename
+        for target, kwargs in [('storage.copy', {'side_effect': lambda uri, filename: shutil.copy(
+                                                   self.sources[uri], filename)}),
+                               ('storage.Image.flat_field_name', {'new_callable': PropertyMock,
+                                                                  'return_value': 'weight'})]:
+            patcher = patch(target, **kwargs)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        shutil.rmtree(self.directory)
+
+    def test_retrieve_mef(self):
+        saved = build_cat.retrieve_mef('1000001', [1, 2])
+        self.assertEqual(storage.copy.call_count, 2)
+        self.assertEqual(saved, 2)
+        self.assertEqual(fits.open('1000001p02.fits')[0].data[0][0], 2)
+        self.assertEqual(fits.open('weight01.fits')[0].data[0][0], 1)
+        self.assertFalse(os.access('1000001p00.fits', os.F_OK))
+        # nothing left to retrieve.
+        self.assertEqual(build_cat.retrieve_mef('1000001', [1, 2]), 0)
+        self.assertEqual(storage.copy.call_count, 2)
@@ -0,0 +1,208 @@
+import errno
+import os
+import shutil
+import tempfile
+import time
+from unittest import TestCase
+
+from astropy.table import Table
+from mock import patch, Mock
+
+import cache
+import storage
+
+
+class TestArtifactCache(TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.cache = cache.ArtifactCache(os.path.join(self.directory, 'cache'), max_bytes=250)
+        self.fetched = []
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def fetch(self, uri, filename):
+        self.fetched.append(uri)
+        with open(filename, 'w') as fout:
+            fout.write(100 * 'x')
+
+    def destination(self, name):
+        return os.path.join(self.directory, name)
+
+    def test_hit_after_miss(self):
+        self.cache.get('vos:a/b.fits', self.destination('1.fits'), 'md5a', 100, self.fetch)
+        self.cache.get('vos:a/b.fits', self.destination('2.fits'), 'md5a', 100, self.fetch)
+        self.assertEqual(self.fetched, ['vos:a/b.fits'])
+        self.assertEqual(open(self.destination('2.fits')).read(), 100 * 'x')
+        self.assertEqual(self.cache.stats, {'hits': 1, 'misses': 1, 'bytes_saved': 100, 'bytes_fetched': 100})
+
+    def test_changed_node_is_a_miss(self):
+        self.cache.get('vos:a/b.fits', self.destination('1.fits'), 'md5a', 100, self.fetch)
+        self.cache.get('vos:a/b.fits', self.destination('2.fits'), 'md5b', 100, self.fetch)
+        self.assertEqual(len(self.fetched), 2)
+
+    def test_least_recently_used_is_evicted(self):
+        for name in ['vos:a', 'vos:b']:
+            self.cache.get(name, self.destination('x.fits'), 'md5', 100, self.fetch)
+        # make sure the next access of vos:a is recorded as more recent than vos:b
+        old = time.time() - 100
+        os.utime(self.cache.path(self.cache.key('vos:b', 'md5', 100)), (old, old))
+        self.cache.get('vos:a', self.destination('x.fits'), 'md5', 100, self.fetch)
+        self.cache.get('vos:c', self.destination('x.fits'), 'md5', 100, self.fetch)
+        self.assertTrue(os.access(self.cache.path(self.cache.key('vos:a', 'md5', 100)), os.F_OK))
+        self.assertFalse(os.access(self.cache.path(self.cache.key('vos:b', 'md5', 100)), os.F_OK))
+        self.assertEqual(len(self.cache.entries()), 2)
+
+    def test_size_tracked(self):
+        with patch.object(self.cache, 'entries', wraps=self.cache.entries) as entries:
+            for name in ['vos:a', 'vos:b']:
+                self.cache.get(name, self.destination('x.fits'), 'md5', 100, self.fetch)
+            # the cache is measured once, then only walked again when it is full.
+            self.assertEqual(entries.call_count, 1)
+            self.cache.get('vos:c', self.destination('x.fits'), 'md5', 100, self.fetch)
+            self.assertEqual(entries.call_count, 2)
+        self.assertEqual(len(self.cache.entries()), 2)
+
+    def test_checksum_reused(self):
+        nodes = []
+
+        def get_node(this, uri, **kwargs):
+            nodes.append(uri)
+            return Mock(props={'MD5': 'md5{}'.format(len(nodes)), 'length': 100}, islink=Mock(return_value=False))
+
+        for target, value in [('storage.get_artifact_cache', lambda: self.cache),
+                              ('storage._copy', lambda source, destination: (destination.startswith('vos:') or
+                                                                             self.fetch(source, destination))),
+                              ('storage._checksum_cache', {}),
+                              ('vos.vos.Client.get_node', get_node)]:
+            patcher = patch(target, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        storage.copy('vos:a/b.fits', self.destination('1.fits'))
+        storage.copy('vos:a/b.fits', self.destination('2.fits'))
+        self.assertEqual((nodes, self.fetched), (['vos:a/b.fits'], ['vos:a/b.fits']))
+        # an upload replaces the node, so its checksum is looked up again.
+        storage.copy(self.destination('1.fits'), 'vos:a/b.fits')
+        storage.copy('vos:a/b.fits', self.destination('2.fits'))
+        self.assertEqual(len(nodes), 2)
+        self.assertEqual(self.fetched, ['vos:a/b.fits', 'vos:a/b.fits'])
+
+    def test_failed_fetch_leaves_no_entry(self):
+        def fail(uri, filename):
+            raise IOError("transfer failed")
+        self.assertRaises(IOError, self.cache.get, 'vos:a', self.destination('x.fits'), 'md5', 100, fail)
+        self.assertEqual(self.cache.entries(), [])
+
+
+class TestQueryCache(TestCase):
+
+    QUERY = "SELECT expnum, RA FROM caom2.Observation WHERE  proposal_title LIKE '%cfis  %'"
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.cache = cache.QueryCache(os.path.join(self.directory, 'tap'), ttl=60)
+        self.queries = []
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def fetch(self, query):
+        self.queries.append(query)
+        return Table([[1000001, 1000002], [10.5, 11.0], [u'r.MP9602', u'r.MP9601']], names=('expnum', 'RA', 'filter'))
+
+    def test_hit_within_ttl(self):
+        self.cache.get(self.QUERY, 'tsv', self.fetch)
+        table = self.cache.get(self.QUERY, 'tsv', self.fetch)
+        self.assertEqual(len(self.queries), 1)
+        self.assertEqual(list(table['expnum']), [1000001, 1000002])
+        self.assertEqual([str(value) for value in table['filter']], ['r.MP9602', 'r.MP9601'])
+        self.assertEqual((self.cache.hits, self.cache.misses), (1, 1))
+
+    def test_expired(self):
+        self.cache.get(self.QUERY, 'tsv', self.fetch)
+        old = time.time() - 120
+        os.utime(self.cache.path(self.cache.key(self.QUERY, 'tsv')), (old, old))
+        self.cache.get(self.QUERY, 'tsv', self.fetch)
+        self.assertEqual(len(self.queries), 2)
+
+    def test_refresh_and_format(self):
+        self.cache.get(self.QUERY, 'tsv', self.fetch)
+        self.cache.get(self.QUERY, 'tsv', self.fetch, refresh=True)
+        self.cache.get(self.QUERY, 'votable', self.fetch)
+        self.assertEqual(len(self.queries), 3)
+
+    def test_normalized(self):
+        self.cache.get(self.QUERY, 'tsv', self.fetch)
+        self.cache.get("SELECT expnum,RA\n  FROM caom2.Observation\n WHERE proposal_title LIKE '%cfis  %' ",
+                       'tsv', self.fetch)
+        self.assertEqual(len(self.queries), 1)
+        # white space inside quoted literals is significant.
+        self.assertNotEqual(cache.normalize_query("x = 'a  b'"), cache.normalize_query("x = 'a b'"))
+
+    def test_invalidate(self):
+        self.cache.get(self.QUERY, 'tsv', self.fetch)
+        self.cache.get("SELECT 1 FROM caom2.Plane", 'tsv', self.fetch)
+        self.assertEqual(self.cache.invalidate(pattern='caom2.Plane'), 1)
+        self.assertEqual(self.cache.invalidate(query=self.QUERY, fmt='tsv'), 1)
+        self.assertEqual(self.cache.invalidate(), 0)
+        self.cache.get(self.QUERY, 'tsv', self.fetch)
+        self.assertEqual(len(self.queries), 3)
+
+    def test_opt_in(self):
+        environ = dict([(key, value) for key, value in os.environ.items()
+                        if key not in [cache.QUERY_CACHE_DIR_ENV, cache.QUERY_CACHE_TTL_ENV]])
+        with patch.dict('os.environ', environ, clear=True):
+            self.assertIsNone(cache.QueryCache.from_environment())
+            os.environ[cache.QUERY_CACHE_DIR_ENV] = os.path.join(self.directory, 'opt_in')
+            self.assertEqual(cache.QueryCache.from_environment().ttl, cache.DEFAULT_QUERY_CACHE_TTL)
+            os.environ[cache.QUERY_CACHE_TTL_ENV] = '0'
+            self.assertIsNone(cache.QueryCache.from_environment())
+
+
+class TestDirectoryCache(TestCase):
+
+    def setUp(self):
+        self.directories = cache.DirectoryCache()
+        self.existing = set(['vos:cfis', 'vos:cfis/dbimages'])
+        self.probed = []
+        self.created = []
+
+    def isdir(self, dirname):
+        self.probed.append(dirname)
+        return dirname in self.existing
+
+    def mkdir(self, dirname):
+        if os.path.dirname(dirname) not in self.existing:
+            raise OSError(2, "parent missing", dirname)
+        self.created.append(dirname)
+        self.existing.add(dirname)
+
+    def test_bulk_ensure(self):
+        dirnames = ['vos:cfis/dbimages/1000001/ccd{:02d}'.format(ccd) for ccd in range(40)]
+        self.directories.ensure(dirnames + dirnames, self.isdir, self.mkdir)
+        self.assertEqual(self.created[0], 'vos:cfis/dbimages/1000001')
+        self.assertEqual(sorted(self.created[1:]), sorted(dirnames))
+        # each missing level is probed once, the existing parent once.
+        self.assertEqual(len(self.probed), 42)
+
+    def test_known_not_probed(self):
+        self.directories.ensure(['vos:cfis/dbimages/1000001/ccd00'], self.isdir, self.mkdir)
+        self.probed = []
+        self.directories.ensure(['vos:cfis/dbimages/1000001/ccd00', 'vos:cfis/dbimages'], self.isdir, self.mkdir)
+        self.assertEqual(self.probed, [])
+        self.assertIn('vos:cfis', self.directories)
+
+    def test_discard(self):
+        self.directories.add('vos:cfis/dbimages/1000001/ccd00')
+        self.directories.discard('vos:cfis/dbimages/1000001')
+        self.assertNotIn('vos:cfis/dbimages/1000001/ccd00', self.directories)
+        self.assertIn('vos:cfis/dbimages', self.directories)
+        self.directories.ensure(['vos:cfis/dbimages/1000001/ccd00'], self.isdir, self.mkdir)
+        self.assertEqual(self.probed, ['vos:cfis/dbimages/1000001/ccd00', 'vos:cfis/dbimages/1000001'])
+
+    def test_created_elsewhere(self):
+        def mkdir(dirname):
+            raise OSError(errno.EEXIST, "exists", dirname)
+        self.directories.ensure(['vos:other'], self.isdir, mkdir)
+        self.assertIn('vos:other', self.directories)
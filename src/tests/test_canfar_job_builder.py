@@ -0,0 +1,90 @@
+import json
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+
+from mock import patch
+
+import canfar_job_builder
+import storage
+from test_scheduler import FakeTags
+
+
+class TestPack(TestCase):
+
+    def test_read_timings(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        filename = os.path.join(directory, 'daomop_00000.out')
+        with open(filename, 'w') as fobj:
+            fobj.write("Processing build_cat 1000001\n"
+                       "TIMING build_cat 1000001 600 0\n"
+                       "TIMING build_cat 1000002 30 1\n"
+                       "TIMING stationary 100 900 0\n")
+        self.assertEqual(canfar_job_builder.read_timings([filename]),
+                         {('build_cat', '1000001'): 600.0, ('stationary', '100'): 900.0})
+
+    def test_estimate(self):
+        timings = {('build_cat', '1000001'): 600.0, ('build_cat', '1000002'): 800.0,
+                   ('build_cat', '1000003'): 1000.0}
+        items = [('build_cat', '1000001'), ('build_cat', '1000004'), ('stationary', '100')]
+        self.assertEqual(canfar_job_builder.estimate(items, timings),
+                         [600.0, 800.0, canfar_job_builder.DEFAULT_ESTIMATES['stationary']])
+
+    def test_pack(self):
+        estimates = [100, 500, 300, 900, 200, 2000]
+        jobs = canfar_job_builder.pack(estimates, 1000)
+        self.assertEqual(sorted(sum(jobs, [])), range(len(estimates)))
+        # the item longer than the budget runs alone, the rest fill jobs up to the budget.
+        self.assertEqual(jobs, [[5], [3, 0], [1, 2, 4]])
+        self.assertEqual(canfar_job_builder.pack(estimates, 1000, max_items=2), [[5], [3, 0], [1, 2], [4]])
+
+
+class TestSubmission(TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.tags = FakeTags()
+        for target, value in [('storage.get_tags', self.tags.get_tags),
+                              ('storage.healpix_overlaps', lambda pixel, runids=None: [('1000003', 1),
+                                                                                        ('1000004', 2)])]:
+            patcher = patch(target, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_unfinished(self):
+        for ccd in storage.Observation('1000001').ccd_list:
+            task = storage.Task('build_cat')
+            task.target = storage.Artifact(storage.Observation('1000001'), ccd=ccd)
+            self.tags.set_status(task)
+        items = [('build_cat', '1000001'), ('build_cat', '1000002'), ('stationary', '100')]
+        self.assertEqual(canfar_job_builder.unfinished(items, workers=2), items[1:])
+        # one look up per exposure, for the CCD items and the CCDs of the healpix alike.
+        self.assertEqual(self.tags.lookups, 4)
+
+    def test_write_submission(self):
+        items = [('build_cat', '1000001'), ('build_cat', '1000002'), ('stationary', '100')]
+        estimates = [600.0, 500.0, 900.0]
+        jobs = canfar_job_builder.pack(estimates, 1200)
+        manifest = canfar_job_builder.write_submission(items, estimates, jobs, 1200, 'catalogs', self.directory,
+                                                       dbimages='vos:test/dbimages',
+                                                       footprint_index='/data/footprints.sqlite')
+        self.assertEqual(manifest, json.load(open(os.path.join(self.directory, canfar_job_builder.MANIFEST_FILENAME))))
+        self.assertEqual([job['items'] for job in manifest['jobs']],
+                         [[['stationary', '100']], [['build_cat', '1000001'], ['build_cat', '1000002']]])
+        lines = open(os.path.join(self.directory, canfar_job_builder.JOB_FILENAME)).read().splitlines()
+        self.assertIn("Arguments = build_cat:1000001 build_cat:1000002", lines)
+        self.assertEqual(lines.count("Queue"), 2)
+        self.assertIn("transfer_input_files = /data/footprints.sqlite", lines)
+        script = os.path.join(self.directory, canfar_job_builder.COMMAND_FILENAME)
+        self.assertTrue(os.access(script, os.X_OK))
+        # the tasks work in the dbimages of the submission, stationary with the index transferred with the job.
+        script = open(script).read()
+        self.assertIn("populate ${item} --verbose --dbimages vos:test/dbimages && "
+                      "build_cat ${item} --verbose --dbimages vos:test/dbimages ;;", script)
+        self.assertIn("stationary ${item} --verbose --dbimages vos:test/dbimages --catalogs catalogs "
+                      "--footprint-index footprints.sqlite ;;", script)
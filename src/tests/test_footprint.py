@@ -0,0 +1,172 @@
+import json
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+
+import numpy
+from astropy.table import Table
+from mock import patch, Mock
+from astropy.coordinates import SkyCoord
+from astropy.io import fits
+
+import footprint
+import storage
+import util
+
+
+def _ccd_header(ccd, crval1, crval2, mjdate, runid):
+    header = fits.Header()
+    header['EXTVER'] = ccd
+    header['CTYPE1'] = 'RA---TAN'
+    header['CTYPE2'] = 'DEC--TAN'
+    header['CRVAL1'] = crval1
+    header['CRVAL2'] = crval2
+    header['CRPIX1'] = 1024.0
+    header['CRPIX2'] = 2306.0
+    header['CD1_1'] = -0.185 / 3600.0
+    header['CD1_2'] = 0.0
+    header['CD2_1'] = 0.0
+    header['CD2_2'] = 0.185 / 3600.0
+    header['DATASEC'] = '[33:2080,1:4612]'
+    header['MJDATE'] = mjdate
+    header['EXPTIME'] = 90.0
+    header['RUNID'] = runid
+    return header
+
+
+def write_head_file(filename, ccd_centres, mjdate, runid):
+    """Write a MEF .head file with a TAN WCS extension centred at each of ccd_centres."""
+    with open(filename, 'w') as fout:
+        for ccd, (crval1, crval2) in enumerate(ccd_centres):
+            header = _ccd_header(ccd + 1, crval1, crval2, mjdate, runid)
+            for card in header.cards:
+                fout.write(str(card) + "\n")
+            fout.write("END      \n")
+
+
+class TestFootprintIndex(TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        write_head_file(os.path.join(self.directory, '1000001p.head'), [(10.0, 0.0), (10.11, 0.0)],
+                        57000.0, '17AP30')
+        write_head_file(os.path.join(self.directory, '1000002p.head'), [(10.05, 0.0), (40.0, 0.0)],
+                        57000.5, '17AP31')
+        write_head_file(os.path.join(self.directory, '1000003p.head'), [(359.98, 0.0)],
+                        57001.0, '17AP30')
+        self.index = footprint.FootprintIndex(os.path.join(self.directory, 'index', 'footprints.sqlite'))
+        self.assertEqual(self.index.fill_from_directory(self.directory), 3)
+
+    def tearDown(self):
+        self.index.close()
+        shutil.rmtree(self.directory)
+
+    def test_fill_is_incremental(self):
+        self.assertEqual(self.index.exposures, set(['1000001', '1000002', '1000003']))
+        self.assertEqual(self.index.fill_from_directory(self.directory), 0)
+
+    def test_search(self):
+        polygon = storage.MyPolygon.from_footprint(numpy.array([[9.99, -0.01], [9.99, 0.01],
+                                                                [10.01, 0.01], [10.01, -0.01]]))
+        overlaps = self.index.search(polygon)
+        self.assertEqual(sorted(overlaps), [['1000001', 1], ['1000002', 1]])
+
+    def test_search_archive_only(self):
+        polygon = storage.MyPolygon.from_footprint(numpy.array([[9.99, -0.01], [9.99, 0.01],
+                                                                [10.01, 0.01], [10.01, -0.01]]))
+        # exposures the archive does not list for the cone search, eg. not r-band, are not found.
+        with self.index.connection:
+            self.index.connection.execute("DELETE FROM archive WHERE expnum = '1000002'")
+        self.assertEqual(self.index.search(polygon), [['1000001', 1]])
+        pixel = util.skycoord_to_healpix(SkyCoord(10.0, 0.0, unit='degree'))
+        self.assertEqual(self.index.healpix_search(pixel), [['1000001', 1], ['1000001', 2]])
+
+    def test_no_ccds_not_recorded(self):
+        self.assertEqual(self.index.add_headers('1000004', [fits.Header()]), 0)
+        self.assertFalse(self.index.has_exposure('1000004'))
+
+    def test_sync(self):
+        pixel = util.skycoord_to_healpix(SkyCoord(10.0, 0.0, unit='degree'))
+        queries = []
+
+        def tap_query(query):
+            queries.append(query)
+            return Table([['1000001', '1000004']], names=['collectionID'])
+
+        headers = [fits.Header(), _ccd_header(1, 10.02, 0.0, 57002.0, '17AP30')]
+        with patch('storage.tap_query', tap_query), \
+                patch('storage.Header', Mock(return_value=Mock(headers=headers))) as header:
+            with patch('storage.get_footprint_index', Mock(return_value=self.index)):
+                self.assertEqual(storage.healpix_overlaps(pixel),
+                                 [['1000001', 1], ['1000001', 2], ['1000002', 1], ['1000004', 1]])
+                storage.healpix_overlaps(pixel)
+        # only the exposure new to the index has its headers read.
+        self.assertEqual(header.call_count, 1)
+        self.assertNotIn('maxLastModified', queries[0])
+        self.assertIn("Observation.maxLastModified > '{}'".format(self.index.synced_since([pixel],
+                                                                                          util.HEALPIX_NSIDE)),
+                      queries[1])
+
+    def test_sync_retries_failures(self):
+        pixel = util.skycoord_to_healpix(SkyCoord(10.0, 0.0, unit='degree'))
+        with patch('storage.tap_query', Mock(return_value=Table([['1000004']], names=['collectionID']))), \
+                patch('storage.Header', Mock(return_value=Mock(headers=[fits.Header()]))):
+            storage.sync_footprint_index([pixel], self.index)
+        self.assertIsNone(self.index.synced_since([pixel], util.HEALPIX_NSIDE))
+
+    def test_search_runid_and_time(self):
+        polygon = storage.MyPolygon.from_footprint(numpy.array([[9.99, -0.01], [9.99, 0.01],
+                                                                [10.01, 0.01], [10.01, -0.01]]))
+        self.assertEqual(self.index.search(polygon, runids=['%P31']), [['1000002', 1]])
+        self.assertEqual(self.index.search(polygon, mjdate=57000.0, minimum_time=2.0/24.0), [['1000002', 1]])
+
+    def test_search_ra_wrap(self):
+        polygon = storage.MyPolygon.from_footprint(numpy.array([[359.99, -0.01], [359.99, 0.01],
+                                                                [0.01, 0.01], [0.01, -0.01]]))
+        self.assertEqual(self.index.search(polygon), [['1000003', 1]])
+
+    def test_healpix_search(self):
+        pixel = util.skycoord_to_healpix(SkyCoord(10.0, 0.0, unit='degree'))
+        self.assertEqual(self.index.healpix_search(pixel), [['1000001', 1], ['1000001', 2], ['1000002', 1]])
+        self.assertEqual(self.index.healpix_search(pixel, runids=['%P30']), [['1000001', 1], ['1000001', 2]])
+        wrapped = util.skycoord_to_healpix(SkyCoord([359.99, 0.01], [0.0, 0.0], unit='degree'))
+        self.assertEqual(set(wrapped), set(self.index.healpixels()) & set(wrapped))
+        for pixel in wrapped:
+            self.assertEqual(self.index.healpix_search(pixel), [['1000003', 1]])
+
+    def test_healpix_other_nside(self):
+        pixel = util.skycoord_to_healpix(SkyCoord(40.0, 0.0, unit='degree'), nside=64)
+        self.assertEqual(self.index.healpix_search(pixel, nside=64), [['1000002', 2]])
+        # mapping is only done once per nside.
+        self.assertEqual(self.index.index_healpix(nside=64), 0)
+
+    def test_degenerate_footprint_skipped(self):
+        corners = numpy.array([[[10.0, 0.0], [10.0, 0.0], [10.0, 0.0], [10.0, 0.0]],
+                               [[10.0, 0.0], [10.1, 0.0], [10.2, 0.0], [10.3, 0.0]],
+                               [[10.0, 0.0], [10.0, 0.3], [10.2, 0.3], [10.2, 0.0]]])
+        pixels = util.footprints_to_healpix(corners)
+        self.assertEqual([len(pixels[0]), len(pixels[1])], [0, 0])
+        self.assertGreater(len(pixels[2]), 0)
+
+        # a bad stored footprint does not stop the others being mapped at a new nside.
+        with self.index.connection:
+            self.index.connection.execute("INSERT INTO footprints VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                                          ('1000004', 1, 10.0, 0.0, 0.0, 0.0, 0.0, json.dumps(corners[1].tolist())))
+        self.assertEqual(self.index.index_healpix(nside=64), 4)
+        pixel = util.skycoord_to_healpix(SkyCoord(40.0, 0.0, unit='degree'), nside=64)
+        self.assertEqual(self.index.healpix_search(pixel, nside=64), [['1000002', 2]])
+        self.assertEqual(self.index.index_healpix(nside=64), 0)
+
+    def test_footprints_to_healpix(self):
+        corners = numpy.array([[[10.0, 0.0], [10.0, 0.3], [10.2, 0.3], [10.2, 0.0]],
+                               [[359.9, 0.0], [359.9, 0.3], [0.1, 0.3], [0.1, 0.0]]])
+        pixels = util.footprints_to_healpix(corners)
+        self.assertIn(util.skycoord_to_healpix(SkyCoord(10.1, 0.15, unit='degree')), pixels[0])
+        # each footprint's corners and centre are in one of its pixels.
+        for footprint_corners, centre, footprint_pixels in zip(corners, [10.1, 0.0], pixels):
+            points = SkyCoord(list(footprint_corners[:, 0]) + [centre],
+                              list(footprint_corners[:, 1]) + [0.15], unit='degree')
+            self.assertTrue(set(util.skycoord_to_healpix(points)) <= set(footprint_pixels))
+        self.assertIn(util.skycoord_to_healpix(SkyCoord(0.05, 0.15, unit='degree')), pixels[1])
+        self.assertLess(len(pixels[1]), 5)
@@ -0,0 +1,171 @@
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+
+import numpy
+from astropy.table import Table
+from cadcutils.exceptions import NotFoundException
+from mock import patch
+
+import storage
+import util
+
+
+class FakeVOSpace(object):
+    """
+    Keep VOSpace nodes as files in a local directory.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+
+    def path(self, uri):
+        return os.path.join(self.directory, uri.replace(storage.VOS_PROTOCOL, '').replace('//', '/'))
+
+    def copy(self, source, destination):
+        if source.startswith(storage.VOS_PROTOCOL):
+            if not os.access(self.path(source), os.F_OK):
+                raise NotFoundException(source)
+            shutil.copy(self.path(source), destination)
+        else:
+            if not os.access(os.path.dirname(self.path(destination)), os.F_OK):
+                os.makedirs(os.path.dirname(self.path(destination)))
+            shutil.copy(source, self.path(destination))
+
+    def listdir(self, uri, force=False):
+        if not os.access(self.path(uri), os.F_OK):
+            raise NotFoundException(uri)
+        return os.listdir(self.path(uri))
+
+    def delete(self, uri):
+        os.unlink(self.path(uri))
+
+
+class FakeVOSpaceTestCase(TestCase):
+    """
+    Run each test in a scratch directory with VOSpace replaced by a FakeVOSpace.
+    """
+
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.directory = tempfile.mkdtemp()
+        os.chdir(self.directory)
+        self.vospace = FakeVOSpace(os.path.join(self.directory, 'vospace'))
+        for name in ['copy', 'listdir', 'delete']:
+            patcher = patch('storage.{}'.format(name), side_effect=getattr(self.vospace, name))
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        patcher = patch('storage.make_path')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        shutil.rmtree(self.directory)
+
+
+class TestHPXCatalog(FakeVOSpaceTestCase):
+    """
+    Check that appended partitions are merged into the catalog view and survive compaction.
+    """
+
+    @staticmethod
+    def rows(dataset_name, values):
+        return Table([[dataset_name] * len(values), values], names=('dataset_name', 'MAG_PSF'))
+
+    def test_missing_catalog(self):
+        with self.assertRaises(NotFoundException):
+            storage.HPXCatalog(pixel=100).table
+
+    def test_append_and_compact(self):
+        catalog = storage.HPXCatalog(pixel=100)
+        catalog.append(self.rows('1000001p01', [1.0, 2.0]), '1000001p01')
+        catalog.append(self.rows('1000002p01', [3.0]), '1000002p01')
+        self.assertEqual(len(storage.HPXCatalog(pixel=100).table), 3)
+
+        self.assertEqual(catalog.compact(), 2)
+        self.assertEqual(catalog.partitions(), [])
+        self.assertEqual(sorted(storage.HPXCatalog(pixel=100).table['MAG_PSF']), [1.0, 2.0, 3.0])
+
+        # re-processing a dataset replaces its rows in the compacted catalog.
+        catalog.append(self.rows('1000001p01', [5.0]), '1000001p01')
+        self.assertEqual(sorted(storage.HPXCatalog(pixel=100).table['MAG_PSF']), [3.0, 5.0])
+        catalog.compact()
+        self.assertEqual(sorted(storage.HPXCatalog(pixel=100).table['MAG_PSF']), [3.0, 5.0])
+
+    def test_compacted_partition_not_applied_twice(self):
+        catalog = storage.HPXCatalog(pixel=100)
+        catalog.append(self.rows('1000001p01', [1.0]), '1000001p01')
+        with patch('storage.delete', side_effect=IOError("delete failed")):
+            catalog.compact()
+        self.assertEqual(len(catalog.partitions()), 1)
+        self.assertEqual(len(storage.HPXCatalog(pixel=100).table), 1)
+
+
+class TestHPXPartitions(FakeVOSpaceTestCase):
+    """
+    Check that a dense healpix is split into NESTED partitions that together hold all its rows.
+    """
+
+    @staticmethod
+    def sources(pixel, count):
+        centre = util.healpix_to_skycoord(pixel)
+        random = numpy.random.RandomState(1)
+        ra = centre.ra.degree + random.uniform(-1.0, 1.0, 10 * count)
+        dec = centre.dec.degree + random.uniform(-1.0, 1.0, 10 * count)
+        inside = util.radec_to_healpix(ra, dec) == pixel
+        ra, dec = ra[inside][:count], dec[inside][:count]
+        return Table([['1000001p01'] * count, ra, dec, numpy.arange(count)],
+                     names=('dataset_name', 'X_WORLD', 'Y_WORLD', 'HPXID'))
+
+    def test_unsplit(self):
+        partitions = storage.HPXPartitions(100)
+        self.assertEqual(partitions.leaves, [partitions.root])
+        self.assertEqual(partitions.catalog(partitions.root).uri, storage.HPXCatalog(pixel=100).uri)
+
+    def test_compact_splits(self):
+        table = self.sources(100, 60)
+        storage.HPXCatalog(pixel=100).append(table, '1000001p01')
+        self.assertEqual(storage.HPXPartitions(100).compact(max_rows=1000), (1, 0))
+        self.assertEqual(storage.HPXPartitions(100).compact(max_rows=10), (0, 1))
+
+        partitions = storage.HPXPartitions(100)
+        self.assertGreater(len(partitions.leaves), 4)
+        self.assertTrue(all([nside > util.HEALPIX_NSIDE for nside, pixel in partitions.leaves]))
+        rows = []
+        for catalog in partitions.catalogs():
+            try:
+                rows.extend(catalog.table['HPXID'])
+                self.assertLessEqual(len(catalog.table), 10)
+            except NotFoundException:
+                pass
+        self.assertEqual(sorted(rows), range(60))
+        # the split catalog is gone, its rows are only in the partitions.
+        with self.assertRaises(NotFoundException):
+            storage.HPXCatalog(pixel=100).table
+
+        leaf = partitions.assign(table['X_WORLD'], table['Y_WORLD'])
+        self.assertTrue((leaf >= 0).all())
+        for idx in range(len(table)):
+            catalog = partitions.catalog(partitions.leaves[leaf[idx]])
+            self.assertIn(table['HPXID'][idx], catalog.table['HPXID'])
+        other = util.healpix_to_skycoord(101)
+        self.assertEqual(list(partitions.assign([other.ra.degree], [other.dec.degree])), [-1])
+
+    def test_max_nside(self):
+        storage.HPXCatalog(pixel=100).append(self.sources(100, 20), '1000001p01')
+        storage.HPXPartitions(100).compact(max_rows=1, max_nside=2 * util.HEALPIX_NSIDE)
+        self.assertEqual(sorted(storage.HPXPartitions(100).leaves),
+                         [(2 * util.HEALPIX_NSIDE, int(child))
+                          for child in util.healpix_children(util.ring_to_nest(100))])
+
+    def test_overlapping(self):
+        storage.HPXCatalog(pixel=100).append(self.sources(100, 20), '1000001p01')
+        partitions = storage.HPXPartitions(100)
+        partitions.compact(max_rows=1, max_nside=2 * util.HEALPIX_NSIDE)
+        child = partitions.leaves[0]
+        centre = util.healpix_to_skycoord(child[1], nside=child[0], nest=True)
+        ra, dec = centre.ra.degree, centre.dec.degree
+        corners = [[ra - 0.01, dec - 0.01], [ra - 0.01, dec + 0.01], [ra + 0.01, dec + 0.01], [ra + 0.01, dec - 0.01]]
+        self.assertEqual(partitions.overlapping(corners), [child])
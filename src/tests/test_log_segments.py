@@ -0,0 +1,93 @@
+import json
+import logging
+import os
+import shutil
+import tempfile
+import threading
+from unittest import TestCase
+
+from mock import patch, Mock
+from six import StringIO
+
+import storage
+import transfer
+
+
+class TestLogSegments(TestCase):
+
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.directory = tempfile.mkdtemp()
+        os.chdir(self.directory)
+        self.nodes = {}
+        self.release = threading.Event()
+        engine = transfer.TransferEngine(lambda source, destination: None, workers=2)
+        self.addCleanup(engine.close)
+        root = logging.getLogger('')
+        self.addCleanup(root.setLevel, root.level)
+        root.setLevel(logging.INFO)
+        for target, value in [('storage._transfer_engine', engine),
+                              ('storage.LOG_SEGMENTS', True),
+                              ('storage.copy', self.copy),
+                              ('storage.make_path', lambda uri: None)]:
+            patcher = patch(target, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        self.release.set()
+        storage.wait_for_log_uploads()
+        os.chdir(self.cwd)
+        shutil.rmtree(self.directory)
+
+    def copy(self, source, destination):
+        self.release.wait(5)
+        self.nodes[destination] = open(source).read()
+
+    def test_shipped_in_background(self):
+        with storage.LoggingManager('build_cat', '', '1000001', 1, 'p'):
+            logging.info("processing ccd 1")
+        # the task is done before its log is in VOSpace.
+        self.assertEqual(self.nodes, {})
+        self.release.set()
+        self.assertEqual(storage.wait_for_log_uploads(), 0)
+        segments = [uri for uri in self.nodes
+                    if uri.startswith(storage.log_segments_uri(storage.log_location('1000001', 1), 'build_cat_p1.txt'))]
+        self.assertEqual(len(segments), 1)
+        self.assertIn("processing ccd 1", self.nodes[segments[0]])
+
+    def test_metrics_shipped(self):
+        with storage.LoggingManager('build_cat', '', '1000001', 1, 'p'):
+            with storage.metrics.timer('download'):
+                storage.metrics.count('bytes_downloaded', 100)
+        self.release.set()
+        self.assertEqual(storage.wait_for_log_uploads(), 0)
+        uris = [uri for uri in self.nodes
+                if uri.startswith(storage.metrics_uri(storage.log_location('1000001', 1), 'build_cat_p1.txt'))]
+        self.assertEqual(len(uris), 1)
+        record = json.loads(self.nodes[uris[0]])
+        self.assertEqual((record['task'], record['scope'], record['expnum'], record['ccd']),
+                         ('build_cat', 'task', '1000001', 1))
+        self.assertEqual(record['timers']['download']['calls'], 1)
+        self.assertEqual(record['counters'], {'bytes_downloaded': 100})
+        # the local copy is removed once it is in VOSpace.
+        self.assertEqual([filename for filename in os.listdir(os.curdir) if filename.endswith('.json')], [])
+
+    def test_empty_segment_dropped(self):
+        handler = storage.util.VOSegmentHandler('vos:a/b_parts/1.txt', Mock())
+        handler.close()
+        self.assertFalse(handler._ship.called)
+        self.assertFalse(os.access(handler.baseFilename, os.F_OK))
+
+    def test_merge(self):
+        location = 'vos:cfis/dbimages/1000001/ccd01'
+        segments = storage.log_segments_uri(location, 'build_cat_p1.txt')
+        content = {location + '/build_cat_p1.txt': "first run\n",
+                   segments + '/20170601T000000.000000-host-2.txt': "third run\n",
+                   segments + '/20170501T000000.000000-host-1.txt': "second run"}
+        client = Mock()
+        client.open.side_effect = lambda uri, view: StringIO(content[uri])
+        client.listdir.return_value = [os.path.basename(uri) for uri in content if uri.startswith(segments)]
+        with patch('vospace.client', client):
+            self.assertEqual(storage.merge_log_segments(location, 'build_cat_p1.txt'),
+                             "first run\nsecond run\nthird run\n")
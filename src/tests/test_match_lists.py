@@ -0,0 +1,49 @@
+from unittest import TestCase
+
+import numpy
+
+import util
+
+
+class TestMatchLists(TestCase):
+    """
+    Check that the k-d tree util.match_lists agrees with the brute force reference implementation.
+    """
+
+    def setUp(self):
+        numpy.random.seed(42)
+        self.pos1 = numpy.random.uniform(0, 2000, size=(500, 2))
+        # pos2 is a jittered, shuffled sub-set of pos1 plus some sources that are not in pos1
+        self.order = numpy.random.permutation(len(self.pos1))[:400]
+        self.pos2 = numpy.concatenate((self.pos1[self.order] + numpy.random.normal(0, 0.5, size=(400, 2)),
+                                       numpy.random.uniform(0, 2000, size=(50, 2))))
+
+    def test_match_lists_agrees_with_bruteforce(self):
+        match1, match2 = util.match_lists(self.pos1, self.pos2, tolerance=3.0)
+        brute1, brute2 = util.match_lists_bruteforce(self.pos1, self.pos2, tolerance=3.0)
+        self.assertTrue(numpy.all(match1.mask == brute1.mask))
+        self.assertTrue(numpy.all(match2.mask == brute2.mask))
+        self.assertTrue(numpy.all(match1.data[~match1.mask] == brute1.data[~brute1.mask]))
+        self.assertTrue(numpy.all(match2.data[~match2.mask] == brute2.data[~brute2.mask]))
+
+    def test_match_lists_is_mutual(self):
+        match1, match2 = util.match_lists(self.pos1, self.pos2, tolerance=3.0)
+        for idx1 in numpy.arange(len(self.pos1))[~match1.mask]:
+            self.assertEqual(match2[match1[idx1]], idx1)
+
+    def test_match_lists_empty(self):
+        match1, match2 = util.match_lists(self.pos1, numpy.zeros((0, 2)))
+        self.assertEqual(len(match2), 0)
+        self.assertTrue(numpy.all(match1.mask))
+
+    def test_match_lists_spherical_ra_wrap(self):
+        """Sources either side of RA=0 are matched when within tolerance on the sky."""
+        tolerance = 0.5 / 3600.0
+        pos1 = numpy.array([[359.99999, 10.0], [180.0, 80.0]])
+        pos2 = numpy.array([[0.00001, 10.0], [180.0 + 0.9 / 3600.0, 80.0]])
+        match1, match2 = util.match_lists(pos1, pos2, tolerance=tolerance, spherical=True)
+        self.assertEqual(match1[0], 0)
+        # 0.9" of RA at DEC=80 is about 0.16" on the sky.
+        self.assertEqual(match1[1], 1)
+        match1, match2 = util.match_lists(pos1, pos2, tolerance=tolerance)
+        self.assertTrue(numpy.all(match1.mask))
@@ -0,0 +1,83 @@
+import os
+import shutil
+import tempfile
+import time
+from unittest import TestCase
+
+from astropy.io import fits
+
+import util
+
+
+def write_head_file(filename, nccd, primary=True):
+    with open(filename, 'w') as fout:
+        headers = []
+        if primary:
+            headers.append([('SIMPLE', True), ('EXPNUM', 1000001), ('RUNID', '17AP30')])
+        for ccd in range(nccd):
+            headers.append([('XTENSION', 'IMAGE'), ('EXTVER', ccd + 1), ('DATASEC', '[33:2080,1:4612]'),
+                            ('MJDATE', 57000.5), ('EXPTIME', 60.0), ('PHOTZP', 30.0),
+                            ('FLAT', "14AQ02-Mar18-r.flat.fits"), ('OBJECT', "Tom's field"),
+                            ('PV1_1', 1.01755337222), ('NORDFIT', 3)])
+        for cards in headers:
+            for key, value in cards:
+                fout.write(str(fits.Card(key, value, 'a comment')) + "\n")
+            fout.write(str(fits.Card('HISTORY', 'processed / with = signs')) + "\n")
+            fout.write("END      \n")
+
+
+class TestMEFHeaders(TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.filename = os.path.join(self.directory, '1000001p.head')
+        write_head_file(self.filename, 3)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_matches_full_parser(self):
+        full = util.read_mef_headers(self.filename)
+        headers = util.MEFHeaders(self.filename)
+        self.assertEqual(len(headers), len(full))
+        for idx in range(len(full)):
+            for key in headers[idx]:
+                self.assertEqual(headers[idx][key], full[idx][key])
+        self.assertEqual(headers[2]['FLAT'], "14AQ02-Mar18-r.flat.fits")
+        self.assertEqual(headers[0]['RUNID'], "17AP30")
+        self.assertNotIn('OBJECT', headers[1])
+        self.assertEqual([header.get('EXTVER', None) for header in headers], [None, 1, 2, 3])
+
+    def test_sidecar(self):
+        headers = util.MEFHeaders(self.filename)
+        headers[1]
+        self.assertFalse(os.access(self.filename + util.HEAD_CACHE_EXT, os.F_OK))
+        list(headers)
+        self.assertTrue(os.access(self.filename + util.HEAD_CACHE_EXT, os.F_OK))
+
+        headers = util.MEFHeaders(self.filename)
+        self.assertIsNone(headers._text)
+        self.assertEqual(headers[3]['EXTVER'], 3)
+
+        # a changed .head file is parsed again.
+        time.sleep(0.01)
+        write_head_file(self.filename, 4)
+        os.utime(self.filename, (time.time() + 10, time.time() + 10))
+        headers = util.MEFHeaders(self.filename)
+        self.assertIsNotNone(headers._text)
+        self.assertEqual(len(headers), 5)
+
+    def test_cached_values(self):
+        headers = util.MEFHeaders(self.filename)
+        self.assertEqual(headers.cached(2, 'pv', lambda header: header['PV1_1']), 1.01755337222)
+        # kept in the sidecar, a later read does not build the value or the header again.
+        headers = util.MEFHeaders(self.filename)
+        self.assertIsNone(headers._text)
+        self.assertEqual(headers.cached(2, 'pv', None), 1.01755337222)
+        self.assertEqual(headers._headers, [None] * 4)
+
+    def test_no_primary(self):
+        write_head_file(self.filename, 2, primary=False)
+        headers = util.MEFHeaders(self.filename, source='vos:1000001p.head')
+        self.assertEqual(headers[0], {'SOURCE': 'vos:1000001p.head'})
+        self.assertEqual(headers[2]['EXTVER'], 2)
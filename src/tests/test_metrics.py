@@ -0,0 +1,103 @@
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+from unittest import TestCase
+
+from mock import patch, Mock
+
+import metrics
+import vospace
+
+
+class TestMetrics(TestCase):
+
+    def setUp(self):
+        patcher = patch('metrics._metrics', metrics.Metrics())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_since(self):
+        metrics.count('bytes_uploaded', 10)
+        with metrics.timer('download'):
+            pass
+        earlier = metrics.snapshot()
+        with metrics.timer('download'):
+            metrics.count('bytes_downloaded', 100)
+        with metrics.timer('upload'):
+            metrics.count('bytes_downloaded', 50)
+        record = metrics.since(earlier)
+        self.assertEqual(record['counters'], {'bytes_downloaded': 150})
+        self.assertEqual(sorted(record['timers']), ['download', 'upload'])
+        self.assertEqual(record['timers']['download']['calls'], 1)
+        self.assertGreaterEqual(record['wall'], 0)
+
+    def test_check_output(self):
+        output = metrics.check_output([sys.executable, '-c', 'print("found")'], stderr=subprocess.STDOUT)
+        self.assertEqual(output.strip(), 'found')
+        usage = metrics.get_metrics().processes[os.path.basename(sys.executable)]
+        self.assertEqual(usage['calls'], 1)
+        self.assertGreater(usage['max_rss_kb'], 0)
+        with self.assertRaises(subprocess.CalledProcessError) as context:
+            metrics.check_output([sys.executable, '-c', 'import sys; print("failed"); sys.exit(3)'])
+        self.assertEqual(context.exception.returncode, 3)
+        self.assertEqual(context.exception.output.strip(), 'failed')
+        self.assertEqual(usage['calls'], 2)
+
+    def test_vospace_calls_timed_once(self):
+        client = vospace.MeteredClient.__new__(vospace.MeteredClient)
+        with patch('vos.vos.Client.isdir', Mock(return_value=True)), \
+                patch('vos.vos.Client.get_node', lambda this, uri, **kwargs: this.isdir(uri)):
+            self.assertTrue(client.get_node('vos:a/b'))
+        # the isdir call made by get_node is part of the get_node call.
+        self.assertEqual(sorted(metrics.get_metrics().timers), ['vospace.get_node'])
+
+    def test_report_on_stderr(self):
+        # stdout is left to the tables the tools write.
+        with patch('metrics._started', {'pid': os.getpid(), 'snapshot': metrics.snapshot()}), \
+                patch('sys.stdout') as stdout, patch('sys.stderr') as stderr:
+            metrics._report('populate')
+        self.assertFalse(stdout.write.called)
+        self.assertTrue(stderr.write.call_args[0][0].startswith(metrics.METRICS_TAG + " "))
+
+
+class TestAggregate(TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    @staticmethod
+    def record(task, scope, wall, cpu, timers):
+        return {'task': task, 'scope': scope, 'wall': wall, 'max_rss_kb': 2048,
+                'cpu': {'user': cpu, 'system': 0.0}, 'children': {'user': 0.0, 'system': 0.0},
+                'counters': {'bytes_downloaded': 10},
+                'timers': dict([(name, {'calls': 1, 'seconds': seconds}) for name, seconds in timers.items()]),
+                'processes': {'sex': {'calls': 1, 'seconds': 5.0, 'user': 4.0, 'system': 0.5, 'max_rss_kb': 1024}}}
+
+    def test_read_and_report(self):
+        with open(os.path.join(self.directory, 'build_cat_p01.json'), 'w') as fobj:
+            json.dump(self.record('build_cat', 'task', 10.0, 2.0, {'download': 6.0, 'psfex': 1.0}), fobj)
+        with open(os.path.join(self.directory, 'daomop_00001.out'), 'w') as fobj:
+            fobj.write("TIMING build_cat 1000001 20 0\n")
+            fobj.write("{} {}\n".format(metrics.METRICS_TAG, json.dumps(
+                self.record('build_cat', 'process', 20.0, 5.0, {'vospace.copy': 10.0}))))
+        with open(os.path.join(self.directory, 'ignored.txt'), 'w') as fobj:
+            fobj.write("{} {{}}\n".format(metrics.METRICS_TAG))
+        records = metrics.read_metrics([self.directory])
+        self.assertEqual(len(records), 2)
+        totals = metrics.aggregate(records + [self.record('build_cat', 'task', 10.0, 8.0, {'download': 2.0})])
+        task = totals[('build_cat', 'task')]
+        self.assertEqual((task['runs'], task['wall'], task['cpu']), (2, 20.0, 10.0))
+        self.assertEqual(task['timers']['download'], {'calls': 2, 'seconds': 8.0})
+        self.assertEqual(task['processes']['sex']['max_rss_kb'], 1024)
+        self.assertEqual(task['counters'], {'bytes_downloaded': 20})
+        lines = metrics.report(totals).splitlines()
+        self.assertIn("build_cat (process scope): 1 runs, 20.0s wall, cpu 25% of wall, VOSpace calls 50% of wall, "
+                      "peak rss 2MB", lines)
+        # the longest timer is listed first.
+        self.assertTrue(lines[-4].strip().startswith('download'))
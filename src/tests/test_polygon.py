@@ -0,0 +1,35 @@
+from unittest import TestCase
+
+import numpy
+
+import storage
+
+
+class TestMyPolygonContainsPoints(TestCase):
+    """
+    Check the vectorized MyPolygon.contains_points against Polygon.isInside.
+    """
+
+    def setUp(self):
+        numpy.random.seed(0)
+        footprint = numpy.array([[10.0, 20.0], [10.1, 20.25], [10.4, 20.2], [10.35, 19.95]])
+        self.polygon = storage.MyPolygon.from_footprint(footprint)
+        self.ra = numpy.random.uniform(9.9, 10.5, 2000)
+        self.dec = numpy.random.uniform(19.9, 20.3, 2000)
+
+    def test_contains_points_agrees_with_is_inside(self):
+        expected = numpy.array([self.polygon.isInside(ra, dec) for ra, dec in zip(self.ra, self.dec)])
+        self.assertTrue(numpy.all(self.polygon.contains_points(self.ra, self.dec) == expected))
+
+    def test_contains_points_with_hole(self):
+        hole = ((10.15, 20.05), (10.15, 20.15), (10.25, 20.15), (10.25, 20.05), (10.15, 20.05))
+        self.polygon.addContour(hole, True)
+        expected = numpy.array([self.polygon.isInside(ra, dec) for ra, dec in zip(self.ra, self.dec)])
+        self.assertTrue(numpy.all(self.polygon.contains_points(self.ra, self.dec) == expected))
+
+    def test_contains_points_ra_wrap(self):
+        polygon = storage.MyPolygon.from_footprint(numpy.array([[359.9, -0.1], [359.9, 0.1],
+                                                                [0.1, 0.1], [0.1, -0.1]]))
+        ra = numpy.array([359.95, 0.05, 0.0, 180.0, 0.2, 359.8])
+        dec = numpy.array([0.0, 0.0, 0.05, 0.0, 0.0, 0.0])
+        self.assertEqual(list(polygon.contains_points(ra, dec)), [True, True, True, False, False, False])
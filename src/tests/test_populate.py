@@ -0,0 +1,50 @@
+import os
+from unittest import TestCase
+
+from mock import patch
+
+import populate
+import storage
+
+
+class TestRunBatch(TestCase):
+
+    def setUp(self):
+        self.links = []
+        self.paths = []
+        # 1000002 has no processed image, 1000001 is already populated and 1000005 only has its raw links.
+        isfile = lambda uri: '1000002' not in uri or 'pitcairn' not in uri
+        listings = {'1000001': ['1000001o.fits.fz', '1000001o.head', '1000001p.fits.fz', '1000001p.head'],
+                    '1000005': ['1000005o.fits.fz', '1000005o.head']}
+        for target, kwargs in [('storage.list_dbimages', {'return_value': ['1000001', '1000005']}),
+                               ('storage.listdir', {'side_effect': lambda uri: listings[os.path.basename(uri)]}),
+                               ('storage.make_paths', {'side_effect': self.paths.extend}),
+                               ('populate.isfile', {'side_effect': isfile}),
+                               ('populate.make_link', {'side_effect': lambda source, destination:
+                                                       self.links.append((source, destination))})]:
+            patcher = patch(target, **kwargs)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_run_batch(self):
+        summary = populate.run_batch([1000001, 1000002, 1000003, 1000004, 1000005], workers=4)
+        self.assertEqual(list(summary['expnum']), ['1000001', '1000002', '1000003', '1000004', '1000005'])
+        self.assertEqual(summary['status'][0], populate.SKIPPED)
+        self.assertIn('No file to link to', summary['status'][1])
+        self.assertEqual(list(summary['status'][2:]), [storage.SUCCESS, storage.SUCCESS, storage.SUCCESS])
+        self.assertEqual(list(summary['links']), [0, 0, 4, 4, 2])
+        # the partly populated exposure only gets the links it is missing.
+        self.assertEqual(sorted(self.links), sorted([(source, destination)
+                                                     for expnum in ['1000003', '1000004']
+                                                     for source, destination in self.batch_links(expnum)] +
+                                                    self.batch_links('1000005')[2:]))
+        self.assertEqual(len(self.paths), 10)
+
+    def test_force_and_dry_run(self):
+        summary = populate.run_batch([1000001], force=True, dry_run=True)
+        self.assertEqual(list(summary['status']), [storage.SUCCESS])
+        self.assertEqual(self.links, [])
+
+    @staticmethod
+    def batch_links(expnum):
+        return [(sources[0], destination) for sources, destination, check in populate.exposure_links(expnum)]
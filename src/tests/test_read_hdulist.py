@@ -0,0 +1,110 @@
+from unittest import TestCase
+
+import numpy
+from astropy.io import fits
+from mock import patch, Mock
+from six import BytesIO
+
+import storage
+import transfer
+
+
+def fits_bytes():
+    hdulist = fits.HDUList([fits.PrimaryHDU(data=numpy.arange(100, dtype='float32').reshape(10, 10))])
+    hdulist[0].header['DATASEC'] = '[1:10,1:10]'
+    fobj = BytesIO()
+    hdulist.writeto(fobj)
+    return fobj.getvalue()
+
+
+class FakeResponse(object):
+
+    def __init__(self, body, status_code=200, content_length=True):
+        self.body = body
+        self.status_code = status_code
+        self.text = body
+        self.url = 'https://example/cutout'
+        self.raw = Mock()
+        self.headers = content_length and {'Content-Length': str(len(body))} or {}
+
+    def iter_content(self, chunk_size=1):
+        for idx in range(0, len(self.body), 1000):
+            yield self.body[idx:idx + 1000]
+
+    def raise_for_status(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class TestReadHDUList(TestCase):
+
+    def setUp(self):
+        self.body = fits_bytes()
+        self.responses = []
+        self.client = Mock()
+        self.client.get_node_url.return_value = ['https://example/cutout']
+        self.client.conn.session.get.side_effect = lambda url, stream: self.responses.pop(0)
+        engine = transfer.TransferEngine(Mock(), retries=2)
+        self.addCleanup(engine.close)
+        for target, value in [('vospace.client', self.client),
+                              ('storage._transfer_engine', engine),
+                              ('time.sleep', Mock())]:
+            patcher = patch(target, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_read(self):
+        for shared, content_length in [(False, True), (True, True), (False, False), (True, False)]:
+            self.responses.append(FakeResponse(self.body, content_length=content_length))
+            hdulist = storage.read_hdulist('vos:a/1000001p.fits', cutout='[1:10,1:10]', shared=shared)
+            self.assertEqual(hdulist[0].data[3, 4], 34)
+            self.assertEqual(hdulist[0].header['DATASEC'], '[1:10,1:10]')
+        self.client.get_node_url.assert_called_with('vos:a/1000001p.fits', method='GET', cutout='[1:10,1:10]',
+                                                    view='cutout')
+
+    def test_truncated(self):
+        for idx in range(3):
+            response = FakeResponse(self.body)
+            response.headers['Content-Length'] = str(len(self.body) + 10)
+            self.responses.append(response)
+        self.assertRaises(IOError, storage.read_hdulist, 'vos:a/1000001p.fits')
+        self.assertEqual(self.responses, [])
+
+    def test_retried(self):
+        response = FakeResponse(self.body)
+        response.headers['Content-Length'] = str(len(self.body) + 10)
+        self.responses.extend([response, FakeResponse(self.body)])
+        self.assertEqual(storage.read_hdulist('vos:a/1000001p.fits')[0].data[3, 4], 34)
+        self.assertEqual(storage.get_transfer_engine().stats['retries'], 1)
+
+    def test_no_matching_data(self):
+        self.responses.append(FakeResponse("No matching data", status_code=400))
+        self.assertEqual(storage.Image(storage.Observation('1000001'), ccd=1).cutout('[1:10,1:10]'), [])
+
+    def test_image_cutout(self):
+        self.responses.append(FakeResponse(self.body))
+        image = storage.Image(storage.Observation('1000001'), ccd=1)
+        with patch('tempfile.NamedTemporaryFile') as named_temporary_file:
+            hdulist = image.cutout('[3:10,3:10]')
+            self.assertFalse(named_temporary_file.called)
+        self.assertEqual(hdulist[0].header['DATASEC'], '[1:8,1:8]')
+        # the extension of the CCD is cut out of the file, there is no node for it.
+        uri = image.uri
+        self.assertTrue(uri.endswith('[2]'))
+        self.client.get_node_url.assert_called_with(uri[:-len('[2]')], method='GET', cutout='[2][3:10,3:10]',
+                                                    view='cutout')
+
+    def test_split_extension(self):
+        self.assertEqual(storage.split_extension('vos:a/1000001p.fits.fz[12]', '[1:10,1:10]'),
+                         ('vos:a/1000001p.fits.fz', '[12][1:10,1:10]'))
+        self.assertEqual(storage.split_extension('vos:a/1000001p.fits.fz[12]'), ('vos:a/1000001p.fits.fz', '[12]'))
+        self.assertEqual(storage.split_extension('vos:a/1000001p.fits', '[1:10,1:10]'),
+                         ('vos:a/1000001p.fits', '[1:10,1:10]'))
+
+    def test_async(self):
+        self.responses.extend([FakeResponse(self.body) for idx in range(4)])
+        futures = storage.read_hdulists_async([('vos:a/1000001p.fits', '[{}:10,1:10]'.format(idx + 1))
+                                               for idx in range(4)])
+        self.assertEqual([future.get()[0].data[0, 0] for future in futures], [0, 0, 0, 0])
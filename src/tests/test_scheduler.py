@@ -0,0 +1,133 @@
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+
+from mock import patch
+
+import scheduler
+import storage
+
+
+class FakeTags(object):
+    """
+    Hold exposure tags in memory, counting the look ups that go to VOSpace.
+    """
+
+    def __init__(self):
+        self.tags = {}
+        self.lookups = 0
+
+    def get_tags(self, expnum, force=False):
+        if force:
+            self.lookups += 1
+        return dict(self.tags.get(str(expnum), {}))
+
+    def set_status(self, node, status=storage.SUCCESS):
+        self.tags.setdefault(node.expnum, {})[storage.tag_uri(node.tag)] = status
+
+
+class TestTask(TestCase):
+
+    def setUp(self):
+        self.tags = FakeTags()
+        patcher = patch('storage.get_tags', side_effect=self.tags.get_tags)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_dependency(self):
+        build_cat = storage.Task('build_cat.py')
+        stationary = storage.Task('stationary.py', dependency=build_cat)
+        self.assertIs(stationary.dependency, build_cat)
+        self.assertIsNone(build_cat.dependency)
+        self.assertRaises(AssertionError, storage.Task, 'stationary', dependency='build_cat')
+        with self.assertRaises(AssertionError):
+            build_cat.target = '1000001'
+
+    def test_ready_and_finished(self):
+        target = storage.Artifact(storage.Observation('1000001'), ccd=3)
+        build_cat = storage.Task('build_cat')
+        build_cat.target = target
+        stationary = storage.Task('stationary', dependency=build_cat)
+        stationary.target = target
+        self.assertEqual(build_cat.tag, storage.get_process_tag('build_cat', 3, 'p'))
+        self.assertTrue(build_cat.ready)
+        self.assertFalse(build_cat.finished)
+        self.assertFalse(stationary.ready)
+        self.tags.set_status(build_cat)
+        self.assertTrue(build_cat.finished)
+        self.assertTrue(stationary.ready)
+        self.assertTrue(storage.get_status('build_cat', '', '1000001', 'p', 3))
+
+
+class TestGraph(TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.tags = FakeTags()
+        self.failing = set()
+        self.commands = []
+        for target, value in [('storage.get_tags', self.tags.get_tags),
+                              ('scheduler.execute', self.execute),
+                              ('storage.FOOTPRINT_INDEX', None),
+                              ('storage.REFRESH_QUERIES', False)]:
+            patcher = patch(target, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def execute(self, job, dry_run=False):
+        self.commands.append(job.command)
+        if job.name not in self.failing:
+            for node in job.nodes:
+                self.tags.set_status(node)
+        return job.name, 0
+
+    def graph(self):
+        graph = scheduler.Graph()
+        graph.add_exposure('1000001', ['build_cat'])
+        graph.add_healpix(100, [('1000001', 1), ('1000002', 2)])
+        return graph
+
+    def test_finished_nodes_skipped(self):
+        graph = self.graph()
+        for ccd in range(1, 36):
+            self.tags.set_status(graph.node('1000001', ccd, 'build_cat'))
+        graph.load_statuses()
+        self.assertEqual(self.tags.lookups, 2)
+        finished, failed, blocked = graph.run(workers=2)
+        self.assertEqual(finished, ['build_cat_1000001_00', 'build_cat_1000002_02', 'stationary_100'])
+        self.assertEqual((failed, blocked), ([], []))
+        # the healpix job only ran once the CCDs it needs were done.
+        self.assertEqual(self.commands[-1], ['stationary', '--dbimages', storage.DBIMAGES, '--catalogs',
+                                             storage.CATALOG, '100'])
+        self.assertEqual(graph.pending(), [])
+
+    def test_failure_blocks_dependents(self):
+        graph = self.graph()
+        self.failing.add('build_cat_1000002_02')
+        finished, failed, blocked = graph.run(workers=4)
+        self.assertEqual(len(finished), 36)
+        self.assertEqual(failed, ['build_cat_1000002_02'])
+        self.assertEqual(blocked, ['stationary_100'])
+
+    def test_write_dag(self):
+        graph = self.graph()
+        for ccd in range(0, 36):
+            self.tags.set_status(graph.node('1000001', ccd, 'build_cat'))
+        filename = os.path.join(self.directory, 'pipeline.dag')
+        with patch('storage.FOOTPRINT_INDEX', 'footprints.sqlite'), patch('storage.REFRESH_QUERIES', True):
+            self.assertEqual(graph.write_dag(filename), 2)
+        lines = open(filename).read().splitlines()
+        self.assertIn("JOB build_cat_1000002_02 daomop.sub", lines)
+        self.assertIn('VARS build_cat_1000002_02 job="build_cat_1000002_02" executable="build_cat" '
+                      'arguments="--dbimages {} --ccd 2 1000002"'.format(storage.DBIMAGES), lines)
+        # the healpix job gets the catalogs, footprint index and refresh the pipeline was run with.
+        self.assertIn('VARS stationary_100 job="stationary_100" executable="stationary" '
+                      'arguments="--dbimages {} --catalogs {} --footprint-index footprints.sqlite --refresh 100"'.format(
+                          storage.DBIMAGES, storage.CATALOG), lines)
+        # the finished parent is not in the DAG.
+        self.assertIn("PARENT build_cat_1000002_02 CHILD stationary_100", lines)
+        self.assertTrue(os.access(os.path.join(self.directory, 'daomop.sub'), os.F_OK))
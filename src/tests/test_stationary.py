@@ -0,0 +1,101 @@
+from unittest import TestCase
+
+import numpy
+from astropy.table import Table
+from mock import patch, Mock, MagicMock
+
+import stationary
+import storage
+import util
+
+
+class FakeCatalog(object):
+
+    def __init__(self, ra, dec):
+        self.table = Table([ra, dec], names=('X_WORLD', 'Y_WORLD'))
+
+
+def fake_load_catalog(expnum, ccd):
+    """
+    Each CCD sees the same field, with the positions jittered by an amount that depends on the CCD.
+    """
+    random = numpy.random.RandomState(int(expnum) * 100 + ccd)
+    base = numpy.random.RandomState(0)
+    ra = 10.0 + base.uniform(0, 0.1, 200) + random.normal(0, 0.3 / 3600.0, 200)
+    dec = base.uniform(0, 0.1, 200) + random.normal(0, 0.3 / 3600.0, 200)
+    image = Mock()
+    image.polygon = storage.MyPolygon.from_footprint(numpy.array([[10.0, 0.0], [10.0, 0.05],
+                                                                  [10.1, 0.05], [10.1, 0.0]]))
+    return FakeCatalog(ra, dec), image
+
+
+class TestWorkingSet(TestCase):
+
+    def setUp(self):
+        patcher = patch('stationary.load_catalog', side_effect=fake_load_catalog)
+        self.load_catalog = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_count_matches(self):
+        keys = [('1000001', 1), ('1000002', 1), ('1000003', 1), ('1000004', 1)]
+        working_set = stationary.WorkingSet()
+        working_set.load(keys)
+        working_set.count_matches(keys[0], keys[1:])
+        table = working_set.catalog(keys[0]).table
+
+        # the same as matching against each catalog in turn.
+        p1 = numpy.transpose((table['X_WORLD'], table['Y_WORLD']))
+        expected = numpy.zeros(len(table), dtype=int)
+        overlaps = numpy.zeros(len(table), dtype=int)
+        for key in keys[1:]:
+            other = working_set.catalog(key).table
+            p2 = numpy.transpose((other['X_WORLD'], other['Y_WORLD']))
+            idx1, idx2 = util.match_lists(p1, p2, tolerance=stationary.MATCH_TOLERANCE, spherical=True)
+            expected[idx2.data[~idx2.mask]] += 1
+            overlaps += working_set.polygons[key].contains_points(table['X_WORLD'], table['Y_WORLD'])
+        self.assertEqual(list(table['MATCHES']), list(expected))
+        self.assertEqual(list(table['OVERLAPS']), list(overlaps))
+        self.assertGreater(expected.sum(), 0)
+        self.assertLess(expected.sum(), 3 * len(table))
+
+    def test_load_drops_unused(self):
+        working_set = stationary.WorkingSet()
+        working_set.load([('1000001', 1), ('1000002', 1)])
+        working_set.load([('1000002', 1), ('1000003', 1)])
+        self.assertEqual(sorted(working_set.catalogs), [('1000002', 1), ('1000003', 1)])
+        self.assertEqual(working_set.loads, 3)
+
+
+class TestMatchHealpix(TestCase):
+
+    def setUp(self):
+        self.neighbours = {}
+        for target in [('1000001', ccd) for ccd in range(6)]:
+            self.neighbours[target] = [('1000002', ccd) for ccd in range(4)]
+        for target, value in [('stationary.load_catalog', Mock(side_effect=fake_load_catalog)),
+                              ('stationary.neighbours', lambda expnum, ccd: self.neighbours[(expnum, ccd)]),
+                              ('stationary.match_partitions', Mock()),
+                              ('stationary.split_to_hpx', Mock()),
+                              ('storage.get_status', Mock(return_value=False)),
+                              ('storage.set_status', Mock()),
+                              ('storage.LoggingManager', MagicMock())]:
+            patcher = patch(target, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_catalogs_loaded_once(self):
+        overlaps = [[expnum, ccd] for expnum, ccd in sorted(self.neighbours)]
+        working_set = stationary.match_healpix(100, overlaps, '', 'p', False, False)
+        self.assertEqual(working_set.loads, 10)
+        self.assertEqual(stationary.split_to_hpx.call_count, 6)
+        statuses = [call[1]['status'] for call in storage.set_status.call_args_list]
+        self.assertEqual(statuses, [storage.SUCCESS] * 6)
+
+    def test_bounded_working_set(self):
+        groups = stationary.batches(sorted(self.neighbours), self.neighbours, max_catalogs=6)
+        self.assertEqual([len(group) for group, needed in groups], [2, 2, 2])
+        self.assertTrue(all([len(needed) <= 6 for group, needed in groups]))
+        overlaps = [[expnum, ccd] for expnum, ccd in sorted(self.neighbours)]
+        working_set = stationary.match_healpix(100, overlaps, '', 'p', False, False, max_catalogs=6)
+        self.assertEqual(stationary.split_to_hpx.call_count, 6)
+        self.assertLessEqual(len(working_set.catalogs), 6)
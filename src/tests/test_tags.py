@@ -0,0 +1,37 @@
+from unittest import TestCase
+
+from mock import patch, Mock
+
+import storage
+
+
+class TestBufferedTags(TestCase):
+    """
+    Check that exposure tags are read with one node look up and buffered writes go out in one add_props.
+    """
+
+    def setUp(self):
+        storage._tag_cache.clear()
+        self.node = Mock()
+        self.node.props = {storage.tag_uri(storage.get_process_tag('build_cat', 1, 'p')): storage.SUCCESS}
+        patcher = patch('storage.vospace.client')
+        self.client = patcher.start()
+        self.client.get_node.return_value = self.node
+        self.addCleanup(patcher.stop)
+
+    def test_get_statuses_single_lookup(self):
+        statuses = storage.get_statuses('build_cat', '', '1000001', 'p', range(3))
+        self.assertEqual(statuses, {0: False, 1: True, 2: False})
+        self.assertTrue(storage.get_status('build_cat', '', '1000001', 'p', 1))
+        self.assertEqual(self.client.get_node.call_count, 1)
+
+    def test_buffered_set_status(self):
+        with storage.buffered_tags():
+            for ccd in range(3):
+                storage.set_status('build_cat', '', '1000001', 'p', ccd, storage.SUCCESS)
+            self.assertEqual(self.client.add_props.call_count, 0)
+            # buffered values are visible before they are written.
+            self.assertTrue(storage.get_status('build_cat', '', '1000001', 'p', 2))
+        self.assertEqual(self.client.add_props.call_count, 1)
+        self.assertEqual(storage.get_statuses('build_cat', '', '1000001', 'p', range(3)),
+                         {0: True, 1: True, 2: True})
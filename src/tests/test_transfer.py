@@ -0,0 +1,161 @@
+import errno
+import hashlib
+import os
+import shutil
+import tempfile
+import threading
+import time
+from unittest import TestCase
+
+from mock import patch, Mock
+
+import storage
+import transfer
+
+
+class FakeVOSpace(object):
+    """
+    Copies between a local directory and a dict of node content, failing the first `failures` copies.
+    """
+
+    def __init__(self, failures=0, corrupt=0):
+        self.nodes = {}
+        self.failures = failures
+        self.corrupt = corrupt
+        self.calls = 0
+        self.active = 0
+        self.max_active = 0
+        self.lock = threading.Lock()
+
+    def copy(self, source, destination):
+        with self.lock:
+            self.calls += 1
+            self.active += 1
+            self.max_active = max(self.active, self.max_active)
+            fail = self.failures > 0
+            self.failures -= 1
+            corrupt = self.corrupt > 0
+            self.corrupt -= 1
+        try:
+            time.sleep(0.01)
+            if fail:
+                raise OSError(errno.EIO, "connection reset")
+            if source.startswith('vos:'):
+                source = source.split('[')[0]
+                if source not in self.nodes:
+                    raise OSError(errno.ENOENT, "no such node", source)
+                with open(destination, 'w') as fobj:
+                    fobj.write(corrupt and 'garbage' or self.nodes[source])
+            else:
+                self.nodes[destination] = corrupt and 'garbage' or open(source).read()
+        finally:
+            with self.lock:
+                self.active -= 1
+
+    def checksum(self, uri):
+        if uri not in self.nodes:
+            return None
+        return hashlib.md5(self.nodes[uri]).hexdigest(), len(self.nodes[uri])
+
+
+class TestTransferEngine(TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.vospace = FakeVOSpace()
+        self.engine = transfer.TransferEngine(self.vospace.copy, checksum=self.vospace.checksum, workers=3,
+                                              retries=3, verify=True)
+        patcher = patch('transfer.BACKOFF', 0.0)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        self.engine.close()
+        shutil.rmtree(self.directory)
+
+    def local(self, name, content=None):
+        filename = os.path.join(self.directory, name)
+        if content is not None:
+            with open(filename, 'w') as fobj:
+                fobj.write(content)
+        return filename
+
+    def test_retry(self):
+        self.vospace.failures = 2
+        self.engine.transfer(self.local('a.fits', 'aaa'), 'vos:a.fits')
+        self.assertEqual(self.vospace.nodes['vos:a.fits'], 'aaa')
+        self.assertEqual(self.engine.stats['retries'], 2)
+
+    def test_give_up(self):
+        self.vospace.failures = 10
+        self.assertRaises(OSError, self.engine.transfer, self.local('a.fits', 'aaa'), 'vos:a.fits')
+        self.assertEqual(self.vospace.calls, 4)
+
+    def test_missing_not_retried(self):
+        self.assertRaises(OSError, self.engine.transfer, 'vos:missing.fits', self.local('missing.fits'))
+        self.assertEqual(self.vospace.calls, 1)
+
+    def test_checksum_mismatch_retried(self):
+        self.vospace.corrupt = 1
+        self.engine.transfer(self.local('b.fits', 'bbb'), 'vos:b.fits')
+        self.assertEqual(self.vospace.nodes['vos:b.fits'], 'bbb')
+        self.assertEqual(self.vospace.calls, 2)
+        self.assertEqual(self.engine.stats['verified'], 2)
+
+    def test_downloads_not_checked(self):
+        # vos checks the MD5 of downloads, the node is not looked up again.
+        self.vospace.nodes['vos:b.fits'] = 'bbb'
+        self.engine.checksum = Mock()
+        self.engine.transfer('vos:b.fits', self.local('b.fits'))
+        self.assertEqual(self.engine.checksum.call_count, 0)
+
+    def test_lagging_checksum(self):
+        # the node MD5 is that of the file overwritten until the service catches up.
+        self.vospace.nodes['vos:b.fits'] = 'old'
+        checksums = [('stale', 3), None]
+        self.engine.checksum = lambda uri: checksums.pop(0) or self.vospace.checksum(uri)
+        with patch('transfer.CHECK_DELAY', 0.0):
+            self.engine.transfer(self.local('b.fits', 'bbb'), 'vos:b.fits')
+        self.assertEqual(self.vospace.calls, 1)
+        self.assertEqual(self.engine.stats['retries'], 0)
+
+    def test_batch(self):
+        pairs = [(self.local('{}.fits'.format(idx), str(idx)), 'vos:{}.fits'.format(idx)) for idx in range(9)]
+        self.vospace.failures = 1
+        futures = self.engine.submit_batch(pairs)
+        self.assertEqual(len(self.engine.wait(futures)), 9)
+        self.assertEqual(sorted(self.vospace.nodes.values()), [str(idx) for idx in range(9)])
+        self.assertLessEqual(self.vospace.max_active, 3)
+        self.assertGreater(self.vospace.max_active, 1)
+
+    def test_wait_raises_after_batch(self):
+        self.vospace.nodes['vos:c.fits'] = 'ccc'
+        pairs = [('vos:missing.fits', self.local('missing.fits')), ('vos:c.fits', self.local('c.fits'))]
+        self.assertRaises(OSError, self.engine.copy_batch, pairs)
+        self.assertEqual(open(self.local('c.fits')).read(), 'ccc')
+
+
+class TestCopyMany(TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.vospace = FakeVOSpace()
+        self.vospace.nodes = {'vos:a.fits': 'aaa', 'vos:b.fits': 'bbb'}
+        engine = transfer.TransferEngine(self.vospace.copy, checksum=self.vospace.checksum, workers=2)
+        self.addCleanup(engine.close)
+        for target, value in [('storage._transfer_engine', engine),
+                              ('storage._artifact_cache', None),
+                              ('storage.get_artifact_cache', lambda: None)]:
+            patcher = patch(target, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_copy_many(self):
+        pairs = [(uri, os.path.join(self.directory, uri[4:])) for uri in ['vos:a.fits', 'vos:b.fits']]
+        storage.copy_many(pairs)
+        self.assertEqual(open(pairs[1][1]).read(), 'bbb')
+        storage.copy(pairs[0][1], 'vos:d.fits')
+        self.assertEqual(self.vospace.nodes['vos:d.fits'], 'aaa')
@@ -0,0 +1,71 @@
+import argparse
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+
+from mock import patch, Mock
+
+import vospace
+
+
+class TestWrapper(TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.failures = 1
+        for target, value in [('vos.vos.Client.get_node', lambda this, uri, **kwargs: this.isdir(uri)),
+                              ('vos.vos.Client.isdir', Mock(return_value=True)),
+                              ('vos.vos.Client.copy', lambda this, source, destination: self.copy(source,
+                                                                                                 destination))]:
+            patcher = patch(target, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def copy(self, source, destination):
+        if self.failures > 0:
+            self.failures -= 1
+            raise IOError("connection reset")
+        with open(destination, 'w') as fobj:
+            fobj.write("x" * 100)
+
+    def test_trace(self):
+        client = vospace.Wrapper(size=3)
+        client.get_node('vos:a/b')
+        client.get_node('vos:a/b', force=True)
+        client.get_node('vos:a/c')
+        filename = os.path.join(self.directory, 'c.fits')
+        self.assertRaises(IOError, client.copy, 'vos:a/c.fits', filename)
+        client.copy('vos:a/c.fits', filename)
+
+        # the ring buffer holds the most recent calls.
+        self.assertEqual([call['method'] for call in client.trace.calls], ['get_node', 'copy', 'copy'])
+        self.assertEqual([(call['bytes'], call['retry']) for call in list(client.trace.calls)[1:]],
+                         [(0, False), (100, True)])
+        # the isdir calls made by get_node are not traced on their own.
+        self.assertEqual(sorted(client.trace.histograms), ['copy', 'get_node'])
+        self.assertEqual(client.trace.histograms['get_node'].calls, 3)
+        self.assertEqual(client.trace.histograms['copy'].failures, 1)
+        self.assertEqual(client.trace.redundant(), [('get_node', 'vos:a/b', 2)])
+        report = client.trace.report()
+        self.assertIn("copy: 2 calls, 1 failed", report)
+        self.assertIn("1 retries", report)
+        self.assertIn("  2 x get_node vos:a/b", report)
+
+    def test_enable_tracing(self):
+        with patch('vospace.client', vospace.MeteredClient()), patch('atexit.register') as register:
+            client = vospace.enable_tracing(size=5)
+            self.assertIs(vospace.client, client)
+            self.assertEqual(client.trace.calls.maxlen, 5)
+            # enabling again keeps the trace.
+            self.assertIs(vospace.enable_tracing(), client)
+            self.assertEqual(register.call_count, 1)
+
+    def test_trace_argument(self):
+        parser = argparse.ArgumentParser()
+        vospace.add_trace_argument(parser)
+        self.assertTrue(parser.parse_args(['--trace-vos']).trace_vos)
+        self.assertFalse(parser.parse_args([]).trace_vos)
@@ -0,0 +1,122 @@
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+
+import numpy
+from astropy.io import fits
+from mock import patch
+
+import storage
+import util
+import wcs
+
+PV = [[-7.030338745606E-03, 1.01755337222, 8.262429361142E-03,
+       0.00000000000, -5.910145454849E-04, -7.494178330178E-04,
+       -3.470178516657E-04, -2.331150605755E-02, -8.187062772669E-06,
+       -2.325429510806E-02, 1.135299506292E-04],
+      [-6.146513090656E-03, 1.01552885426, 8.259666421752E-03,
+       0.00000000000, -4.567030382243E-04, -6.978676921999E-04,
+       -3.732572951216E-04, -2.332572754467E-02, -2.354317291723E-05,
+       -2.329623852891E-02, 1.196394469003E-04]]
+DC = [[19550.08417778, 269.58539826],
+      [-48.85428173, -19520.05812122]]
+
+
+def pv_header():
+    """
+    A MegaPipe style header of a CCD near the edge of the mosaic, where the distortion is largest.
+    """
+    header = fits.Header()
+    cd = numpy.linalg.inv(DC)
+    cards = [('NAXIS', 2), ('NAXIS1', 2112), ('NAXIS2', 4644),
+             ('CTYPE1', 'RA---TAN'), ('CTYPE2', 'DEC--TAN'),
+             ('CRPIX1', -7535.57493517), ('CRPIX2', 9808.40914361),
+             ('CRVAL1', 176.486157083), ('CRVAL2', 8.03697351091),
+             ('CD1_1', cd[0][0]), ('CD1_2', cd[0][1]), ('CD2_1', cd[1][0]), ('CD2_2', cd[1][1]),
+             ('NORDFIT', 3)]
+    for key, value in cards:
+        header[key] = value
+    for axis in [0, 1]:
+        for idx, value in enumerate(PV[axis]):
+            header['PV{}_{}'.format(axis + 1, idx)] = value
+    return header
+
+
+class TestSky2xypv(TestCase):
+
+    def setUp(self):
+        self.wcs = wcs.WCS(pv_header())
+        numpy.random.seed(0)
+        self.x = numpy.random.uniform(1, 2112, 1000)
+        self.y = numpy.random.uniform(1, 4644, 1000)
+        ra, dec = self.wcs.xy2sky(self.x, self.y)
+        self.ra = ra.value
+        self.dec = dec.value
+
+    def test_round_trip(self):
+        for inverse in [None, self.wcs.pv_inverse]:
+            x, y = wcs.sky2xypv(self.ra, self.dec, self.wcs.crpix1, self.wcs.crpix2, self.wcs.crval1,
+                                self.wcs.crval2, self.wcs.dc, self.wcs.pv, self.wcs.nord, inverse=inverse)
+            self.assertLess(numpy.fabs(x - self.x).max(), 0.01)
+            self.assertLess(numpy.fabs(y - self.y).max(), 0.01)
+
+    def test_sky2xy_arrays(self):
+        x, y = self.wcs.sky2xy(self.ra, self.dec)
+        self.assertEqual(x.shape, self.x.shape)
+        self.assertLess(numpy.fabs(x - self.x).max(), 0.01)
+        self.assertLess(numpy.fabs(y - self.y).max(), 0.01)
+
+    def test_matches_scalar(self):
+        for idx in range(10):
+            expected = wcs.sky2xypv_scalar(self.ra[idx], self.dec[idx], self.wcs.crpix1, self.wcs.crpix2,
+                                           self.wcs.crval1, self.wcs.crval2, self.wcs.dc, self.wcs.pv,
+                                           self.wcs.nord)
+            result = self.wcs.sky2xy(self.ra[idx], self.dec[idx])
+            self.assertTrue(numpy.isscalar(result[0]))
+            self.assertAlmostEqual(result[0], expected[0], 3)
+            self.assertAlmostEqual(result[1], expected[1], 3)
+
+    def test_inverse_is_close(self):
+        self.assertLess(self.wcs.pv_inverse.max_residual * numpy.fabs(DC).max(), 0.1)
+
+
+class TestDistortion(TestCase):
+
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.directory = tempfile.mkdtemp()
+        os.chdir(self.directory)
+        header = storage.Header(storage.Observation('1000001'))
+        with open(header.filename, 'w') as fobj:
+            for card_header in [fits.Header([('SIMPLE', True)]), pv_header()]:
+                for card in card_header.cards:
+                    fobj.write(str(card) + '\n')
+                fobj.write('END      \n')
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        shutil.rmtree(self.directory)
+
+    def test_parsed_once(self):
+        image_wcs = wcs.WCS(pv_header())
+        with patch('wcs.parse_pv', wraps=wcs.parse_pv) as parse_pv:
+            for idx in range(3):
+                image_wcs.sky2xy(176.0, 8.0)
+                image_wcs.xy2sky(1000.0, 1000.0)
+            self.assertEqual(parse_pv.call_count, 1)
+
+    def test_sidecar(self):
+        header = storage.Header(storage.Observation('1000001'))
+        with patch('wcs.parse_pv', wraps=wcs.parse_pv) as parse_pv:
+            self.assertEqual(header.distortion(1).pv, PV)
+            self.assertIsNone(header.distortion(0))
+            # only the extension asked for is parsed.
+            self.assertEqual(parse_pv.call_count, 1)
+        # the distortions share the sidecar of the keywords of the .head file.
+        self.assertTrue(os.access('1000001p.head' + util.HEAD_CACHE_EXT, os.F_OK))
+        with patch('wcs.parse_pv') as parse_pv:
+            distortion = storage.Header(storage.Observation('1000001')).distortion(1)
+            self.assertFalse(parse_pv.called)
+        self.assertEqual(distortion.pv, PV)
+        numpy.testing.assert_allclose(distortion.dc, DC, rtol=1e-8)
@@ -0,0 +1,113 @@
+import threading
+from unittest import TestCase
+
+from mock import patch
+from six.moves import BaseHTTPServer, socketserver
+
+import storage
+import webservice
+
+TSV = "collectionID\tRA\tDE\n1000001\t10.5\t-1.5\n1000002\t11.0\t2.0\n"
+
+
+class StubHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """
+    Answer TAP style queries with a fixed TSV table, failing the first `failures` requests with a 503.
+    """
+    failures = 0
+    requests = []
+    clients = set()
+
+    def do_GET(self):
+        StubHandler.requests.append(self.path)
+        StubHandler.clients.add(self.client_address)
+        if StubHandler.failures > 0:
+            StubHandler.failures -= 1
+            self.send_response(503)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        if 'missing' in self.path:
+            self.send_response(404)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/tab-separated-values')
+        self.send_header('Content-Length', str(len(TSV)))
+        self.end_headers()
+        self.wfile.write(TSV.encode('utf-8'))
+
+    def log_message(self, *args):
+        pass
+
+
+class StubServer(socketserver.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+
+class TestWebService(TestCase):
+
+    def setUp(self):
+        self.server = StubServer(('127.0.0.1', 0), StubHandler)
+        # keep-alive, so the client can reuse its pooled connection.
+        StubHandler.protocol_version = 'HTTP/1.1'
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        self.url = 'http://127.0.0.1:{}/tap/sync'.format(self.server.server_address[1])
+        StubHandler.failures = 0
+        StubHandler.requests = []
+        StubHandler.clients = set()
+        self.client = webservice.Client(retries=2)
+        for target, value in [('webservice._client', self.client),
+                              ('webservice.BACKOFF', 0.0),
+                              ('storage.TAP_WEB_SERVICE', self.url),
+                              ('storage._query_cache', None)]:
+            patcher = patch(target, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        self.client.session.close()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_tap_query(self):
+        table = storage.tap_query("SELECT * FROM caom2.Observation")
+        self.assertEqual(list(table['collectionID']), [1000001, 1000002])
+        self.assertIn('SELECT', StubHandler.requests[0])
+        self.assertEqual(self.client.histograms[self.url].calls, 1)
+
+    def test_connection_reused(self):
+        for idx in range(3):
+            storage.tap_query("SELECT * FROM caom2.Observation")
+        self.assertEqual(len(StubHandler.clients), 1)
+
+    def test_retry_server_errors(self):
+        StubHandler.failures = 2
+        table = storage.tap_query("SELECT * FROM caom2.Observation")
+        self.assertEqual(len(table), 2)
+        self.assertEqual(len(StubHandler.requests), 3)
+        self.assertEqual(self.client.histograms[self.url].failures, 2)
+
+    def test_give_up(self):
+        StubHandler.failures = 5
+        self.assertRaises(webservice.requests.HTTPError, webservice.get, self.url)
+        self.assertEqual(len(StubHandler.requests), 3)
+
+    def test_client_errors_are_not_retried(self):
+        self.assertRaises(webservice.requests.HTTPError, webservice.get, self.url.replace('sync', 'missing'))
+        self.assertEqual(len(StubHandler.requests), 1)
+        self.assertIn('1 failed', webservice.latency_report())
+
+    def test_certificates_verified(self):
+        response = webservice.requests.Response()
+        response.status_code = 200
+        with patch.object(self.client.session, 'request', return_value=response) as request:
+            webservice.get('https://ssd.jpl.nasa.gov/horizons_batch.cgi')
+            self.assertTrue(request.call_args[1]['verify'])
+            webservice.get('https://www.cadc-ccda.hia-iha.nrc-cnrc.gc.ca/tap/sync')
+            self.assertFalse(request.call_args[1]['verify'])
+        with patch.dict('os.environ', {webservice.UNVERIFIED_HOSTS_ENV: ''}):
+            self.assertEqual(webservice.Client().unverified_hosts, set())
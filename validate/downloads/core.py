@@ -2,8 +2,6 @@ import os
 
 __author__ = "David Rusk <drusk@uvic.ca>"
 
-from astropy.io import fits
-import cStringIO
 from src.validate.gui import logger
 from src.daomop import storage
 import sys
@@ -34,17 +32,9 @@ class Downloader(object):
         logger.debug(str(kwargs))
         hdulist = None
         try:
-            vobj = storage.vofile(uri, **kwargs)
-            try:
-                fobj = cStringIO.StringIO(vobj.read())
-                fobj.seek(0)
-                hdulist = fits.open(fobj)
-            except Exception as e:
-                sys.stderr.write("ERROR: {}\n".format(str(e)))
-                sys.stderr.write("While loading {} {}\n".format(uri, kwargs))
-                pass
-            finally:
-                vobj.close()
+            # streamed straight into the HDUList's buffer.
+            cutout = kwargs.get('view', None) == 'cutout' and str(kwargs.get('cutout', '')) or None
+            hdulist = storage.read_hdulist(uri, cutout=cutout)
         except Exception as e:
             sys.stderr.write(str(e)+"\n")
             sys.stderr.write("While opening connection to {}.\n".format(uri))
@@ -6,20 +6,18 @@ import pprint
 import warnings
 
 import numpy
-import requests
 from astropy import units
 from astropy.coordinates import SkyCoord
 from astropy.io import ascii
 from astropy.time import Time
 
-from src.daomop import astrom, mpc
+from src.daomop import astrom, mpc, webservice
 from src.planning import parameters
 from src.validate.gui import config
 from .astrom import SourceReading
 from .gui import logger
 from .orbfit import Orbfit
 
-requests.packages.urllib3.disable_warnings()
 
 __author__ = 'Michele Bannister, JJ Kavelaars'
 
@@ -729,12 +727,10 @@ class Query(object):
         """
         params = self.param_dict_builder.params
         logger.debug(pprint.pformat(format(params)))
-        response = requests.post(SSOS_URL,
-                                 data=params,
-                                 headers=self.headers)
+        response = webservice.post(SSOS_URL,
+                                   data=params,
+                                   headers=self.headers)
         logger.debug(response.url)
-        assert isinstance(response, requests.Response)
-        assert (response.status_code == requests.codes.ok)
 
         lines = response.content
         # note: spelling 'occured' is in SSOIS